@@ -5,6 +5,17 @@ import os
 from httpx import AsyncClient, ASGITransport
 from pytest_httpx import HTTPXMock
 from fhir_proxy.app import app
+from fhir_proxy.app.authcache import auth_cache
+from fhir_proxy.app.auth import jwks_validator
+from fhir_proxy.app.responsecache import response_cache
+from fhir_proxy.app.coalesce import coalescer
+from fhir_proxy.app.metrics import registry
+from fhir_proxy.app.paging import prefetch_cache
+from fhir_proxy.app.limiter import gen3_limiter, hapi_limiter
+from fhir_proxy.app.breaker import gen3_breaker, hapi_breaker
+from fhir_proxy.app.hedge import hapi_hedger
+from fhir_proxy.app.profiling import profiler
+from fhir_proxy.app.config import GEN_USER_URL
 from dotenv import load_dotenv
 import pytest_asyncio
 
@@ -19,7 +30,6 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 # -----------------------------
 load_dotenv(".env.test", override=True)
-GEN_USER_URL = os.getenv("GEN_USER_URL")
 FHIR_SERVER_URL = os.getenv("FHIR_SERVER_URL")
 
 # -----------------------------
@@ -109,6 +119,61 @@ def mock_hapi_httpx(httpx_mock: HTTPXMock):
 
     return _mock
 
+# -----------------------------
+# Reset in-process caches between tests
+# -----------------------------
+@pytest.fixture(autouse=True)
+def reset_caches():
+    auth_cache.reset()
+    jwks_validator.reset()
+    response_cache.reset()
+    coalescer.reset()
+    registry.reset()
+    prefetch_cache.reset()
+    hapi_limiter.reset()
+    gen3_limiter.reset()
+    hapi_breaker.reset()
+    gen3_breaker.reset()
+    hapi_hedger.reset()
+    profiler.clear()
+    yield
+    auth_cache.reset()
+    jwks_validator.reset()
+    response_cache.reset()
+    coalescer.reset()
+    registry.reset()
+    prefetch_cache.reset()
+    hapi_limiter.reset()
+    gen3_limiter.reset()
+    hapi_breaker.reset()
+    gen3_breaker.reset()
+    hapi_hedger.reset()
+    profiler.clear()
+
+# -----------------------------
+# Shared test helpers
+# -----------------------------
+# The tests call the proxy with absolute URLs under this root.
+PROXY_ROOT = "http://localhost:8080"
+# The _security parameter the proxy adds for mock_gen3_httpx's default resources.
+FRAGMENT = "_security=gen3%7CObservation%2Cgen3%7CPatient"
+
+
+def tagged(resource_type, resource_id=None, *codes, **fields):
+    """A resource carrying `codes` as gen3 security tags."""
+    resource = {"resourceType": resource_type}
+    if resource_id is not None:
+        resource["id"] = resource_id
+    resource["meta"] = {"security": [{"system": "gen3", "code": code} for code in codes]}
+    resource.update(fields)
+    return resource
+
+
+async def chunked(data, size=16):
+    """`data` as an async body of `size`-byte chunks."""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
 # -----------------------------
 # Test bearer token fixture
 # -----------------------------
@@ -0,0 +1,89 @@
+import asyncio
+import base64
+import json
+import re
+import time
+
+import httpx
+import pytest
+
+from fhir_proxy.app.authcache import AuthorizationCache, auth_cache, token_expiry
+from conftest import GEN_USER_URL
+
+
+def make_jwt(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).rstrip(b"=").decode()
+    return f"header.{payload}.signature"
+
+
+@pytest.mark.asyncio
+async def test_repeated_requests_hit_cache(client, mock_gen3_httpx, mock_hapi_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    mock_hapi_httpx(path="/Patient/123")
+    mock_hapi_httpx(path="/Patient/123")
+
+    for _ in range(2):
+        response = await client.get("/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 200
+
+    assert auth_cache.stats()["hits"] == 1
+    assert auth_cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_forbidden_lookup_is_negatively_cached(client, httpx_mock):
+    url_pattern = re.compile(rf"{re.escape(GEN_USER_URL)}/?(\?.*)?$")
+    httpx_mock.add_response(method="GET", url=url_pattern, status_code=403)
+
+    for _ in range(2):
+        response = await client.get("/Patient/123", headers={"Authorization": "Bearer bad-token"})
+        assert response.status_code == 403
+
+    assert auth_cache.stats()["negative_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_are_coalesced():
+    cache = AuthorizationCache(ttl=60, negative_ttl=5, max_entries=10, max_bytes=10_000)
+    calls = 0
+
+    async def loader(token):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return ["Patient"]
+
+    results = await asyncio.gather(*(cache.get_or_load("token", loader) for _ in range(5)))
+
+    assert calls == 1
+    assert results == [["Patient"]] * 5
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_and_jwt_expiry():
+    cache = AuthorizationCache(ttl=60, negative_ttl=5, max_entries=2, max_bytes=10_000)
+
+    async def loader(token):
+        return [token]
+
+    for token in ("a", "b", "c"):
+        await cache.get_or_load(token, loader)
+    await cache.get_or_load(make_jwt(time.time() - 10), loader)
+
+    assert len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+    assert token_expiry(make_jwt(1234)) == 1234.0
+
+
+@pytest.mark.asyncio
+async def test_gen3_errors_propagate():
+    cache = AuthorizationCache(ttl=60, negative_ttl=5, max_entries=2, max_bytes=10_000)
+    request = httpx.Request("GET", "https://gen3.example.org/user/user")
+
+    async def loader(token):
+        raise httpx.HTTPStatusError("boom", request=request, response=httpx.Response(500, request=request))
+
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            await cache.get_or_load("token", loader)
+    assert len(cache) == 0
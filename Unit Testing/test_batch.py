@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from fhir_proxy.app.batch import BatchEntry, parse_entries, secure_response_entry
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from conftest import FRAGMENT, PROXY_ROOT, tagged
+
+
+def batch(*entries):
+    return {"resourceType": "Bundle", "type": "batch", "entry": list(entries)}
+
+
+def get(url):
+    return {"request": {"method": "GET", "url": url}}
+
+
+async def post_batch(client, token, bundle):
+    return await client.post(f"{PROXY_ROOT}/", content=json.dumps(bundle),
+                              headers={"Authorization": f"Bearer {token}", "Content-Type": "application/fhir+json"})
+
+
+def test_invalid_and_disallowed_entries_become_error_entries():
+    parsed = parse_entries([
+        get("Patient/1"),
+        get(f"{HAPI_FHIR_URL}/Patient/2"),
+        get("https://elsewhere.example.org/fhir/Patient/3"),
+        {"request": {"method": "PATCH", "url": "Patient/4"}},
+        {"request": {"method": "POST", "url": "Patient"}, "resource": tagged("Patient", "5", "Secret")},
+        {"request": {"method": "PUT", "url": "Patient/6", "ifMatch": 'W/"1"'}, "resource": tagged("Patient", "6", "Patient")},
+    ], (HAPI_FHIR_URL,), ["Patient"])
+
+    assert [entry.url for entry in parsed[:2]] == ["Patient/1", "Patient/2"]
+    assert [entry["response"]["status"] for entry in parsed[2:5]] == ["400 Bad Request", "400 Bad Request", "403 Forbidden"]
+    assert isinstance(parsed[5], BatchEntry)
+    assert parsed[5].headers == {"If-Match": 'W/"1"'}
+
+
+@pytest.mark.asyncio
+async def test_batch_entries_fan_out_with_security(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient/1?{FRAGMENT}", json=tagged("Patient", "1", "Patient"))
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient/2?{FRAGMENT}", json=tagged("Patient", "2", "Secret"))
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Observation?code=x&{FRAGMENT}",
+                            json={"resourceType": "Bundle", "type": "searchset", "entry": [
+                                {"resource": tagged("Observation", "o1", "Observation")},
+                                {"resource": tagged("Observation", "o2", "Secret")},
+                            ]})
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient/404?{FRAGMENT}", status_code=404,
+                            json={"resourceType": "OperationOutcome"})
+
+    response = await post_batch(client, test_token, batch(
+        get("Patient/1"),
+        get("Patient/2"),
+        get("Observation?code=x"),
+        get("Patient/404"),
+        {"request": {"method": "POST", "url": "Observation"}, "resource": tagged("Observation", "n", "Secret")},
+    ))
+
+    assert response.status_code == 200
+    bundle = response.json()
+    assert bundle["type"] == "batch-response"
+    statuses = [entry["response"]["status"] for entry in bundle["entry"]]
+    assert statuses == ["200 OK", "403 Forbidden", "200 OK", "404 Not Found", "403 Forbidden"]
+    assert bundle["entry"][0]["resource"]["id"] == "1"
+    assert [e["resource"]["id"] for e in bundle["entry"][2]["resource"]["entry"]] == ["o1"]
+    # The disallowed write never reaches HAPI; Gen3 is asked once.
+    assert all(request.method == "GET" for request in httpx_mock.get_requests())
+    assert len(httpx_mock.get_requests()) == 5
+
+
+@pytest.mark.asyncio
+async def test_batch_sent_upstream_as_one_bundle(client, httpx_mock, mock_gen3_httpx, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "BATCH_MODE", "upstream")
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="POST", url=HAPI_FHIR_URL, json={"resourceType": "Bundle", "type": "batch-response",
+                                                                     "entry": [
+        {"response": {"status": "200 OK"}, "resource": tagged("Patient", "1", "Patient")},
+        {"response": {"status": "200 OK"}, "resource": tagged("Patient", "2", "Secret")},
+    ]})
+
+    response = await post_batch(client, test_token, batch(get("Patient/1"), {"request": {"url": "Patient/3"}}, get("Patient/2")))
+
+    statuses = [entry["response"]["status"] for entry in response.json()["entry"]]
+    assert statuses == ["200 OK", "400 Bad Request", "403 Forbidden"]
+    sent = json.loads(httpx_mock.get_requests()[-1].content)
+    assert [entry["request"]["url"] for entry in sent["entry"]] == [f"Patient/1?{FRAGMENT}", f"Patient/2?{FRAGMENT}"]
+
+
+@pytest.mark.asyncio
+async def test_oversized_batch_is_rejected(client, mock_gen3_httpx, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "BATCH_MAX_ENTRIES", 1)
+    mock_gen3_httpx(token=test_token)
+
+    response = await post_batch(client, test_token, batch(get("Patient/1"), get("Patient/2")))
+
+    assert response.status_code == 413
+
+
+def test_export_file_read_in_a_batch_is_refused():
+    export = {"resourceType": "Binary", "id": "7", "contentType": "application/fhir+ndjson", "data": "e30K",
+              "meta": {"security": [{"system": "gen3", "code": "Patient"}]}}
+
+    entry = secure_response_entry({"resource": export, "response": {"status": "200 OK"}}, ["Patient"])
+
+    assert entry["response"]["status"].startswith("406")
+    assert "resource" not in entry
@@ -0,0 +1,144 @@
+import asyncio
+
+import httpx
+import pytest
+
+from fhir_proxy.app.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, gen3_breaker
+from fhir_proxy.app.hedge import Hedger
+from fhir_proxy.app.limiter import Overloaded
+from conftest import PROXY_ROOT
+
+
+def make_breaker(**kwargs):
+    options = dict(window=10, min_calls=4, failure_rate=0.5, slow_call_seconds=1.0, slow_call_rate=0.8,
+                   open_seconds=60.0, half_open_calls=2)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+async def call(breaker, failed=False):
+    async with breaker.guard() as outcome:
+        outcome.failed = failed
+
+
+async def timed_out(breaker):
+    with pytest.raises(httpx.ReadTimeout):
+        async with breaker.guard():
+            raise httpx.ReadTimeout("timed out")
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_on_failure_rate_and_fails_fast():
+    breaker = make_breaker()
+    await call(breaker)
+    await call(breaker, failed=True)
+    await call(breaker)
+    assert breaker.state == CLOSED
+
+    await timed_out(breaker)
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpen) as rejected:
+        await call(breaker)
+    assert rejected.value.retry_after >= 59
+    assert breaker.stats()["trips"] == 1
+    assert breaker.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_local_load_shedding_is_not_an_upstream_failure():
+    breaker = make_breaker(min_calls=1)
+    for _ in range(10):
+        with pytest.raises(Overloaded):
+            async with breaker.guard():
+                raise Overloaded("hapi", 1)
+
+    assert breaker.state == CLOSED
+    assert breaker.stats()["failures"] == 0
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_on_slow_calls():
+    breaker = make_breaker(slow_call_seconds=0.0)
+    for _ in range(4):
+        await call(breaker)
+    assert breaker.state == OPEN
+
+
+@pytest.mark.asyncio
+async def test_half_open_probes_close_or_reopen_the_breaker():
+    breaker = make_breaker(min_calls=1, open_seconds=0.0)
+    await call(breaker, failed=True)
+    assert breaker.state == OPEN
+
+    await call(breaker)
+    assert breaker.state == HALF_OPEN
+    await call(breaker, failed=True)
+    assert breaker.state == OPEN
+
+    await call(breaker)
+    await call(breaker)
+    assert breaker.state == CLOSED
+    assert breaker.trips == 2
+
+
+@pytest.mark.asyncio
+async def test_half_open_admits_limited_probes():
+    breaker = make_breaker(min_calls=1, open_seconds=0.0, half_open_calls=1)
+    await call(breaker, failed=True)
+
+    async with breaker.guard():
+        with pytest.raises(CircuitOpen):
+            await call(breaker)
+    assert breaker.state == CLOSED
+
+
+@pytest.mark.asyncio
+async def test_open_gen3_breaker_returns_503_without_calling_gen3(client, httpx_mock, test_token, monkeypatch):
+    monkeypatch.setattr(gen3_breaker, "min_calls", 1)
+    await call(gen3_breaker, failed=True)
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 503
+    assert "retry-after" in response.headers
+    assert httpx_mock.get_requests() == []
+
+
+async def respond_after(delay, label, sent):
+    sent.append(label)
+    await asyncio.sleep(delay)
+    return httpx.Response(200, text=label)
+
+
+@pytest.mark.asyncio
+async def test_slow_request_is_hedged_and_fast_attempt_wins():
+    hedger = Hedger(quantile=0.95, min_delay=0.01, window=100, min_samples=5, max_ratio=1.0)
+    for _ in range(5):
+        hedger.record(0.01)
+    delays = iter([1.0, 0.0])
+    sent = []
+
+    resp = await hedger.send(lambda: respond_after(next(delays), f"attempt-{len(sent)}", sent))
+
+    assert resp.text == "attempt-1"
+    assert sent == ["attempt-0", "attempt-1"]
+    assert (hedger.hedged, hedger.hedge_wins) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_hedging_needs_samples_budget_and_permission():
+    hedger = Hedger(quantile=0.95, min_delay=0.0, window=100, min_samples=1, max_ratio=1.0)
+    sent = []
+
+    await hedger.send(lambda: respond_after(0.02, "first", sent))
+    assert hedger.delay() is not None
+    await hedger.send(lambda: respond_after(0.05, "vetoed", sent), may_hedge=lambda: False)
+
+    assert sent == ["first", "vetoed"]
+    assert hedger.hedged == 0
+    assert hedger.primary_wins == 2
+
+    hedger.max_ratio = 0.0
+    await hedger.send(lambda: respond_after(0.05, "over-budget", sent))
+    assert hedger.hedged == 0
@@ -0,0 +1,176 @@
+import base64
+import json
+import re
+
+import pytest
+from pytest_httpx import IteratorStream
+
+from fhir_proxy.app.bulkexport import NDJSONSecurityFilter, rewrite_manifest
+from fhir_proxy.app.config import HAPI_FHIR_URL
+from conftest import PROXY_ROOT
+
+NDJSON = "application/fhir+ndjson"
+
+
+def ndjson_line(resource_id, code=None):
+    resource = {"resourceType": "Patient", "id": resource_id}
+    if code:
+        resource["meta"] = {"security": [{"system": "gen3", "code": code}]}
+    return json.dumps(resource).encode() + b"\n"
+
+
+async def collect(chunks):
+    return b"".join([chunk async for chunk in chunks])
+
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.asyncio
+async def test_ndjson_filter_drops_disallowed_lines_across_chunks():
+    body = ndjson_line("a", "Patient") + ndjson_line("b", "Secret") + ndjson_line("c") + ndjson_line("d", "Patient")
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+    ndjson_filter = NDJSONSecurityFilter(["Patient"])
+
+    out = await collect(ndjson_filter.filter(aiter(chunks)))
+
+    assert [json.loads(line)["id"] for line in out.splitlines()] == ["a", "c", "d"]
+    assert (ndjson_filter.kept, ndjson_filter.dropped) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_ndjson_filter_decodes_escaped_keys():
+    line = b'{"resourceType":"Patient","meta":{"\\u0073ecurity":[{"code":"Secret"}]}}\n'
+    out = await collect(NDJSONSecurityFilter(["Patient"]).filter(aiter([line])))
+    assert out == b""
+
+
+@pytest.mark.asyncio
+async def test_ndjson_filter_limits_line_size():
+    ndjson_filter = NDJSONSecurityFilter(["Patient"], max_line_bytes=10)
+    with pytest.raises(ValueError):
+        await collect(ndjson_filter.filter(aiter([b"x" * 8, b"x" * 8])))
+
+
+def test_manifest_urls_point_at_proxy():
+    manifest = {
+        "request": f"{HAPI_FHIR_URL}/$export",
+        "requiresAccessToken": False,
+        "output": [{"type": "Patient", "url": f"{HAPI_FHIR_URL}/Binary/1"}],
+        "error": [],
+    }
+
+    rewritten = rewrite_manifest(manifest, HAPI_FHIR_URL, "https://proxy.example.org")
+
+    assert rewritten["output"][0]["url"] == "https://proxy.example.org/Binary/1"
+    assert rewritten["request"] == "https://proxy.example.org/$export"
+    assert rewritten["requiresAccessToken"] is True
+
+
+@pytest.mark.asyncio
+async def test_export_kickoff_is_passed_through(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(
+        method="GET",
+        url=f"{HAPI_FHIR_URL}/Patient/$export?_type=Patient",
+        status_code=202,
+        headers={"Content-Location": f"{HAPI_FHIR_URL}/$export-poll-status?_jobId=42"},
+    )
+
+    response = await client.get(
+        f"{PROXY_ROOT}/Patient/$export?_type=Patient",
+        headers={"Authorization": f"Bearer {test_token}", "Prefer": "respond-async"},
+    )
+
+    assert response.status_code == 202
+    assert response.headers["content-location"] == f"{PROXY_ROOT}/$export-poll-status?_jobId=42"
+    assert httpx_mock.get_requests()[-1].headers["prefer"] == "respond-async"
+
+
+@pytest.mark.asyncio
+async def test_export_status_manifest_is_rewritten(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(
+        method="GET",
+        url=f"{HAPI_FHIR_URL}/$export-poll-status?_jobId=42",
+        json={"output": [{"type": "Patient", "url": f"{HAPI_FHIR_URL}/Binary/7"}], "error": []},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/$export-poll-status?_jobId=42",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.json()["output"][0]["url"] == f"{PROXY_ROOT}/Binary/7"
+
+
+@pytest.mark.asyncio
+async def test_export_file_download_is_filtered(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    httpx_mock.add_response(
+        method="GET",
+        url=f"{HAPI_FHIR_URL}/Binary/7",
+        stream=IteratorStream([ndjson_line("a", "Patient"), ndjson_line("b", "Secret")]),
+        headers={"Content-Type": NDJSON},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/Binary/7",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept": NDJSON})
+
+    assert response.status_code == 200
+    assert [json.loads(line)["id"] for line in response.content.splitlines()] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_non_ndjson_download_is_refused(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Binary/8", content=b"%PDF",
+                            headers={"Content-Type": "application/pdf"})
+
+    response = await client.get(f"{PROXY_ROOT}/Binary/8",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept": NDJSON})
+
+    assert response.status_code == 406
+
+
+@pytest.mark.asyncio
+async def test_export_file_read_as_json_is_refused(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    data = base64.b64encode(ndjson_line("a", "Patient") + ndjson_line("b", "Secret")).decode()
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Binary/7(\?.*)?$"),
+                            json={"resourceType": "Binary", "id": "7", "contentType": NDJSON, "data": data})
+
+    response = await client.get(f"{PROXY_ROOT}/Binary/7",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept": "application/fhir+json"})
+
+    assert response.status_code == 406
+    assert data not in response.text
+
+
+@pytest.mark.asyncio
+async def test_export_file_vread_is_refused(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    data = base64.b64encode(ndjson_line("a", "Patient") + ndjson_line("b", "Secret")).decode()
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Binary/7/_history/1(\?.*)?$"),
+                            json={"resourceType": "Binary", "id": "7", "contentType": NDJSON, "data": data})
+
+    response = await client.get(f"{PROXY_ROOT}/Binary/7/_history/1",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept": "application/fhir+json"})
+
+    assert response.status_code == 406
+    assert data not in response.text
+
+
+@pytest.mark.asyncio
+async def test_export_file_is_dropped_from_search_results(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    data = base64.b64encode(ndjson_line("b", "Secret")).decode()
+    export = {"resourceType": "Binary", "id": "7", "contentType": NDJSON, "data": data,
+              "meta": {"security": [{"system": "gen3", "code": "Patient"}]}}
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Binary\?.*$"),
+                            json={"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": export}]})
+
+    response = await client.get(f"{PROXY_ROOT}/Binary?_id=7", headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    assert data not in response.text
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from fhir_proxy.app.bundlefilter import BundleScanner, BundleSecurityFilter
+from conftest import chunked
+
+
+async def run_filter(document, allowed, mode="drop", size=5):
+    body = json.dumps(document).encode()
+    bundle_filter = BundleSecurityFilter(allowed, mode=mode)
+    out = b"".join([chunk async for chunk in bundle_filter.filter(chunked(body, size))])
+    return json.loads(out)
+
+
+def entry(resource_id, code=None):
+    resource = {"resourceType": "Observation", "id": resource_id, "note": [{"text": "a \"quoted\" ] }"}]}
+    if code is not None:
+        resource["meta"] = {"security": [{"system": "gen3", "code": code}]}
+    return {"fullUrl": f"Observation/{resource_id}", "resource": resource}
+
+
+@pytest.mark.asyncio
+async def test_drops_entries_and_fixes_total():
+    bundle = {"resourceType": "Bundle", "total": 10, "link": [{"relation": "self", "url": "x"}],
+              "entry": [entry("1", "A"), entry("2", "B"), entry("3")]}
+
+    result = await run_filter(bundle, ["A"])
+
+    assert [e["resource"]["id"] for e in result["entry"]] == ["1", "3"]
+    assert result["total"] == 9
+    assert result["link"] == bundle["link"]
+
+
+@pytest.mark.asyncio
+async def test_redact_mode_keeps_stub():
+    bundle = {"resourceType": "Bundle", "total": 2, "entry": [entry("1", "A"), entry("2", "B")]}
+
+    result = await run_filter(bundle, ["A"], mode="redact")
+
+    assert result["total"] == 2
+    assert result["entry"][1]["resource"]["meta"]["security"][0]["code"] == "REDACTED"
+    assert "note" not in result["entry"][1]["resource"]
+
+
+@pytest.mark.asyncio
+async def test_all_entries_dropped_omits_entry_array():
+    result = await run_filter({"resourceType": "Bundle", "total": 1, "entry": [entry("1", "B")]}, [])
+    assert result == {"resourceType": "Bundle", "total": 0}
+
+
+@pytest.mark.asyncio
+async def test_non_object_body_passes_through():
+    bundle_filter = BundleSecurityFilter([])
+    out = b"".join([chunk async for chunk in bundle_filter.filter(chunked(b"[1, 2, 3]", 2))])
+    assert out == b"[1, 2, 3]"
+
+
+def test_scanner_holds_one_entry_at_a_time():
+    scanner = BundleScanner()
+    events = scanner.feed(b'{"resourceType": "Bundle", "entry": [{"a": 1}, {"b": ')
+    assert [event[0] for event in events] == ["member", "entry_start", "entry"]
+    assert len(scanner._buf) - scanner._pos < 10
+
+    events = scanner.feed(b'2}], "total": 12') + scanner.feed(b'3}')
+    assert [event[0] for event in events] == ["entry", "entry_end", "member", "end"]
+    assert events[2][3] == 123
@@ -0,0 +1,82 @@
+import httpx
+import pytest
+
+from fhir_proxy.app import clients
+from fhir_proxy.app.config import settings
+
+ADMIN = {"X-Proxy-Admin-Token": "admin-secret"}
+
+
+@pytest.mark.asyncio
+async def test_upstream_clients_are_reused(client, mock_gen3_httpx, mock_hapi_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    mock_hapi_httpx(path="/Patient/123")
+    mock_hapi_httpx(path="/Patient/123")
+
+    await client.get("/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+    hapi_client = clients.get_hapi_client()
+    await client.get("/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    assert clients.get_hapi_client() is hapi_client
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_endpoint(client, monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "admin-secret")
+    clients.get_hapi_client()
+    clients.get_gen3_client()
+    response = await client.get("http://localhost:8080/_proxy/pools", headers=ADMIN)
+    assert response.status_code == 200
+    stats = response.json()
+    assert set(stats) >= {"hapi", "gen3"}
+    assert stats["hapi"]["max_connections"] > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("endpoint", ["pools", "auth-cache", "jwks", "limits", "breakers"])
+async def test_stats_endpoints_need_the_admin_token(client, monkeypatch, endpoint):
+    assert (await client.get(f"http://localhost:8080/_proxy/{endpoint}", headers=ADMIN)).status_code == 403
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "admin-secret")
+    assert (await client.get(f"http://localhost:8080/_proxy/{endpoint}")).status_code == 403
+    assert (await client.get(f"http://localhost:8080/_proxy/{endpoint}", headers=ADMIN)).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_without_an_httpcore_pool():
+    await clients.close_clients()
+    clients.set_transport(clients.HAPI, httpx.MockTransport(lambda request: httpx.Response(200)))
+    try:
+        clients.get_hapi_client()
+        stats = clients.pool_stats()
+    finally:
+        await clients.close_clients()
+        clients.set_transport(clients.HAPI, None)
+
+    assert "connections" not in stats["hapi"]
+    assert stats["hapi"]["max_connections"] > 0
+
+
+@pytest.mark.asyncio
+async def test_custom_transport_routes_upstream_in_process(client, test_token):
+    async def gen3(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"resources": ["Patient"]}'})
+
+    async def hapi(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/fhir+json")]})
+        await send({"type": "http.response.body", "body": b'{"resourceType": "Patient", "id": "1"}'})
+
+    await clients.close_clients()
+    clients.set_transport(clients.GEN3, httpx.ASGITransport(app=gen3))
+    clients.set_transport(clients.HAPI, httpx.ASGITransport(app=hapi))
+    try:
+        response = await client.get("/Patient/1", headers={"Authorization": f"Bearer {test_token}"})
+    finally:
+        await clients.close_clients()
+        clients.set_transport(clients.GEN3, None)
+        clients.set_transport(clients.HAPI, None)
+
+    assert response.status_code == 200
+    assert response.json() == {"resourceType": "Patient", "id": "1"}
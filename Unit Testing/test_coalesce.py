@@ -0,0 +1,166 @@
+import asyncio
+import re
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from fhir_proxy.app.coalesce import RequestCoalescer, coalescer
+from fhir_proxy.app.config import HAPI_FHIR_URL
+from fhir_proxy.app.streaming import UpstreamResult
+from conftest import PROXY_ROOT
+
+PATIENT_SEARCH_URL = re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$")
+BUNDLE = {"resourceType": "Bundle", "type": "searchset", "total": 0}
+
+
+async def collect(result: UpstreamResult) -> bytes:
+    if result.stream is None:
+        return result.body
+    return b"".join([chunk async for chunk in result.stream])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_fetches_share_one_call():
+    coalescer = RequestCoalescer(max_replay_bytes=1024)
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return UpstreamResult(200, {}, body=b"shared")
+
+    results = await asyncio.gather(*(coalescer.run("key", fetch) for _ in range(5)))
+
+    assert calls == 1
+    assert [r.body for r in results] == [b"shared"] * 5
+    assert coalescer.stats()["followers"] == 4
+    assert len(coalescer) == 0
+
+
+@pytest.mark.asyncio
+async def test_streamed_body_is_broadcast_to_every_subscriber():
+    coalescer = RequestCoalescer(max_replay_bytes=1024)
+    release = asyncio.Event()
+
+    async def chunks():
+        yield b"one,"
+        await release.wait()
+        yield b"two"
+
+    async def fetch():
+        return UpstreamResult(200, {}, stream=chunks())
+
+    leader = await coalescer.run("key", fetch)
+    first = await leader.stream.__anext__()
+    # Joins after the first chunk went out and still sees the whole body.
+    follower = await coalescer.run("key", fetch)
+    release.set()
+
+    rest, follower_body = await asyncio.gather(collect(leader), collect(follower))
+    assert first + rest == follower_body == b"one,two"
+    assert coalescer.stats()["leaders"] == 1
+
+
+@pytest.mark.asyncio
+async def test_large_body_stops_taking_subscribers():
+    coalescer = RequestCoalescer(max_replay_bytes=4)
+
+    async def chunks():
+        yield b"12345"
+        yield b"678"
+
+    async def fetch():
+        return UpstreamResult(200, {}, stream=chunks())
+
+    leader = await coalescer.run("key", fetch)
+    assert await leader.stream.__anext__() == b"12345"
+    await asyncio.sleep(0)
+
+    assert len(coalescer) == 0
+    assert await collect(leader) == b"678"
+
+
+@pytest.mark.asyncio
+async def test_error_reaches_every_caller_and_is_not_cached():
+    coalescer = RequestCoalescer(max_replay_bytes=1024)
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=502, detail="upstream down")
+
+    results = await asyncio.gather(*(coalescer.run("key", fetch) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, HTTPException) and r.status_code == 502 for r in results)
+
+    with pytest.raises(HTTPException):
+        await coalescer.run("key", fetch)
+    assert calls == 2
+    assert coalescer.stats()["errors"] == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_fetch():
+    coalescer = RequestCoalescer(max_replay_bytes=1024)
+    started = asyncio.Event()
+
+    async def fetch():
+        started.set()
+        await asyncio.sleep(0.02)
+        return UpstreamResult(200, {}, body=b"done")
+
+    leader = asyncio.create_task(coalescer.run("key", fetch))
+    await started.wait()
+    follower = asyncio.create_task(coalescer.run("key", fetch))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert (await follower).body == b"done"
+    assert leader.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_fetch_cancelled_once_every_caller_is_gone():
+    coalescer = RequestCoalescer(max_replay_bytes=1024)
+    cancelled = asyncio.Event()
+
+    async def fetch():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    callers = [asyncio.create_task(coalescer.run("key", fetch)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    for caller in callers:
+        caller.cancel()
+
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+    await asyncio.sleep(0)
+    assert len(coalescer) == 0
+    assert coalescer.stats()["cancelled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_identical_searches_share_one_upstream_request(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+
+    async def slow_search(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json=BUNDLE, headers={"content-type": "application/fhir+json"})
+
+    httpx_mock.add_callback(slow_search, method="GET", url=PATIENT_SEARCH_URL)
+
+    headers = {"Authorization": f"Bearer {test_token}"}
+    responses = await asyncio.gather(
+        *(client.get(f"{PROXY_ROOT}/Patient?name=smith", headers=headers) for _ in range(3))
+    )
+
+    assert [r.status_code for r in responses] == [200] * 3
+    assert all(r.json() == BUNDLE for r in responses)
+    assert len(httpx_mock.get_requests(url=PATIENT_SEARCH_URL)) == 1
+    assert coalescer.stats()["followers"] == 2
@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from fhir_proxy.app.codec import CODECS, get_codec
+
+BUNDLE = {"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Patient", "id": "1",
+                                                           "name": [{"family": "Müller"}]}}]}
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_codecs_round_trip(name):
+    codec = CODECS[name]
+    encoded = codec.dumps(BUNDLE)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == BUNDLE
+    assert json.loads(encoded) == BUNDLE
+
+
+def test_unknown_codec_falls_back_to_stdlib():
+    assert get_codec("does-not-exist").name == "json"
+
@@ -0,0 +1,106 @@
+import gzip
+import json
+import re
+
+import pytest
+from pytest_httpx import IteratorStream
+
+from fhir_proxy.app.compression import StreamCompressor, StreamDecompressor, negotiate, supported_encodings
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.metrics import WIRE_BYTES
+from conftest import PROXY_ROOT
+
+SEARCH = re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$")
+
+
+def patients(count):
+    return {"resourceType": "Bundle", "type": "searchset",
+            "entry": [{"resource": {"resourceType": "Patient", "id": str(i), "name": [{"family": "Smith"}]}}
+                      for i in range(count)]}
+
+
+def test_negotiation_follows_q_values_and_preference():
+    assert negotiate("gzip;q=0.5, deflate") == "gzip"
+    assert negotiate("gzip;q=0, deflate") is None
+    assert negotiate("identity") is None
+    assert negotiate("*") == ("br" if "br" in supported_encodings() else "gzip")
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_each_streamed_chunk_can_be_decoded_on_arrival(encoding):
+    compressor = StreamCompressor(encoding)
+    decompressor = StreamDecompressor(encoding)
+    lines = [json.dumps({"resourceType": "Patient", "id": str(i)}).encode() + b"\n" for i in range(3)]
+
+    received = [decompressor.decompress(compressor.compress(line, flush=True)) for line in lines]
+
+    assert received == lines
+
+
+@pytest.mark.asyncio
+async def test_large_bundle_is_compressed_for_the_client(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    body = json.dumps(patients(200)).encode()
+    httpx_mock.add_response(method="GET", url=SEARCH, headers={"Content-Type": "application/fhir+json"},
+                            stream=IteratorStream([body[i:i + 4096] for i in range(0, len(body), 4096)]))
+
+    response = await client.get(f"{PROXY_ROOT}/Patient",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert len(response.json()["entry"]) == 200
+    assert 0 < WIRE_BYTES.value("client", "gzip") < len(body) / 4
+    # HAPI is asked for gzip whatever the client accepts.
+    assert httpx_mock.get_requests()[-1].headers["accept-encoding"] == settings.UPSTREAM_ACCEPT_ENCODING
+
+
+@pytest.mark.asyncio
+async def test_small_response_is_not_compressed(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    httpx_mock.add_response(method="GET", url=SEARCH, json=patients(1))
+
+    response = await client.get(f"{PROXY_ROOT}/Patient",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert "accept-encoding" in response.headers["vary"].lower()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("accept_encoding, wire_encoding", [("gzip", "gzip"), ("identity", "identity")])
+async def test_uninspected_body_passes_through_encoded(client, httpx_mock, mock_gen3_httpx, test_token, monkeypatch,
+                                                       accept_encoding, wire_encoding):
+    monkeypatch.setattr(settings, "BUNDLE_SECURITY_FILTER", False)
+    monkeypatch.setattr(settings, "REWRITE_BUNDLE_LINKS", False)
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    body = json.dumps(patients(200)).encode()
+    encoded = gzip.compress(body)
+    httpx_mock.add_response(method="GET", url=SEARCH, content=encoded,
+                            headers={"Content-Type": "application/fhir+json", "Content-Encoding": "gzip"})
+
+    response = await client.get(f"{PROXY_ROOT}/Patient",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept-Encoding": accept_encoding})
+
+    assert response.status_code == 200
+    assert response.headers.get("content-encoding", "identity") == wire_encoding
+    # Passed through or decoded, the body depends on Accept-Encoding.
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert response.content == body
+    assert WIRE_BYTES.value("upstream", "gzip") == len(encoded)
+    expected = len(encoded) if wire_encoding == "gzip" else len(body)
+    assert WIRE_BYTES.value("client", wire_encoding) == expected
+
+
+@pytest.mark.asyncio
+async def test_re_encoded_body_has_a_weak_etag(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    httpx_mock.add_response(method="GET", url=SEARCH, json=patients(200), headers={"ETag": '"7"'})
+
+    response = await client.get(f"{PROXY_ROOT}/Patient",
+                                headers={"Authorization": f"Bearer {test_token}", "Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == 'W/"7"'
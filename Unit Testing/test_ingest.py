@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from fhir_proxy.app.codec import loads
+from fhir_proxy.app.ingest import Ingestor, Spool, dependency_levels, main, security_tags, spool_files
+
+FHIR_URL = "http://hapi.test/fhir"
+
+
+def write_synthea_bundle(path, patient_id="p1"):
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {"fullUrl": f"urn:uuid:{patient_id}", "resource": {"resourceType": "Patient", "id": patient_id}},
+            {
+                "fullUrl": "urn:uuid:e1",
+                "resource": {
+                    "resourceType": "Encounter",
+                    "id": "e1",
+                    "subject": {"reference": f"urn:uuid:{patient_id}"},
+                },
+            },
+        ],
+    }
+    path.write_text(json.dumps(bundle))
+
+
+def test_dependency_levels_follow_ingestion_order():
+    levels = dependency_levels(["CarePlan", "Encounter", "Organization", "Patient", "Practitioner", "Procedure"])
+
+    assert levels == [["Organization", "Practitioner"], ["Patient"], ["Encounter"], ["CarePlan"], ["Procedure"]]
+
+
+def test_spool_tags_resources_and_resolves_references(tmp_path):
+    write_synthea_bundle(tmp_path / "patient.json")
+    spool = Spool(str(tmp_path))
+
+    count = spool_files([str(tmp_path / "patient.json")], spool, security_tags(["/programs/synthea"]))
+
+    assert count == 2
+    encounter = next(spool.read("Encounter"))
+    assert encounter["subject"] == {"reference": "Patient/p1"}
+    assert encounter["meta"]["security"] == [{"system": "gen3", "code": "/programs/synthea"}]
+
+
+@pytest.mark.asyncio
+async def test_types_uploaded_in_dependency_order(tmp_path, httpx_mock):
+    uploaded = []
+
+    def transaction(request):
+        bundle = loads(request.content)
+        uploaded.append([entry["request"]["url"] for entry in bundle["entry"]])
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "transaction-response"})
+
+    httpx_mock.add_callback(transaction, method="POST", url=FHIR_URL, is_reusable=True)
+    write_synthea_bundle(tmp_path / "a.json", "p1")
+    write_synthea_bundle(tmp_path / "b.json", "p2")
+    spool = Spool(str(tmp_path))
+    spool_files([str(tmp_path / "a.json"), str(tmp_path / "b.json")], spool, [])
+
+    async with httpx.AsyncClient() as client:
+        ingestor = Ingestor(client, FHIR_URL, bundle_size=2, workers=2)
+        await ingestor.run(spool)
+
+    assert uploaded == [["Patient/p1", "Patient/p2"], ["Encounter/e1", "Encounter/e1"]]
+    assert ingestor.total_uploaded == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_entries_are_retried(httpx_mock):
+    httpx_mock.add_response(method="POST", url=FHIR_URL, json={"resourceType": "Bundle", "entry": [
+        {"response": {"status": "201 Created"}},
+        {"response": {"status": "429 Too Many Requests"}},
+        {"response": {"status": "422 Unprocessable Entity"}},
+    ]})
+    httpx_mock.add_response(method="POST", url=FHIR_URL, json={"resourceType": "Bundle", "entry": [
+        {"response": {"status": "200 OK"}},
+    ]})
+    entries = [{"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(3)]
+
+    async with httpx.AsyncClient() as client:
+        ingestor = Ingestor(client, FHIR_URL, bundle_type="batch", backoff=0)
+        await ingestor.upload_chunk("Patient", entries)
+
+    assert ingestor.uploaded["Patient"] == 2
+    assert ingestor.retried == 1
+    assert [entry["resource"]["id"] for entry, _ in ingestor.failures["Patient"]] == ["2"]
+    sent = loads(httpx_mock.get_requests()[-1].content)
+    assert [entry["resource"]["id"] for entry in sent["entry"]] == ["1"]
+
+
+@pytest.mark.asyncio
+async def test_failed_transaction_is_split_to_isolate_bad_entries(httpx_mock):
+    def transaction(request):
+        ids = [entry["resource"]["id"] for entry in loads(request.content)["entry"]]
+        if "bad" in ids:
+            return httpx.Response(400, json={"resourceType": "OperationOutcome"})
+        return httpx.Response(200, json={"resourceType": "Bundle"})
+
+    httpx_mock.add_callback(transaction, method="POST", url=FHIR_URL, is_reusable=True)
+    entries = [{"resource": {"resourceType": "Patient", "id": i}} for i in ("a", "b", "bad", "c")]
+
+    async with httpx.AsyncClient() as client:
+        ingestor = Ingestor(client, FHIR_URL, backoff=0)
+        await ingestor.upload_chunk("Patient", entries)
+
+    assert ingestor.uploaded["Patient"] == 3
+    assert [entry["resource"]["id"] for entry, _ in ingestor.failures["Patient"]] == ["bad"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content", [b"<html>Bad gateway</html>", b"[]"])
+async def test_malformed_batch_response_fails_entries_without_hanging(httpx_mock, content):
+    httpx_mock.add_response(method="POST", url=FHIR_URL, content=content, is_reusable=True)
+    resources = [{"resourceType": "Patient", "id": str(i)} for i in range(10)]
+
+    async with httpx.AsyncClient() as client:
+        ingestor = Ingestor(client, FHIR_URL, bundle_type="batch", bundle_size=1, workers=1, backoff=0)
+        await asyncio.wait_for(ingestor.upload_level({"Patient": iter(resources)}), timeout=5)
+
+    assert ingestor.total_uploaded == 0
+    assert ingestor.total_failed == 10
+
+
+def test_command_reports_failures_in_exit_code(tmp_path, httpx_mock):
+    httpx_mock.add_response(method="POST", url=FHIR_URL, json={"resourceType": "Bundle"})
+    (tmp_path / "Patient-1.json").write_text(json.dumps({"resourceType": "Patient", "id": "1"}))
+
+    assert main([str(tmp_path), "--url", FHIR_URL, "--security-code", "/programs/ncpi"]) == 0
+    sent = loads(httpx_mock.get_requests()[0].content)
+    assert sent["entry"][0]["resource"]["meta"]["security"][0]["code"] == "/programs/ncpi"
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+import rsa
+from jose import jwk, jwt
+
+from fhir_proxy.app.auth import jwks_validator
+from fhir_proxy.app.config import settings
+
+JWKS_URL = "https://qa.planx-pla.net/user/.well-known/jwks"
+
+
+@pytest.fixture(scope="module")
+def signing_keys():
+    public_key, private_key = rsa.newkeys(1024)
+    public_jwk = jwk.construct(public_key.save_pkcs1().decode(), "RS256").to_dict()
+    public_jwk["kid"] = "key-1"
+    return private_key.save_pkcs1().decode(), public_jwk
+
+
+@pytest.fixture
+def local_validation(monkeypatch, httpx_mock, signing_keys):
+    monkeypatch.setattr(settings, "JWKS_URL", JWKS_URL)
+    httpx_mock.add_response(method="GET", url=JWKS_URL, json={"keys": [signing_keys[1]]})
+    return signing_keys[0]
+
+
+def sign(private_key, exp_offset=60, kid="key-1"):
+    return jwt.encode({"sub": "user", "exp": time.time() + exp_offset}, private_key,
+                      algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.mark.asyncio
+async def test_valid_token_is_accepted_locally(client, local_validation, mock_gen3_httpx, mock_hapi_httpx):
+    token = sign(local_validation)
+    mock_gen3_httpx(token=token)
+    mock_hapi_httpx(path="/Patient/123")
+    response = await client.get("/Patient/123", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert jwks_validator.stats()["accepted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_token_rejected_before_upstream(client, local_validation):
+    token = sign(local_validation, exp_offset=-60)
+    response = await client.get("/Patient/123", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    assert jwks_validator.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_malformed_token_rejected_before_upstream(client, monkeypatch):
+    monkeypatch.setattr(settings, "JWKS_URL", JWKS_URL)
+    response = await client.get("/Patient/123", headers={"Authorization": "Bearer not-a-jwt"})
+    assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid_triggers_single_refresh(local_validation, httpx_mock, signing_keys):
+    assert await jwks_validator.validate(sign(local_validation))
+    httpx_mock.add_response(method="GET", url=JWKS_URL, json={"keys": [signing_keys[1]]})
+    jwks_validator._fetched_at = 0.0
+
+    assert not await jwks_validator.validate(sign(local_validation, kid="rotated"))
+    assert jwks_validator.stats()["refreshes"] == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("payload", [[], {"keys": {"kid": "key-1"}}, {"keys": ["key-1"]}])
+async def test_malformed_jwks_keeps_previous_keys(local_validation, httpx_mock, signing_keys, payload):
+    await jwks_validator.refresh()
+    httpx_mock.add_response(method="GET", url=JWKS_URL, json=payload)
+
+    await jwks_validator.refresh()
+
+    assert jwks_validator.stats()["keys"] == 1
+    assert jwks_validator.stats()["refresh_failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unreachable_jwks_is_not_refetched_for_every_token(monkeypatch, httpx_mock, signing_keys):
+    monkeypatch.setattr(settings, "JWKS_URL", JWKS_URL)
+    httpx_mock.add_response(method="GET", url=JWKS_URL, status_code=503)
+
+    for _ in range(5):
+        await jwks_validator.validate(sign(signing_keys[0], kid="unknown"))
+
+    assert len(httpx_mock.get_requests(url=JWKS_URL)) == 1
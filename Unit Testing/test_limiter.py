@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from fhir_proxy.app.limiter import (
+    PRIORITY_PREFETCH,
+    PRIORITY_READ,
+    PRIORITY_SEARCH,
+    AdaptiveLimiter,
+    Overloaded,
+    hapi_limiter,
+)
+from conftest import PROXY_ROOT
+
+
+def make_limiter(**kwargs):
+    options = dict(initial_limit=2, min_limit=1, max_limit=10, queue_size=10, queue_timeout=1.0)
+    options.update(kwargs)
+    return AdaptiveLimiter("test", **options)
+
+
+async def hold(limiter, priority, release, order, name):
+    async with limiter.slot(priority):
+        order.append(name)
+        await release.wait()
+
+
+@pytest.mark.asyncio
+async def test_requests_over_the_limit_wait_in_priority_order():
+    limiter = make_limiter(initial_limit=1)
+    release = asyncio.Event()
+    order = []
+
+    first = asyncio.create_task(hold(limiter, PRIORITY_SEARCH, release, order, "first"))
+    await asyncio.sleep(0)
+    waiting = [
+        asyncio.create_task(hold(limiter, PRIORITY_SEARCH, release, order, "search")),
+        asyncio.create_task(hold(limiter, PRIORITY_PREFETCH, release, order, "prefetch")),
+        asyncio.create_task(hold(limiter, PRIORITY_READ, release, order, "read")),
+    ]
+    await asyncio.sleep(0)
+    assert (limiter.in_flight, limiter.queued) == (1, 3)
+
+    release.set()
+    await asyncio.gather(first, *waiting)
+
+    assert order == ["first", "read", "search", "prefetch"]
+    assert (limiter.in_flight, limiter.queued) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_full_queue_sheds_lowest_priority_waiter():
+    limiter = make_limiter(initial_limit=1, queue_size=1)
+    release = asyncio.Event()
+    order = []
+
+    first = asyncio.create_task(hold(limiter, PRIORITY_SEARCH, release, order, "first"))
+    await asyncio.sleep(0)
+    prefetch = asyncio.create_task(hold(limiter, PRIORITY_PREFETCH, release, order, "prefetch"))
+    await asyncio.sleep(0)
+    read = asyncio.create_task(hold(limiter, PRIORITY_READ, release, order, "read"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(Overloaded) as shed:
+        await prefetch
+    assert shed.value.retry_after >= 1
+    with pytest.raises(Overloaded):
+        await limiter.acquire(PRIORITY_SEARCH)
+
+    release.set()
+    await asyncio.gather(first, read)
+    assert order == ["first", "read"]
+    assert limiter.stats()["shed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout_raises_overloaded():
+    limiter = make_limiter(initial_limit=1, queue_timeout=0.01)
+    permit = await limiter.acquire(PRIORITY_READ)
+
+    with pytest.raises(Overloaded):
+        await limiter.acquire(PRIORITY_READ)
+
+    permit.release()
+    assert (limiter.in_flight, limiter.queued, limiter.timeouts) == (0, 0, 1)
+
+
+def test_limit_decreases_on_latency_and_overload():
+    limiter = make_limiter(initial_limit=10)
+    limiter.in_flight = 1
+    limiter._release(0.01, False)
+    limiter.in_flight = 1
+    limiter._release(0.05, False)
+    assert limiter.limit == pytest.approx(9.0)
+
+    limiter._last_decrease = 0.0
+    limiter.in_flight = 1
+    limiter._release(0.01, True)
+    assert limiter.limit == pytest.approx(8.1)
+    assert limiter.decreases == 2
+
+
+def test_limit_grows_only_while_in_use():
+    limiter = make_limiter(initial_limit=4)
+    limiter.in_flight = 1
+    limiter._release(0.01, False)
+    assert limiter.limit == 4
+
+    for _ in range(8):
+        limiter.in_flight = 4
+        limiter._release(0.01, False)
+    assert 5.5 < limiter.limit < 6
+
+
+@pytest.mark.asyncio
+async def test_overloaded_upstream_returns_503(client, mock_gen3_httpx, test_token, monkeypatch):
+    mock_gen3_httpx(token=test_token)
+    monkeypatch.setattr(hapi_limiter, "limit", 0.0)
+    monkeypatch.setattr(hapi_limiter, "queue_size", 0)
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert hapi_limiter.stats()["shed"] == 1
@@ -0,0 +1,78 @@
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.metrics import Histogram, STAGE_DURATION, UPSTREAM_RESPONSES
+from conftest import PROXY_ROOT
+
+PATIENT = {"resourceType": "Patient", "id": "123", "meta": {"security": [{"code": "Patient"}]}}
+
+
+@pytest.fixture
+def mock_patient_read(httpx_mock):
+    def _mock():
+        httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient/123?_security=gen3%7CObservation%2Cgen3%7CPatient",
+                                json=PATIENT)
+    return _mock
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_is_not_proxied(client):
+    response = await client.get(f"{PROXY_ROOT}/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE fhir_proxy_request_duration_seconds histogram" in response.text
+
+
+@pytest.mark.asyncio
+async def test_direct_read_records_stages_and_upstream_status(client, mock_gen3_httpx, mock_patient_read, test_token):
+    mock_gen3_httpx(token=test_token)
+    mock_patient_read()
+
+    await client.get(f"{PROXY_ROOT}/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    for name in ("auth", "gen3", "rewrite", "upstream", "read", "decode", "security", "encode"):
+        assert STAGE_DURATION.count(name) == 1, name
+    assert UPSTREAM_RESPONSES.value("hapi", "200") == 1
+    assert UPSTREAM_RESPONSES.value("gen3", "200") == 1
+
+    text = (await client.get(f"{PROXY_ROOT}/metrics")).text
+    assert 'fhir_proxy_request_duration_seconds_count{method="GET",status="200"} 1' in text
+    assert 'fhir_proxy_payload_bytes_count{direction="response"} 1' in text
+    assert "fhir_proxy_auth_cache_misses 1" in text
+
+
+@pytest.mark.asyncio
+async def test_server_timing_header(client, mock_gen3_httpx, mock_patient_read, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_TIMING", True)
+    mock_gen3_httpx(token=test_token)
+    mock_patient_read()
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    timing = response.headers["server-timing"]
+    assert "gen3;dur=" in timing
+    assert "upstream;dur=" in timing
+
+
+@pytest.mark.asyncio
+async def test_no_server_timing_by_default(client, mock_gen3_httpx, mock_patient_read, test_token):
+    mock_gen3_httpx(token=test_token)
+    mock_patient_read()
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/123", headers={"Authorization": f"Bearer {test_token}"})
+
+    assert "server-timing" not in response.headers
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'a"b')
+    histogram.observe(0.5, 'a"b')
+    histogram.observe(5.0, 'a"b')
+
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="a\\"b",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="a\\"b",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="a\\"b",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="a\\"b"} 3' in lines
@@ -0,0 +1,59 @@
+import asyncio
+import re
+
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.paging import prefetch_cache, strip_fragment
+from conftest import FRAGMENT, PROXY_ROOT
+
+SEARCH_URL = re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$")
+PAGE_URL = re.compile(rf"{re.escape(HAPI_FHIR_URL)}/\?_getpages=abc.*$")
+
+
+def page(resource_id, next_offset=None):
+    links = [{"relation": "self", "url": f"{HAPI_FHIR_URL}/Patient?name=x&{FRAGMENT}"}]
+    if next_offset is not None:
+        links.append({"relation": "next",
+                      "url": f"{HAPI_FHIR_URL}?_getpages=abc&_getpagesoffset={next_offset}&_count=1"})
+    return {"resourceType": "Bundle", "type": "searchset", "link": links,
+            "entry": [{"resource": {"resourceType": "Patient", "id": resource_id}}]}
+
+
+def test_strip_fragment_removes_only_the_scope_parameter():
+    assert strip_fragment(f"http://h/Patient?name=x&{FRAGMENT}&_count=5", FRAGMENT) == "http://h/Patient?name=x&_count=5"
+    assert strip_fragment(f"http://h/Patient?{FRAGMENT}", FRAGMENT) == "http://h/Patient"
+    assert strip_fragment("http://h/Patient?_security=other", FRAGMENT) == "http://h/Patient?_security=other"
+
+
+@pytest.mark.asyncio
+async def test_bundle_links_point_at_proxy_without_security(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=SEARCH_URL, json=page("1", next_offset=1),
+                            headers={"Content-Type": "application/fhir+json"})
+
+    response = await client.get(f"{PROXY_ROOT}/Patient?name=x", headers={"Authorization": f"Bearer {test_token}"})
+
+    links = {link["relation"]: link["url"] for link in response.json()["link"]}
+    assert links["self"] == f"{PROXY_ROOT}/Patient?name=x"
+    assert links["next"] == f"{PROXY_ROOT}?_getpages=abc&_getpagesoffset=1&_count=1"
+
+
+@pytest.mark.asyncio
+async def test_next_page_is_prefetched(client, httpx_mock, mock_gen3_httpx, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "PREFETCH_NEXT_PAGE", True)
+    mock_gen3_httpx(token=test_token)
+    headers = {"Content-Type": "application/fhir+json"}
+    httpx_mock.add_response(method="GET", url=SEARCH_URL, json=page("1", next_offset=1), headers=headers)
+    httpx_mock.add_response(method="GET", url=PAGE_URL, json=page("2"), headers=headers)
+
+    auth = {"Authorization": f"Bearer {test_token}"}
+    first = await client.get(f"{PROXY_ROOT}/Patient?name=x", headers=auth)
+    next_url = next(link["url"] for link in first.json()["link"] if link["relation"] == "next")
+    await asyncio.sleep(0.01)
+    second = await client.get(next_url, headers=auth)
+
+    assert second.status_code == 200
+    assert second.json()["entry"][0]["resource"]["id"] == "2"
+    assert prefetch_cache.stats()["hits"] == 1
+    assert len(httpx_mock.get_requests(url=PAGE_URL)) == 1
@@ -0,0 +1,55 @@
+import marshal
+import re
+
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.profiling import profiler
+from conftest import PROXY_ROOT
+
+ADMIN = {"X-Proxy-Admin-Token": "admin-secret"}
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "admin-secret")
+
+
+@pytest.mark.asyncio
+async def test_profiling_needs_the_admin_token(client, monkeypatch):
+    assert (await client.get(f"{PROXY_ROOT}/_proxy/profiling", headers=ADMIN)).status_code == 403
+
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "admin-secret")
+    assert (await client.post(f"{PROXY_ROOT}/_proxy/profiling",
+                              headers={"X-Proxy-Admin-Token": "wrong"})).status_code == 403
+    assert not profiler.active
+
+
+@pytest.mark.asyncio
+async def test_sampled_requests_are_profiled_per_resource_type(client, httpx_mock, mock_gen3_httpx, test_token,
+                                                               admin_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/(Patient|Observation)\?.*$"),
+                            json={"resourceType": "Bundle", "type": "searchset", "entry": []}, is_reusable=True)
+
+    started = await client.post(f"{PROXY_ROOT}/_proxy/profiling",
+                                params={"sample_rate": 1, "memory": "true", "resource_type": "Patient"}, headers=ADMIN)
+    assert started.json()["active"]
+
+    for resource_type in ("Patient", "Patient", "Observation"):
+        await client.get(f"{PROXY_ROOT}/{resource_type}", headers={"Authorization": f"Bearer {test_token}"})
+
+    status = (await client.get(f"{PROXY_ROOT}/_proxy/profiling", headers=ADMIN)).json()
+    assert status["profiled"] == {"Patient": 2}
+
+    download = await client.get(f"{PROXY_ROOT}/_proxy/profiling/cpu", params={"resource_type": "Patient"},
+                                headers=ADMIN)
+    assert download.status_code == 200
+    assert any(name == "proxy_fhir" for (_, _, name) in marshal.loads(download.content))
+
+    memory = (await client.get(f"{PROXY_ROOT}/_proxy/profiling/memory", headers=ADMIN)).json()
+    assert "Patient" in memory["peak_bytes"]
+
+    await client.delete(f"{PROXY_ROOT}/_proxy/profiling", params={"clear": "true"}, headers=ADMIN)
+    assert not profiler.active
+    assert (await client.get(f"{PROXY_ROOT}/_proxy/profiling/cpu", headers=ADMIN)).status_code == 404
@@ -4,9 +4,9 @@ import logging
 import re
 import os
 from dotenv import load_dotenv
+from fhir_proxy.app.config import GEN_USER_URL
 
 load_dotenv(".env.test", override=True)
-GEN_USER_URL = os.getenv("GEN_USER_URL")
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,100 @@
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL
+from fhir_proxy.app.references import (
+    collect_references,
+    include_searches,
+    revinclude_searches,
+    split_include_params,
+)
+from conftest import FRAGMENT, PROXY_ROOT, tagged
+
+
+def searchset(*resources):
+    return {"resourceType": "Bundle", "type": "searchset",
+            "entry": [{"resource": r, "search": {"mode": "match"}} for r in resources]}
+
+
+def test_include_params_are_taken_out_of_the_query():
+    query, includes, revincludes = split_include_params(
+        "code=x&_proxy_include=subject,performer&_count=5&_proxy_revinclude=Observation%3Asubject")
+
+    assert query == "code=x&_count=5"
+    assert includes == ["subject", "performer"]
+    assert revincludes == [("Observation", "subject")]
+    assert split_include_params("code=x") == ("code=x", [], [])
+
+
+@pytest.mark.parametrize("source", ["..", "Observation%2F..%2Fmetadata", "%24export", ""])
+def test_revinclude_source_must_be_a_resource_type(source):
+    with pytest.raises(ValueError):
+        split_include_params(f"_proxy_revinclude={source}%3Asubject")
+
+
+def test_references_are_deduplicated_and_batched():
+    bundle = searchset(
+        {"resourceType": "Observation", "id": "o1", "subject": {"reference": "Patient/p1"}},
+        {"resourceType": "Observation", "id": "o2", "subject": {"reference": f"{HAPI_FHIR_URL}/Patient/p2"}},
+        {"resourceType": "Observation", "id": "o3", "subject": {"reference": "Patient/p1/_history/2"}},
+        {"resourceType": "Observation", "id": "o4", "subject": {"reference": "https://elsewhere.org/Patient/p9"}},
+        {"resourceType": "Observation", "id": "o5", "performer": [{"reference": "Practitioner/d1"}]},
+    )
+
+    wanted = collect_references(bundle, ["subject"], (HAPI_FHIR_URL,), limit=100)
+    assert wanted == {"Patient": ["p1", "p2"]}
+    assert collect_references(bundle, ["*"], (HAPI_FHIR_URL,), limit=100) == {
+        "Patient": ["p1", "p2"], "Practitioner": ["d1"]}
+    assert include_searches({"Patient": ["a", "b", "c"]}, batch_size=2) == [
+        ("Patient", "_id=a,b&_count=2"), ("Patient", "_id=c&_count=1")]
+    assert revinclude_searches({"Patient": ["Patient/a"]}, [("Observation", "subject")], 10, 50) == [
+        ("Observation", "subject=Patient/a&_count=50")]
+
+
+@pytest.mark.asyncio
+async def test_search_includes_referenced_resources(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Observation?code=x&{FRAGMENT}", json=searchset(
+        tagged("Observation", "o1", "Observation", subject={"reference": "Patient/p1"}),
+        tagged("Observation", "o2", "Observation", subject={"reference": "Patient/p2"}),
+        tagged("Observation", "o3", "Observation", subject={"reference": "Patient/p1"}),
+    ))
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient?_id=p1,p2&_count=2&{FRAGMENT}",
+                            json=searchset(tagged("Patient", "p1", "Patient"), tagged("Patient", "p2", "Secret")))
+
+    response = await client.get(f"{PROXY_ROOT}/Observation?code=x&_proxy_include=subject",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    entries = response.json()["entry"]
+    included = [e for e in entries if e["search"]["mode"] == "include"]
+    assert [e["resource"]["id"] for e in included] == ["p1"]
+    assert included[0]["fullUrl"] == f"{PROXY_ROOT}/Patient/p1"
+    # One search for both patients.
+    assert len([r for r in httpx_mock.get_requests() if r.url.path.endswith("/Patient")]) == 1
+
+
+@pytest.mark.asyncio
+async def test_search_revincludes_referring_resources(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Patient?name=x&{FRAGMENT}",
+                            json=searchset(tagged("Patient", "p1", "Patient")))
+    httpx_mock.add_response(method="GET", url=f"{HAPI_FHIR_URL}/Observation?subject=Patient/p1&_count=1000&{FRAGMENT}",
+                            json=searchset(tagged("Observation", "o1", "Observation", subject={"reference": "Patient/p1"})))
+
+    response = await client.get(f"{PROXY_ROOT}/Patient?name=x&_proxy_revinclude=Observation:subject",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    entries = response.json()["entry"]
+    assert [(e["resource"]["id"], e["search"]["mode"]) for e in entries] == [("p1", "match"), ("o1", "include")]
+
+
+@pytest.mark.asyncio
+async def test_invalid_revinclude_source_is_refused(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+
+    response = await client.get(f"{PROXY_ROOT}/Patient?_proxy_revinclude=..%2Fmetadata%3Asubject",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 400
+    assert not any(HAPI_FHIR_URL in str(request.url) for request in httpx_mock.get_requests())
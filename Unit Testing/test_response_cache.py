@@ -0,0 +1,131 @@
+import re
+import time
+
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.responsecache import CachedResponse, ResponseCache, response_cache
+from conftest import PROXY_ROOT
+
+VALUESET_URL = re.compile(rf"{re.escape(HAPI_FHIR_URL)}/ValueSet\?.*$")
+VALUESET = {"resourceType": "Bundle", "type": "searchset", "total": 0}
+
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", True)
+
+
+async def get_valuesets(client, token):
+    return await client.get(f"{PROXY_ROOT}/ValueSet?url=x", headers={"Authorization": f"Bearer {token}"})
+
+
+@pytest.mark.asyncio
+async def test_repeated_get_served_from_cache(client, httpx_mock, mock_gen3_httpx, test_token, cache_enabled):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=VALUESET)
+
+    first = await get_valuesets(client, test_token)
+    second = await get_valuesets(client, test_token)
+
+    assert first.json() == second.json() == VALUESET
+    assert second.headers["x-proxy-cache"] == "HIT"
+    assert response_cache.stats()["hits"] == 1
+    assert response_cache.stats()["bytes_saved"] == len(second.content)
+
+
+@pytest.mark.asyncio
+async def test_stale_entry_revalidated_with_etag(client, httpx_mock, mock_gen3_httpx, test_token,
+                                                 cache_enabled, monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 0)
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=VALUESET, headers={"ETag": 'W/"3"'})
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, status_code=304)
+
+    await get_valuesets(client, test_token)
+    second = await get_valuesets(client, test_token)
+
+    assert second.status_code == 200
+    assert second.json() == VALUESET
+    assert second.headers["x-proxy-cache"] == "REVALIDATED"
+    assert httpx_mock.get_requests()[-1].headers["if-none-match"] == 'W/"3"'
+
+
+@pytest.mark.asyncio
+async def test_client_revalidation_of_a_direct_read_is_passed_through(client, httpx_mock, mock_gen3_httpx,
+                                                                      test_token):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient/1(\?.*)?$"),
+                            status_code=304, headers={"ETag": 'W/"3"'})
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/1",
+                                headers={"Authorization": f"Bearer {test_token}", "If-None-Match": 'W/"3"'})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == 'W/"3"'
+    assert httpx_mock.get_requests()[-1].headers["if-none-match"] == 'W/"3"'
+
+
+@pytest.mark.asyncio
+async def test_write_invalidates_resource_type(client, httpx_mock, mock_gen3_httpx, test_token, cache_enabled):
+    mock_gen3_httpx(token=test_token)
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=VALUESET)
+    httpx_mock.add_response(method="PUT", url=f"{HAPI_FHIR_URL}/ValueSet/1?_security=gen3%7CObservation%2Cgen3%7CPatient",
+                            json={"resourceType": "ValueSet", "id": "1"})
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=VALUESET)
+
+    await get_valuesets(client, test_token)
+    await client.put(f"{PROXY_ROOT}/ValueSet/1", json={"resourceType": "ValueSet", "id": "1"},
+                     headers={"Authorization": f"Bearer {test_token}"})
+    third = await get_valuesets(client, test_token)
+
+    assert "x-proxy-cache" not in third.headers
+    assert response_cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_survives_memory_eviction(tmp_path):
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=1000, disk_dir=str(tmp_path))
+    entry = CachedResponse("CodeSystem", 200, {"content-type": "application/fhir+json"}, b'{"id": "big"}', time.time())
+
+    await cache.put("key", entry)
+    assert len(cache) == 0
+
+    restored = await cache.get("key")
+    assert restored.body == entry.body
+    assert restored.headers == entry.headers
+    assert cache.stats()["disk_hits"] == 1
+
+    await cache.invalidate("CodeSystem")
+    assert await cache.get("key") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("resource_type", ["..", "../keep", "Patient/..", "metadata"])
+async def test_disk_tier_ignores_names_that_are_not_resource_types(tmp_path, resource_type):
+    disk_dir = tmp_path / "cache"
+    (tmp_path / "keep").mkdir()
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=1000, disk_dir=str(disk_dir))
+
+    await cache.put("key", CachedResponse(resource_type, 200, {}, b"{}", time.time()))
+    await cache.invalidate(resource_type)
+
+    assert (tmp_path / "keep").is_dir()
+    assert not disk_dir.exists() or not any(disk_dir.iterdir())
+
+
+@pytest.mark.asyncio
+async def test_rewritten_links_are_cached_per_proxy_base(client, httpx_mock, mock_gen3_httpx, test_token,
+                                                         cache_enabled):
+    mock_gen3_httpx(token=test_token)
+    page = VALUESET | {"link": [{"relation": "next", "url": f"{HAPI_FHIR_URL}/ValueSet?url=x&_page=2"}]}
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=page)
+    httpx_mock.add_response(method="GET", url=VALUESET_URL, json=page)
+
+    forged = await client.get(f"{PROXY_ROOT}/ValueSet?url=x",
+                              headers={"Authorization": f"Bearer {test_token}", "Host": "attacker.example"})
+    honest = await get_valuesets(client, test_token)
+
+    assert forged.json()["link"][0]["url"].startswith("http://attacker.example/")
+    assert "x-proxy-cache" not in honest.headers
+    assert honest.json()["link"][0]["url"].startswith(f"{PROXY_ROOT}/")
@@ -0,0 +1,56 @@
+from urllib.parse import parse_qs
+
+import pytest
+
+from fhir_proxy.app import scope as scope_module
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.main import rewrite_fhir_url
+from fhir_proxy.app.scope import AccessScope
+from conftest import PROXY_ROOT
+
+
+def test_security_fragment_is_one_any_of_parameter():
+    scope = AccessScope(["/programs/b", "/programs/a", "/programs/a"])
+    assert parse_qs(scope.security_fragment) == {"_security": ["gen3|/programs/a,gen3|/programs/b"]}
+
+
+def test_security_fragment_escapes_token_separators():
+    scope = AccessScope(["a,b"])
+    assert parse_qs(scope.security_fragment)["_security"] == ["gen3|a\\,b"]
+
+
+def test_security_fragment_shared_between_equal_scopes():
+    first = AccessScope(["Patient", "Observation"])
+    second = AccessScope(["Observation", "Patient"])
+    assert first.digest == second.digest
+    assert first.security_fragment is second.security_fragment
+    assert scope_module._fragments[first.digest] is first.security_fragment
+
+
+def test_rewrite_appends_fragment_to_original_query():
+    scope = AccessScope(["Patient"])
+    url = rewrite_fhir_url("http://hapi/fhir/Patient?name=O%27Brien&_count=10", scope)
+    assert url == "http://hapi/fhir/Patient?name=O%27Brien&_count=10&_security=gen3%7CPatient"
+    assert rewrite_fhir_url("http://hapi/fhir/Patient", scope) == "http://hapi/fhir/Patient?_security=gen3%7CPatient"
+
+
+@pytest.mark.asyncio
+async def test_long_search_switches_to_post(client, httpx_mock, mock_gen3_httpx, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_URL_LENGTH", 64)
+    resources = [f"/programs/p{i}" for i in range(20)]
+    mock_gen3_httpx(token=test_token, allowed_resources=resources)
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{HAPI_FHIR_URL}/Patient/_search",
+        json={"resourceType": "Bundle", "type": "searchset"},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/Patient?name=Smith",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    upstream = httpx_mock.get_requests()[-1]
+    assert upstream.headers["content-type"] == "application/x-www-form-urlencoded"
+    form = parse_qs(upstream.content.decode())
+    assert form["name"] == ["Smith"]
+    assert len(form["_security"][0].split(",")) == 20
@@ -0,0 +1,69 @@
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from fhir_proxy.app import scope as scope_module
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.scope import AccessScope
+from fhir_proxy.app.security import SecurityMatcher, resource_allowed
+from conftest import tagged
+
+
+def test_matcher_allows_exact_codes_and_descendant_paths():
+    matcher = SecurityMatcher(["Patient", "/programs/a/projects/b", "/programs/c/"])
+
+    assert matcher.allows("Patient")
+    assert matcher.allows("/programs/a/projects/b")
+    assert matcher.allows("/programs/a/projects/b/subjects/1")
+    assert matcher.allows("/programs/c/projects/d")
+    assert not matcher.allows("/programs/a")
+    assert not matcher.allows("/programs/a/projects/bb")
+    assert not matcher.allows("Observation")
+    assert not matcher.allows(None)
+
+
+def test_matcher_normalizes_tag_prefix():
+    matcher = SecurityMatcher(["gen3|/programs/a"])
+
+    assert matcher.allows("/programs/a/projects/b")
+    assert matcher.allows("gen3|/programs/a")
+
+
+def test_resource_allowed_uses_hierarchy():
+    scope = AccessScope(["/programs/a"])
+
+    assert resource_allowed(tagged("Patient", None, "/programs/a/projects/b"), scope)
+    assert resource_allowed(tagged("Patient", None, "Other", "/programs/a"), scope)
+    assert not resource_allowed(tagged("Patient", None, "/programs/b"), scope)
+    assert resource_allowed({"resourceType": "Patient"}, scope)
+
+
+def test_matcher_shared_between_equal_scopes():
+    first = AccessScope(["/programs/a", "Patient"])
+    second = AccessScope(["Patient", "/programs/a"])
+
+    assert first.matcher is second.matcher
+    assert scope_module._matchers[first.digest] is first.matcher
+
+
+@pytest.mark.asyncio
+async def test_inheritance_applies_to_reads_but_not_to_searches(client, httpx_mock, mock_gen3_httpx, test_token):
+    # Descendant paths are allowed where the proxy checks the resource
+    # itself. Searches are filtered by HAPI FHIR with exact _security codes,
+    # so resources tagged with a descendant path are not found by them.
+    mock_gen3_httpx(token=test_token, allowed_resources=["/programs/a"])
+    patient = tagged("Patient", "1", "/programs/a/projects/b")
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient/1(\?.*)?$"),
+                            json=patient)
+    httpx_mock.add_response(method="GET", url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$"),
+                            json={"resourceType": "Bundle", "type": "searchset", "total": 0})
+    headers = {"Authorization": f"Bearer {test_token}"}
+
+    read = await client.get("http://localhost:8080/Patient/1", headers=headers)
+    search = await client.get("http://localhost:8080/Patient?name=x", headers=headers)
+
+    assert read.status_code == 200
+    assert search.status_code == 200
+    sent = parse_qs(urlsplit(str(httpx_mock.get_requests()[-1].url)).query)
+    assert sent["_security"] == [settings.SECURITY_TAG_PREFIX + "/programs/a"]
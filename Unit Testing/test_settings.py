@@ -0,0 +1,42 @@
+import logging
+
+import pytest
+
+from fhir_proxy.app.config import settings, validate_settings
+
+
+def test_default_settings_are_valid():
+    validate_settings(settings)
+
+
+def test_every_invalid_setting_is_reported(monkeypatch):
+    monkeypatch.setattr(settings, "HAPI_FHIR_URL", "localhost:8080/fhir")
+    monkeypatch.setattr(settings, "BATCH_MODE", "parallel")
+    monkeypatch.setattr(settings, "PROFILE_SAMPLE_RATE", 1.5)
+
+    with pytest.raises(ValueError) as invalid:
+        validate_settings(settings)
+
+    message = str(invalid.value)
+    assert "HAPI_FHIR_URL" in message
+    assert "BATCH_MODE" in message
+    assert "PROFILE_SAMPLE_RATE" in message
+
+
+def test_legacy_auth_server_url_is_flagged(monkeypatch, caplog):
+    monkeypatch.setenv("AUTH_SERVER_URL", "http://fence")
+
+    with caplog.at_level(logging.WARNING):
+        validate_settings(settings)
+
+    assert "GEN3_USER_URL" in caplog.text
+
+
+def test_link_rewriting_without_public_base_url_is_flagged(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "REWRITE_BUNDLE_LINKS", True)
+    monkeypatch.setattr(settings, "PUBLIC_BASE_URL", "")
+
+    with caplog.at_level(logging.WARNING):
+        validate_settings(settings)
+
+    assert "PUBLIC_BASE_URL" in caplog.text
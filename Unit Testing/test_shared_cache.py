@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from fhir_proxy.app.authcache import AuthorizationCache
+from fhir_proxy.app.responsecache import CachedResponse, ResponseCache
+from fhir_proxy.app.scope import AccessScope
+from fhir_proxy.app.sharedcache import CacheBackend, LocalBackend, SharedMemoryBackend
+
+SIZE = 256 * 1024
+
+
+@pytest.fixture
+def shm_path(tmp_path):
+    return str(tmp_path / "cache")
+
+
+def test_shared_memory_backend_is_shared_between_mappings(shm_path):
+    writer = SharedMemoryBackend(shm_path, SIZE, slots=64)
+    reader = SharedMemoryBackend(shm_path, SIZE, slots=64)
+
+    assert writer.set("response", b"k1", b"body-1", tag="Patient")
+    assert writer.set("response", b"k2", b"body-2", tag="Observation")
+
+    assert reader.get("response", b"k1") == b"body-1"
+    assert reader.get("auth", b"k1") is None
+
+    reader.invalidate("response", "Patient")
+    assert writer.get("response", b"k1") is None
+    assert writer.get("response", b"k2") == b"body-2"
+
+    writer.clear("response")
+    assert reader.get("response", b"k2") is None
+    writer.close()
+    reader.close()
+
+
+def test_shared_memory_backend_expires_and_deletes(shm_path):
+    backend = SharedMemoryBackend(shm_path, SIZE, slots=64)
+
+    backend.set("auth", b"expired", b"x", ttl=-1)
+    backend.set("auth", b"deleted", b"y")
+    backend.delete("auth", b"deleted")
+
+    assert backend.get("auth", b"expired") is None
+    assert backend.get("auth", b"deleted") is None
+    backend.close()
+
+
+def test_shared_memory_ring_overwrite_is_a_miss(shm_path):
+    backend = SharedMemoryBackend(shm_path, SIZE, slots=1024)
+    value = b"v" * 4000
+    for i in range(200):
+        backend.set("response", f"k{i}".encode(), value + str(i).encode())
+
+    assert backend.get("response", b"k0") is None
+    assert backend.get("response", b"k199") == value + b"199"
+    assert not backend.set("response", b"huge", b"x" * SIZE)
+    backend.close()
+
+
+def test_shared_memory_layout_change_reinitializes(shm_path):
+    SharedMemoryBackend(shm_path, SIZE, slots=64).set("auth", b"k", b"v")
+
+    backend = SharedMemoryBackend(shm_path, SIZE, slots=128)
+
+    assert backend.get("auth", b"k") is None
+    backend.close()
+
+
+@pytest.mark.asyncio
+async def test_response_invalidation_reaches_other_workers():
+    backend = LocalBackend(max_bytes=1024 * 1024)
+    first = ResponseCache(max_bytes=10_000, max_entry_bytes=1000, backend=backend)
+    second = ResponseCache(max_bytes=10_000, max_entry_bytes=1000, backend=backend)
+
+    await first.put("key", CachedResponse("Patient", 200, {"etag": 'W/"1"'}, b"{}", time.time()))
+    entry = await second.get("key")
+    assert entry.body == b"{}" and entry.etag == 'W/"1"'
+    assert second.stats()["shared_hits"] == 1
+
+    await first.invalidate("Patient")
+
+    assert await second.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_authorization_loaded_once_across_workers(shm_path):
+    calls = 0
+
+    async def loader(token):
+        nonlocal calls
+        calls += 1
+        return AccessScope(["Patient"])
+
+    workers = [
+        AuthorizationCache(ttl=60, negative_ttl=5, max_entries=10, max_bytes=10_000,
+                           backend=SharedMemoryBackend(shm_path, SIZE, slots=64))
+        for _ in range(3)
+    ]
+    scopes = [await cache.get_or_load("token", loader) for cache in workers]
+
+    assert calls == 1
+    assert all(scope.resources == ("Patient",) for scope in scopes)
+    assert [cache.stats()["shared_hits"] for cache in workers] == [0, 1, 1]
+
+
+def test_incomplete_backend_cannot_be_created():
+    class GetOnly(CacheBackend):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly()
@@ -0,0 +1,70 @@
+import json
+import re
+
+import pytest
+from pytest_httpx import IteratorStream
+
+from fhir_proxy.app.config import HAPI_FHIR_URL
+from conftest import PROXY_ROOT, tagged
+
+
+@pytest.mark.asyncio
+async def test_search_bundle_is_streamed_through(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    chunks = [b'{"resourceType": "Bundle", ', b'"type": "searchset", ', b'"total": 1, "entry": [{"resource"',
+              b': {"resourceType": "Patient", "id": "1"}}]}']
+    httpx_mock.add_response(
+        method="GET",
+        url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$"),
+        stream=IteratorStream(chunks),
+        headers={"Content-Type": "application/fhir+json", "ETag": 'W/"1"'},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/Patient?name=Smith",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    assert response.json() == json.loads(b"".join(chunks))
+    assert response.headers["content-type"] == "application/fhir+json"
+    assert response.headers["etag"] == 'W/"1"'
+
+
+@pytest.mark.asyncio
+async def test_direct_read_is_buffered_and_checked(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Observation"])
+    httpx_mock.add_response(
+        method="GET",
+        url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient/123\?.*$"),
+        json={"resourceType": "Patient", "id": "123", "meta": {"security": [{"code": "Patient"}]}},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/Patient/123",
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_search_bundle_entries_filtered_by_security(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token, allowed_resources=["Patient"])
+    body = json.dumps({
+        "resourceType": "Bundle",
+        "total": 3,
+        "entry": [
+            {"resource": tagged("Patient", "1", "Patient")},
+            {"resource": tagged("Patient", "2", "Secret")},
+            {"resource": tagged("Patient", "3", "Patient")},
+        ],
+    }).encode()
+    httpx_mock.add_response(
+        method="GET",
+        url=re.compile(rf"{re.escape(HAPI_FHIR_URL)}/Patient\?.*$"),
+        stream=IteratorStream([body[i:i + 7] for i in range(0, len(body), 7)]),
+        headers={"Content-Type": "application/fhir+json"},
+    )
+
+    response = await client.get(f"{PROXY_ROOT}/Patient", headers={"Authorization": f"Bearer {test_token}"})
+
+    bundle = response.json()
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == ["1", "3"]
+    assert bundle["total"] == 2
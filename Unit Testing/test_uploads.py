@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from fhir_proxy.app.config import HAPI_FHIR_URL, settings
+from fhir_proxy.app.uploads import UploadRejected, UploadValidator, stream_upload
+from conftest import FRAGMENT, PROXY_ROOT, chunked, tagged
+
+
+def transaction(*resources):
+    return {"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"resource": r, "request": {"method": "PUT", "url": f"{r['resourceType']}/{r['id']}"}} for r in resources
+    ]}
+
+
+@pytest.mark.asyncio
+async def test_last_chunk_is_held_until_the_body_is_validated():
+    body = json.dumps(transaction(tagged("Patient", "1", "Patient"), tagged("Patient", "2", "Secret"))).encode()
+    sent = []
+
+    with pytest.raises(UploadRejected) as rejected:
+        async for chunk in stream_upload(chunked(body), validator=UploadValidator(["Patient"])):
+            sent.append(chunk)
+
+    assert rejected.value.status_code == 403
+    assert len(b"".join(sent)) < len(body)
+
+
+@pytest.mark.asyncio
+async def test_single_resource_needs_an_allowed_tag():
+    validator = UploadValidator(["Patient"])
+    allowed = json.dumps(tagged("Patient", "1", "Patient")).encode()
+    assert b"".join([c async for c in stream_upload(chunked(allowed), validator=validator)]) == allowed
+    assert validator.checked == 1
+
+    untagged = json.dumps({"resourceType": "Patient", "id": "2"}).encode()
+    with pytest.raises(UploadRejected):
+        [c async for c in stream_upload(chunked(untagged), validator=UploadValidator(["Patient"]))]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("entry", [tagged("Patient", "2", "Secret"), {"resourceType": "Patient", "id": "2"}])
+async def test_entries_before_resource_type_are_checked(entry):
+    bundle = transaction(tagged("Patient", "1", "Patient"), entry)
+    # "entry" first, "resourceType" last.
+    body = json.dumps(dict(reversed(list(bundle.items())))).encode()
+    assert body.index(b'"entry"') < body.index(b'"resourceType"')
+
+    with pytest.raises(UploadRejected) as rejected:
+        [c async for c in stream_upload(chunked(body), validator=UploadValidator(["Patient"]))]
+    assert rejected.value.status_code == 403
+
+    allowed = json.dumps(dict(reversed(list(transaction(tagged("Patient", "1", "Patient")).items())))).encode()
+    validator = UploadValidator(["Patient"])
+    assert b"".join([c async for c in stream_upload(chunked(allowed), validator=validator)]) == allowed
+    assert validator.checked == 1
+
+
+@pytest.mark.asyncio
+async def test_transaction_is_streamed_to_hapi(client, httpx_mock, mock_gen3_httpx, test_token):
+    mock_gen3_httpx(token=test_token)
+    body = json.dumps(transaction(tagged("Patient", "1", "Patient"))).encode()
+    httpx_mock.add_response(method="POST", url=f"{HAPI_FHIR_URL}/?{FRAGMENT}",
+                            json={"resourceType": "Bundle", "type": "transaction-response"})
+
+    response = await client.post(f"{PROXY_ROOT}/", content=chunked(body, 7),
+                                 headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 200
+    upstream = httpx_mock.get_requests()[-1]
+    assert upstream.content == body
+    assert "content-length" not in upstream.headers
+
+
+@pytest.mark.asyncio
+async def test_oversized_upload_is_refused(client, httpx_mock, mock_gen3_httpx, test_token, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_REQUEST_BODY_BYTES", 100)
+    mock_gen3_httpx(token=test_token)
+    body = json.dumps(tagged("Patient", "1", "Patient") | {"text": {"div": "x" * 200}}).encode()
+
+    response = await client.put(f"{PROXY_ROOT}/Patient/1", content=body,
+                                headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 413
+    assert not any(request.method == "PUT" for request in httpx_mock.get_requests())
+
+
+@pytest.mark.asyncio
+async def test_upload_with_disallowed_resource_is_refused(client, httpx_mock, mock_gen3_httpx, test_token,
+                                                          monkeypatch):
+    monkeypatch.setattr(settings, "VALIDATE_UPLOAD_SECURITY", True)
+    mock_gen3_httpx(token=test_token)
+    body = json.dumps(transaction(tagged("Patient", "1", "Patient"), tagged("Patient", "2", "Secret"))).encode()
+    httpx_mock.add_response(method="POST", url=f"{HAPI_FHIR_URL}/?{FRAGMENT}", is_optional=True)
+
+    response = await client.post(f"{PROXY_ROOT}/", content=chunked(body, 32),
+                                 headers={"Authorization": f"Bearer {test_token}"})
+
+    assert response.status_code == 403
+    assert "security tag" in response.json()["detail"]
@@ -0,0 +1,11 @@
+# The FastAPI application is built on first access to `fhir_proxy.app.app`,
+# so importing a single module (settings, the codec, a benchmark) does not
+# pull in FastAPI and every upstream client.
+
+
+def __getattr__(name):
+    if name == "app":
+        from .main import app
+
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,28 +1,192 @@
-from fastapi import HTTPException, status
+import asyncio
+import hmac
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
 import httpx
+from fastapi import Header, HTTPException
 from .config import settings
+from .authcache import token_key
+from .clients import get_gen3_client
+from .codec import loads
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSValidator:
+    """Validate bearer JWTs locally against the issuer's cached JWKS.
+
+    Keys are refreshed in the background and on demand when a token is
+    signed with an unknown `kid` (key rotation). Tokens that verified once
+    are remembered until their `exp`, so the signature check is not repeated
+    for every request.
+    """
+
+    def __init__(self) -> None:
+        self._keys: dict[str, dict] = {}
+        self._fetched_at = 0.0
+        self._inflight = SingleFlight()
+        self._verified: "OrderedDict[bytes, float]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.rejected = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.JWKS_URL)
+
+    async def start(self) -> None:
+        if self.enabled and self._task is None:
+            await self.refresh()
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.JWKS_REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception:
+                # The loop must outlive any one bad refresh, or the keys go stale.
+                logger.exception("JWKS refresh failed")
+
+    async def refresh(self) -> None:
+        await self._inflight.do("jwks", self._fetch)
+
+    async def _fetch(self) -> None:
+        # Failed attempts count too, so an unreachable issuer is not asked
+        # again for every request.
+        self._fetched_at = time.monotonic()
+        try:
+            resp = await get_gen3_client().get(settings.JWKS_URL)
+            resp.raise_for_status()
+            keys = parse_jwks(loads(resp.content))
+        except (httpx.HTTPError, ValueError) as exc:
+            # Keep serving the previous key set until the issuer is reachable.
+            self.refresh_failures += 1
+            logger.warning("Failed to refresh JWKS from %s: %s", settings.JWKS_URL, exc)
+            return
+        self._keys = keys
+        self.refreshes += 1
+
+    def _refresh_due(self) -> bool:
+        """On-demand refreshes are spaced JWKS_MIN_REFRESH_INTERVAL apart."""
+        return time.monotonic() - self._fetched_at >= settings.JWKS_MIN_REFRESH_INTERVAL
+
+    async def _signing_key(self, kid: str) -> Optional[dict]:
+        key = self._keys.get(kid)
+        if key is None and self._refresh_due():
+            await self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    async def validate(self, token: str) -> bool:
+        key_id = token_key(token)
+        exp = self._verified.get(key_id)
+        if exp is not None:
+            if exp > time.time():
+                self._verified.move_to_end(key_id)
+                self.accepted += 1
+                return True
+            del self._verified[key_id]
+
+        # Only deployments with JWKS_URL set validate locally; jose is
+        # imported on the first token that is not in the verified cache.
+        from jose import JWTError, jwt
+
+        try:
+            header = jwt.get_unverified_header(token)
+        except JWTError:
+            return self._reject()
+        if header.get("alg") not in settings.JWT_ALGORITHMS:
+            return self._reject()
+
+        if not self._keys:
+            if self._refresh_due():
+                await self.refresh()
+            if not self._keys:
+                # No key set available: leave validation to the Gen3 lookup.
+                return True
+
+        key = await self._signing_key(header.get("kid", ""))
+        if key is None:
+            return self._reject()
+
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=list(settings.JWT_ALGORITHMS),
+                audience=settings.JWT_AUDIENCE or None,
+                issuer=settings.JWT_ISSUER or None,
+                options={"verify_aud": bool(settings.JWT_AUDIENCE), "require_exp": True},
+            )
+        except JWTError:
+            return self._reject()
+
+        self._verified[key_id] = float(claims["exp"])
+        while len(self._verified) > settings.JWT_VERIFIED_CACHE_SIZE:
+            self._verified.popitem(last=False)
+        self.accepted += 1
+        return True
+
+    def _reject(self) -> bool:
+        self.rejected += 1
+        return False
+
+    def reset(self) -> None:
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._verified.clear()
+        self.accepted = self.rejected = self.refreshes = self.refresh_failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "keys": len(self._keys),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "verified_cache_entries": len(self._verified),
+        }
+
+
+def parse_jwks(payload) -> dict[str, dict]:
+    """Keys of a JWK Set by `kid`; ValueError for anything that is not one."""
+    keys = payload.get("keys", []) if isinstance(payload, dict) else None
+    if not isinstance(keys, list) or not all(isinstance(key, dict) for key in keys):
+        raise ValueError("JWKS is not an object with a list of keys")
+    return {key.get("kid", ""): key for key in keys}
+
+
+jwks_validator = JWKSValidator()
+
 
 async def verify_token(token: str) -> bool:
 
     if not token:
         return False
-    return True
+    if not jwks_validator.enabled:
+        return True
+    return await jwks_validator.validate(token)
 
 
-async def get_accessible_resources(token: str) -> list[str]:
- 
-    headers = {"Authorization": f"Bearer {token}"}
-    
-    async with httpx.AsyncClient(timeout=settings.PROXY_TIMEOUT) as client:
-        try:
-            response = await client.get(
-                f"{settings.AUTH_SERVER_URL}/auth/resources",
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as exc:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Failed to verify access permissions"
-            ) from exc
+def require_admin(x_proxy_admin_token: str = Header(None)) -> None:
+    """The /_proxy endpoints need ADMIN_TOKEN in X-Proxy-Admin-Token; without one set they are off."""
+    expected = settings.ADMIN_TOKEN
+    if not expected or not x_proxy_admin_token or not hmac.compare_digest(x_proxy_admin_token, expected):
+        raise HTTPException(status_code=403, detail="Admin token required")
@@ -0,0 +1,206 @@
+import base64
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+import httpx
+from .config import settings
+from .codec import dumps, loads
+from .scope import AccessScope
+from .sharedcache import CacheBackend, cache_backend
+from .singleflight import SingleFlight
+
+# In-process cache of Gen3 authorization lookups, keyed by a hash of the
+# bearer token so raw tokens are never kept in memory. With a shared backend
+# the resource sets (not the denials) are also kept in a tier all workers
+# of the host see.
+
+NEGATIVE_STATUS_CODES = (401, 403)
+_ENTRY_OVERHEAD = 64
+NAMESPACE = "auth"
+
+
+def token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """Return the unverified `exp` claim of a JWT, or None if there is none."""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + "=" * (-len(parts[1]) % 4)
+    try:
+        claims = loads(base64.urlsafe_b64decode(payload))
+    except ValueError:
+        return None
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+def _estimate_size(value: Any) -> int:
+    value = getattr(value, "resources", value)
+    if isinstance(value, (list, tuple)):
+        return _ENTRY_OVERHEAD + sum(len(item) + _ENTRY_OVERHEAD for item in value)
+    return _ENTRY_OVERHEAD
+
+
+class _Entry:
+    __slots__ = ("value", "error", "expires_at", "size")
+
+    def __init__(self, value: Any, error: Optional[httpx.HTTPStatusError], expires_at: float, size: int):
+        self.value = value
+        self.error = error
+        self.expires_at = expires_at
+        self.size = size
+
+
+class AuthorizationCache:
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int, max_bytes: int,
+                 backend: Optional[CacheBackend] = None,
+                 decode: Callable[[list], Any] = AccessScope):
+        self.ttl = ttl
+        self.backend = backend
+        self.decode = decode
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[bytes, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._inflight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.shared_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get_or_load(self, token: str, loader: Callable[[str], Awaitable[Any]]) -> Any:
+        key = token_key(token)
+        entry = self._lookup(key)
+        if entry is not None:
+            if entry.error is not None:
+                self.negative_hits += 1
+                raise httpx.HTTPStatusError(
+                    str(entry.error), request=entry.error.request, response=entry.error.response
+                )
+            self.hits += 1
+            return entry.value
+
+        if self.backend is not None:
+            value = self._lookup_shared(key)
+            if value is not None:
+                self.shared_hits += 1
+                return value
+
+        self.misses += 1
+        return await self._inflight.do(key, lambda: self._load(key, token, loader))
+
+    def _lookup_shared(self, key: bytes) -> Any:
+        data = self.backend.get(NAMESPACE, key)
+        if data is None:
+            return None
+        try:
+            item = loads(data)
+            value = self.decode(item["value"])
+            ttl = item["expires_at"] - time.time()
+        except (ValueError, KeyError, TypeError):
+            return None
+        if ttl <= 0:
+            return None
+        self._store(key, _Entry(value, None, time.monotonic() + ttl, _estimate_size(value)))
+        return value
+
+    async def _load(self, key: bytes, token: str, loader: Callable[[str], Awaitable[Any]]) -> Any:
+        now = time.monotonic()
+        try:
+            value = await loader(token)
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code in NEGATIVE_STATUS_CODES and self.negative_ttl > 0:
+                self._store(key, _Entry(None, exc, now + self.negative_ttl, _ENTRY_OVERHEAD))
+            raise
+
+        ttl = self.ttl
+        exp = token_expiry(token)
+        if exp is not None:
+            # Never serve an authorization past the lifetime of the token.
+            ttl = min(ttl, exp - time.time())
+        if ttl > 0:
+            self._store(key, _Entry(value, None, now + ttl, _estimate_size(value)))
+            if self.backend is not None:
+                item = {"value": list(value), "expires_at": time.time() + ttl}
+                self.backend.set(NAMESPACE, key, dumps(item), ttl=ttl)
+        return value
+
+    def _lookup(self, key: bytes) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: bytes, entry: _Entry) -> None:
+        if key in self._entries:
+            self._remove(key)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: bytes) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def invalidate(self, token: str) -> None:
+        key = token_key(token)
+        if key in self._entries:
+            self._remove(key)
+        if self.backend is not None:
+            self.backend.delete(NAMESPACE, key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def reset(self) -> None:
+        self.clear()
+        self.hits = self.misses = self.negative_hits = self.shared_hits = self.evictions = self.expirations = 0
+        self._inflight.coalesced = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.shared_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "coalesced": self._inflight.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": (self.hits + self.negative_hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+
+auth_cache = AuthorizationCache(
+    ttl=settings.AUTH_CACHE_TTL,
+    negative_ttl=settings.AUTH_CACHE_NEGATIVE_TTL,
+    max_entries=settings.AUTH_CACHE_MAX_ENTRIES,
+    max_bytes=settings.AUTH_CACHE_MAX_BYTES,
+    backend=cache_backend,
+)
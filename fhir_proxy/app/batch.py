@@ -0,0 +1,177 @@
+import asyncio
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Iterable, Optional, Union
+
+from .bulkexport import is_export_file
+from .security import resource_allowed
+
+# FHIR `batch` Bundles POSTed to the base URL. The proxy authorizes the
+# caller once and then handles every entry as if it had been sent on its
+# own: the `_security` fragment is added to its URL, resources being written
+# must carry an allowed security code, and what comes back is checked
+# against the caller's scope. Entries are independent in a batch, so one
+# failing entry only fails its own response entry.
+
+BATCH_METHODS = ("GET", "POST", "PUT", "DELETE")
+
+# Bundle.entry.request fields sent upstream as conditional headers.
+CONDITIONAL_FIELDS = {
+    "ifNoneMatch": "If-None-Match",
+    "ifModifiedSince": "If-Modified-Since",
+    "ifMatch": "If-Match",
+    "ifNoneExist": "If-None-Exist",
+}
+
+ISSUE_CODES = {400: "invalid", 403: "forbidden", 404: "not-found", 413: "too-costly", 503: "transient"}
+
+
+class BatchEntryError(ValueError):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+class BatchEntry:
+    __slots__ = ("request", "method", "path", "query", "headers", "resource")
+
+    def __init__(self, request: dict, method: str, path: str, query: str, headers: dict, resource: Optional[dict]):
+        self.request = request
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.resource = resource
+
+    @property
+    def url(self) -> str:
+        """The entry's URL relative to the server base."""
+        return f"{self.path}?{self.query}" if self.query else self.path
+
+    @property
+    def path_parts(self) -> list[str]:
+        return self.path.split("/")
+
+
+def is_batch(bundle: Any) -> bool:
+    return isinstance(bundle, dict) and bundle.get("resourceType") == "Bundle" and bundle.get("type") == "batch"
+
+
+def status_line(status_code: int) -> str:
+    try:
+        return f"{status_code} {HTTPStatus(status_code).phrase}"
+    except ValueError:
+        return str(status_code)
+
+
+def error_entry(status_code: int, detail: str) -> dict:
+    outcome = {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": ISSUE_CODES.get(status_code, "processing"), "diagnostics": detail}],
+    }
+    return {"response": {"status": status_line(status_code), "outcome": outcome}}
+
+
+def parse_entry(entry: Any, bases: Iterable[str], allowed_resources: Iterable[str]) -> BatchEntry:
+    request = entry.get("request") if isinstance(entry, dict) else None
+    if not isinstance(request, dict) or not isinstance(request.get("url"), str):
+        raise BatchEntryError(400, "Batch entry has no request url")
+    method = str(request.get("method", "")).upper()
+    if method not in BATCH_METHODS:
+        raise BatchEntryError(400, f"Unsupported batch entry method: {request.get('method')}")
+
+    url = request["url"]
+    for base in bases:
+        base = base.rstrip("/")
+        if url == base or url.startswith((base + "/", base + "?")):
+            url = url[len(base):]
+            break
+    else:
+        if "://" in url:
+            raise BatchEntryError(400, "Batch entry url is not on this server")
+    path, _, query = url.lstrip("/").partition("?")
+    path = path.strip("/")
+    if not path or path.startswith("$") or "/$export" in path:
+        raise BatchEntryError(400, f"Operation not supported in a batch: {request['url']}")
+
+    resource = entry.get("resource")
+    if method in ("POST", "PUT"):
+        if not isinstance(resource, dict) or "resourceType" not in resource:
+            raise BatchEntryError(400, f"{method} batch entry has no resource")
+        if not resource_allowed(resource, allowed_resources):
+            raise BatchEntryError(403, "Access denied for this resource")
+    else:
+        resource = None
+
+    headers = {header: str(request[field]) for field, header in CONDITIONAL_FIELDS.items() if request.get(field)}
+    return BatchEntry(request, method, path, query, headers, resource)
+
+
+def parse_entries(entries: list, bases: Iterable[str], allowed_resources: Iterable[str]) -> list[Union[BatchEntry, dict]]:
+    """Parse each entry, or turn it into its error response entry."""
+    parsed: list[Union[BatchEntry, dict]] = []
+    for entry in entries:
+        try:
+            parsed.append(parse_entry(entry, bases, allowed_resources))
+        except BatchEntryError as e:
+            parsed.append(error_entry(e.status_code, str(e)))
+    return parsed
+
+
+def response_entry(status_code: int, headers: dict, resource: Any = None) -> dict:
+    response = {"status": status_line(status_code)}
+    for header, field in (("location", "location"), ("etag", "etag"), ("last-modified", "lastModified")):
+        value = headers.get(header)
+        if value:
+            response[field] = value
+    entry: dict = {"response": response}
+    if resource is not None:
+        entry["resource"] = resource
+    return entry
+
+
+def secure_response_entry(entry: Any, allowed_resources: Iterable[str],
+                          rewrite_links: Optional[Callable[[Any], Any]] = None) -> dict:
+    """Check the resource a read or search entry returned against the scope."""
+    if not isinstance(entry, dict):
+        return error_entry(502, "Malformed batch response entry")
+    resource = entry.get("resource")
+    if isinstance(resource, dict) and resource.get("resourceType") == "Bundle":
+        if isinstance(resource.get("entry"), list):
+            resource["entry"] = [
+                item for item in resource["entry"]
+                if not isinstance(item, dict) or (not is_export_file(item.get("resource"))
+                                                  and resource_allowed(item.get("resource"), allowed_resources))
+            ]
+        if rewrite_links is not None and "link" in resource:
+            resource["link"] = rewrite_links(resource["link"])
+    elif is_export_file(resource):
+        return error_entry(406, "Export files can only be downloaded as NDJSON")
+    elif not resource_allowed(resource, allowed_resources):
+        return error_entry(403, "Access denied for this resource")
+    return entry
+
+
+def upstream_entry(entry: BatchEntry, url: str) -> dict:
+    """The entry as sent upstream in a single batch, pointing at `url`."""
+    upstream = {"request": {**entry.request, "method": entry.method, "url": url}}
+    if entry.resource is not None:
+        upstream["resource"] = entry.resource
+    return upstream
+
+
+def response_bundle(entries: list[dict]) -> dict:
+    return {"resourceType": "Bundle", "type": "batch-response", "entry": entries}
+
+
+async def run_entries(entries: list[Union[BatchEntry, dict]], execute: Callable[[BatchEntry], Awaitable[dict]],
+                      concurrency: int) -> list[dict]:
+    """Execute the parsed entries concurrently, keeping their order."""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(entry: Union[BatchEntry, dict]) -> dict:
+        if not isinstance(entry, BatchEntry):
+            return entry
+        async with semaphore:
+            return await execute(entry)
+
+    return list(await asyncio.gather(*(run(entry) for entry in entries)))
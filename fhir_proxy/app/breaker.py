@@ -0,0 +1,198 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from .config import settings
+from .limiter import ClientFault, Overloaded
+
+# Circuit breakers toward the upstreams.
+#
+# Each upstream keeps a window of its most recent call outcomes. Once the
+# window holds `min_calls` outcomes and either the failure rate (transport
+# errors and 5xx answers) or the rate of calls slower than
+# `slow_call_seconds` reaches its threshold, the breaker opens: calls fail
+# at once with 503 instead of each waiting out the upstream timeout. After
+# `open_seconds` it lets `half_open_calls` probe calls through; if they all
+# succeed it closes again, and any failing probe opens it for another
+# period.
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Overloaded):
+    pass
+
+
+class Call:
+    __slots__ = ("breaker", "started", "probe", "failed")
+
+    def __init__(self, breaker: Optional["CircuitBreaker"], probe: bool = False) -> None:
+        self.breaker = breaker
+        self.started = time.perf_counter()
+        self.probe = probe
+        self.failed = False
+
+    def finish(self, cancelled: bool = False) -> None:
+        if self.breaker is not None:
+            breaker, self.breaker = self.breaker, None
+            breaker._record(self, time.perf_counter() - self.started, cancelled)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, window: int, min_calls: int, failure_rate: float, slow_call_seconds: float,
+                 slow_call_rate: float, open_seconds: float, half_open_calls: int) -> None:
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.reset()
+
+    def reset(self) -> None:
+        self.state = CLOSED
+        self._outcomes: deque[tuple[bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.state == CLOSED
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[Call]:
+        """Run one upstream call through the breaker; set `call.failed` for bad answers."""
+        if not settings.CIRCUIT_BREAKER_ENABLED:
+            yield Call(None)
+            return
+        call = self._admit()
+        try:
+            yield call
+        except (asyncio.CancelledError, ClientFault, Overloaded):
+            # Neither a success nor a failure of the upstream: the call was
+            # cancelled, refused for the client's request or shed by the
+            # local limiter before it was sent.
+            call.finish(cancelled=True)
+            raise
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            call.finish()
+
+    def _admit(self) -> Call:
+        if self.state == OPEN:
+            if time.monotonic() < self._opened_at + self.open_seconds:
+                self.rejected += 1
+                raise CircuitOpen(self.name, self.retry_after())
+            self.state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_calls:
+                self.rejected += 1
+                raise CircuitOpen(self.name, self.retry_after())
+            self._probes += 1
+            return Call(self, probe=True)
+        return Call(self)
+
+    def _record(self, call: Call, latency: float, cancelled: bool) -> None:
+        if cancelled:
+            # Says nothing about the upstream; give a probe slot back.
+            if call.probe and self.state == HALF_OPEN:
+                self._probes -= 1
+            return
+        slow = latency >= self.slow_call_seconds
+        self.calls += 1
+        self.failures += call.failed
+        self.slow_calls += slow
+
+        if call.probe:
+            if self.state != HALF_OPEN:
+                return
+            if call.failed or slow:
+                self._trip()
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self.state = CLOSED
+            return
+        if self.state != CLOSED:
+            # Started before the breaker opened.
+            return
+
+        self._outcomes.append((call.failed, slow))
+        self._failures += call.failed
+        self._slow += slow
+        if len(self._outcomes) > self.window:
+            old_failed, old_slow = self._outcomes.popleft()
+            self._failures -= old_failed
+            self._slow -= old_slow
+        count = len(self._outcomes)
+        if count >= self.min_calls and (self._failures >= self.failure_rate * count
+                                        or self._slow >= self.slow_call_rate * count):
+            self._trip()
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._failures = self._slow = 0
+        self.trips += 1
+
+    def retry_after(self) -> int:
+        if self.state == OPEN:
+            return max(1, math.ceil(self._opened_at + self.open_seconds - time.monotonic()))
+        return 1
+
+    def stats(self) -> dict:
+        count = len(self._outcomes)
+        return {
+            "state": self.state,
+            "state_code": STATE_CODES[self.state],
+            "failure_rate": self._failures / count if count else 0.0,
+            "slow_call_rate": self._slow / count if count else 0.0,
+            "calls": self.calls,
+            "failures": self.failures,
+            "slow_calls": self.slow_calls,
+            "rejected": self.rejected,
+            "trips": self.trips,
+        }
+
+
+def _breaker(name: str, slow_call_seconds: float) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        window=settings.CIRCUIT_BREAKER_WINDOW,
+        min_calls=settings.CIRCUIT_BREAKER_MIN_CALLS,
+        failure_rate=settings.CIRCUIT_BREAKER_FAILURE_RATE,
+        slow_call_seconds=slow_call_seconds,
+        slow_call_rate=settings.CIRCUIT_BREAKER_SLOW_CALL_RATE,
+        open_seconds=settings.CIRCUIT_BREAKER_OPEN_SECONDS,
+        half_open_calls=settings.CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+    )
+
+
+hapi_breaker = _breaker("hapi", settings.HAPI_SLOW_CALL_SECONDS)
+gen3_breaker = _breaker("gen3", settings.GEN3_SLOW_CALL_SECONDS)
+
+
+def breaker_stats() -> dict:
+    return {"hapi": hapi_breaker.stats(), "gen3": gen3_breaker.stats()}
@@ -0,0 +1,108 @@
+from typing import AsyncIterator, Iterable
+
+from .codec import loads
+from .security import compile_matcher, resource_allowed
+
+# FHIR Bulk Data ($export) support. Kick-off and status requests are passed
+# through to HAPI with the upstream URLs they return (Content-Location, the
+# manifest's file URLs) pointed back at the proxy, and the NDJSON files are
+# filtered by meta.security line by line while they stream.
+
+EXPORT_OPERATION = "$export"
+EXPORT_STATUS = "$export-poll-status"
+NDJSON_TYPES = ("application/fhir+ndjson", "application/ndjson", "ndjson")
+
+
+def is_export_kickoff(path_parts: list[str]) -> bool:
+    return path_parts[-1] == EXPORT_OPERATION
+
+
+def is_export_status(path_parts: list[str]) -> bool:
+    return path_parts[0] == EXPORT_STATUS
+
+
+def is_ndjson(content_type: str) -> bool:
+    return any(media_type in content_type for media_type in NDJSON_TYPES)
+
+
+def is_export_file(resource) -> bool:
+    """An export output read as a Binary resource; its `data` is the whole unfiltered file."""
+    return isinstance(resource, dict) and resource.get("resourceType") == "Binary" \
+        and isinstance(resource.get("contentType"), str) and is_ndjson(resource["contentType"])
+
+
+def to_proxy_url(url: str, upstream_base: str, proxy_base: str) -> str:
+    upstream_base = upstream_base.rstrip("/")
+    if url == upstream_base or url.startswith((upstream_base + "/", upstream_base + "?")):
+        return proxy_base.rstrip("/") + url[len(upstream_base):]
+    return url
+
+
+def rewrite_manifest(manifest: dict, upstream_base: str, proxy_base: str) -> dict:
+    """Point the file URLs of a completed export at the proxy."""
+    for key in ("output", "error", "deleted"):
+        for item in manifest.get(key) or []:
+            if isinstance(item, dict) and isinstance(item.get("url"), str):
+                item["url"] = to_proxy_url(item["url"], upstream_base, proxy_base)
+    if isinstance(manifest.get("request"), str):
+        manifest["request"] = to_proxy_url(manifest["request"], upstream_base, proxy_base)
+    # The files are only served through the proxy, which needs the token.
+    manifest["requiresAccessToken"] = True
+    return manifest
+
+
+class NDJSONSecurityFilter:
+    """Drop NDJSON lines whose resource carries no allowed security code.
+
+    Only one line is held at a time, so memory stays constant whatever the
+    size of the file. Lines that cannot contain a "security" key are
+    untagged and are passed on without being decoded.
+    """
+
+    def __init__(self, allowed_resources: Iterable[str], max_line_bytes: int = 0) -> None:
+        self.allowed_resources = compile_matcher(allowed_resources)
+        self.max_line_bytes = max_line_bytes
+        self.kept = 0
+        self.dropped = 0
+        self.invalid = 0
+
+    async def filter(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        pending = bytearray()
+        async for chunk in chunks:
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                pending += chunk
+                if self.max_line_bytes and len(pending) > self.max_line_bytes:
+                    raise ValueError("NDJSON line exceeds the configured size limit")
+                continue
+            pending += chunk[:end]
+            out = self._filter_lines(bytes(pending))
+            pending = bytearray(chunk[end + 1:])
+            if out:
+                yield out
+        out = self._filter_lines(bytes(pending))
+        if out:
+            yield out
+
+    def _filter_lines(self, data: bytes) -> bytes:
+        kept = []
+        for line in data.split(b"\n"):
+            line = line.rstrip(b"\r")
+            if not line.strip():
+                continue
+            # Escaped keys could spell "security" without the literal bytes.
+            if b'"security"' in line or b"\\u" in line:
+                try:
+                    resource = loads(line)
+                except ValueError:
+                    self.invalid += 1
+                    continue
+                if not resource_allowed(resource, self.allowed_resources):
+                    self.dropped += 1
+                    continue
+            self.kept += 1
+            kept.append(line)
+        if not kept:
+            return b""
+        kept.append(b"")
+        return b"\n".join(kept)
@@ -0,0 +1,300 @@
+import codecs
+import json
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
+
+from .bulkexport import is_export_file
+from .codec import dumps
+from .security import compile_matcher, resource_allowed
+
+# Incremental scanner for top-level JSON objects such as FHIR Bundles.
+#
+# The scanner decodes the body as it arrives and reports each top-level
+# member and each element of the top-level "entry" array as soon as it is
+# complete, so a consumer never holds more than one entry in memory.
+#
+# Events:
+#   ("member", name, text, value)   a top-level member other than "entry"
+#   ("entry_start",)                the "entry" array has started
+#   ("entry", text, value)          one element of the "entry" array
+#   ("entry_end",)                  the "entry" array is closed
+#   ("end",)                        the top-level object is closed
+#   ("raw", data)                   the body is not a JSON object; pass it through
+#
+# Values are decoded with the C-accelerated JSONDecoder.raw_decode. An
+# incomplete value is retried only once the buffered text has doubled, so a
+# large entry spread over many chunks is decoded in amortized linear time.
+
+_WHITESPACE = " \t\r\n"
+_NUMBER_START = "-0123456789"
+
+_OBJECT, _KEY, _COLON, _VALUE, _AFTER_VALUE, _ENTRY, _AFTER_ENTRY, _DONE = range(8)
+
+
+class BundleScanner:
+    def __init__(self, max_value_bytes: int = 0) -> None:
+        self.max_value_bytes = max_value_bytes
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._state = _OBJECT
+        self._key: Optional[str] = None
+        self._need = 0
+        self._prefix = bytearray()
+        self._passthrough = False
+
+    def feed(self, chunk: bytes) -> list:
+        events: list = []
+        if self._passthrough:
+            if chunk:
+                events.append(("raw", bytes(chunk)))
+            return events
+        if self._state == _OBJECT:
+            self._prefix += chunk
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        self._scan(events, final=False)
+        return events
+
+    def close(self) -> list:
+        events: list = []
+        if self._passthrough:
+            return events
+        if self._state == _OBJECT:
+            if self._prefix:
+                events.append(("raw", bytes(self._prefix)))
+            return events
+        self._buf = self._buf[self._pos:] + self._text.decode(b"", final=True)
+        self._pos = 0
+        self._need = 0
+        self._scan(events, final=True)
+        if self._state != _DONE:
+            raise ValueError("Truncated JSON document")
+        return events
+
+    def _skip_whitespace(self) -> bool:
+        buf, pos = self._buf, self._pos
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _decode_value(self, final: bool) -> Optional[tuple]:
+        buf, pos = self._buf, self._pos
+        available = len(buf) - pos
+        if not final and available < self._need:
+            return None
+        try:
+            value, end = self._decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            if self.max_value_bytes and available > self.max_value_bytes:
+                raise ValueError("JSON value exceeds the configured size limit")
+            self._need = 2 * available
+            return None
+        if end == len(buf) and not final and buf[pos] in _NUMBER_START:
+            # A number at the end of the buffer may continue in the next chunk.
+            self._need = available + 1
+            return None
+        self._need = 0
+        self._pos = end
+        return buf[pos:end], value
+
+    def _scan(self, events: list, final: bool) -> None:
+        while self._state != _DONE and self._skip_whitespace():
+            c = self._buf[self._pos]
+            state = self._state
+
+            if state == _OBJECT:
+                if c != "{":
+                    self._passthrough = True
+                    events.append(("raw", bytes(self._prefix)))
+                    self._prefix.clear()
+                    self._buf = ""
+                    self._pos = 0
+                    return
+                self._prefix.clear()
+                self._pos += 1
+                self._state = _KEY
+            elif state == _KEY:
+                if c == "}":
+                    self._pos += 1
+                    self._state = _DONE
+                    events.append(("end",))
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    return
+                self._key = decoded[1]
+                self._state = _COLON
+            elif state == _COLON:
+                self._expect(c, ":")
+                self._state = _VALUE
+            elif state == _VALUE:
+                if c == "[" and self._key == "entry":
+                    self._pos += 1
+                    self._state = _ENTRY
+                    events.append(("entry_start",))
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    return
+                events.append(("member", self._key, decoded[0], decoded[1]))
+                self._state = _AFTER_VALUE
+            elif state == _AFTER_VALUE:
+                self._pos += 1
+                if c == ",":
+                    self._state = _KEY
+                elif c == "}":
+                    self._state = _DONE
+                    events.append(("end",))
+                else:
+                    raise ValueError(f"Unexpected character {c!r} in JSON object")
+            elif state == _ENTRY:
+                if c == "]":
+                    self._pos += 1
+                    self._state = _AFTER_VALUE
+                    events.append(("entry_end",))
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    return
+                events.append(("entry", decoded[0], decoded[1]))
+                self._state = _AFTER_ENTRY
+            elif state == _AFTER_ENTRY:
+                self._pos += 1
+                if c == ",":
+                    self._state = _ENTRY
+                elif c == "]":
+                    self._state = _AFTER_VALUE
+                    events.append(("entry_end",))
+                else:
+                    raise ValueError(f"Unexpected character {c!r} in JSON array")
+
+    def _expect(self, c: str, expected: str) -> None:
+        if c != expected:
+            raise ValueError(f"Expected {expected!r}, found {c!r}")
+        self._pos += 1
+
+
+REDACTED_SECURITY = {
+    "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+    "code": "REDACTED",
+}
+
+
+class BundleSecurityFilter:
+    """Filter Bundle entries by `meta.security` while streaming.
+
+    Entries whose resource carries no allowed security code are dropped (or
+    reduced to a redacted stub), `total` is corrected for dropped entries and
+    written after the entries, and every kept entry is forwarded byte for
+    byte without being re-encoded. With `allowed_resources=None` every entry
+    is kept. `rewrite_links`, if given, is applied to the Bundle's `link`
+    array.
+    """
+
+    def __init__(self, allowed_resources: Optional[Iterable[str]], mode: str = "drop", max_entry_bytes: int = 0,
+                 rewrite_links: Optional[Callable[[Any], Any]] = None) -> None:
+        self.allowed_resources = compile_matcher(allowed_resources) if allowed_resources is not None else None
+        self.rewrite_links = rewrite_links
+        self.redact = mode == "redact"
+        self.max_entry_bytes = max_entry_bytes
+        self.kept = 0
+        self.dropped = 0
+        self.redacted = 0
+        self._opened = False
+        self._entries_open = False
+        self._is_bundle: Optional[bool] = None
+        self._total: Any = None
+
+    async def filter(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        scanner = BundleScanner(self.max_entry_bytes)
+        async for chunk in chunks:
+            out = self._render(scanner.feed(chunk))
+            if out:
+                yield out
+        out = self._render(scanner.close())
+        if out:
+            yield out
+
+    def _render(self, events: list) -> bytes:
+        out = bytearray()
+        for event in events:
+            kind = event[0]
+            if kind == "member":
+                _, name, text, value = event
+                if name == "resourceType":
+                    self._is_bundle = value == "Bundle"
+                if name == "total" and self._is_bundle is not False:
+                    self._total = value
+                    continue
+                if name == "link" and self.rewrite_links is not None and self._is_bundle is not False:
+                    self._write_member(out, name, dumps(self.rewrite_links(value)))
+                    continue
+                self._write_member(out, name, text.encode())
+            elif kind == "entry":
+                entry = self._check_entry(event[1], event[2])
+                if entry is None:
+                    continue
+                if self._entries_open:
+                    out += b","
+                else:
+                    self._write_key(out, "entry")
+                    out += b"["
+                    self._entries_open = True
+                out += entry
+            elif kind == "entry_end":
+                if self._entries_open:
+                    out += b"]"
+                    self._entries_open = False
+            elif kind == "end":
+                if self._total is not None:
+                    self._write_member(out, "total", dumps(self._corrected_total()))
+                if not self._opened:
+                    out += b"{"
+                out += b"}"
+            elif kind == "raw":
+                out += event[1]
+        return bytes(out)
+
+    def _write_key(self, out: bytearray, name: str) -> None:
+        out += b"," if self._opened else b"{"
+        self._opened = True
+        out += dumps(name) + b":"
+
+    def _write_member(self, out: bytearray, name: str, raw: bytes) -> None:
+        self._write_key(out, name)
+        out += raw
+
+    def _check_entry(self, text: str, entry: Any) -> Optional[bytes]:
+        if self._is_bundle is False:
+            return text.encode()
+        resource = entry.get("resource") if isinstance(entry, dict) else None
+        # An export file's `data` is the unfiltered export, whatever its tags.
+        if not is_export_file(resource) and (
+                self.allowed_resources is None or resource_allowed(resource, self.allowed_resources)):
+            self.kept += 1
+            return text.encode()
+        if self.redact:
+            self.redacted += 1
+            return dumps(redacted_entry(entry))
+        self.dropped += 1
+        return None
+
+    def _corrected_total(self) -> Any:
+        total = self._total
+        if not isinstance(total, int) or isinstance(total, bool):
+            return total
+        return max(total - self.dropped, 0)
+
+
+def redacted_entry(entry: dict) -> dict:
+    resource = entry.get("resource") or {}
+    stub = {"resourceType": resource.get("resourceType"), "meta": {"security": [REDACTED_SECURITY]}}
+    if "id" in resource:
+        stub["id"] = resource["id"]
+    redacted = {key: entry[key] for key in ("fullUrl", "search") if key in entry}
+    redacted["resource"] = stub
+    return redacted
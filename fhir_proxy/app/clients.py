@@ -0,0 +1,133 @@
+import os
+import ssl
+from functools import lru_cache
+from typing import Optional
+
+import certifi
+import httpx
+from .config import settings
+
+# Shared, pooled upstream clients. They are opened in the app lifespan and
+# reused by every request so connections to HAPI and Gen3 stay warm instead
+# of paying a TCP/TLS handshake per proxied call.
+
+HAPI = "hapi"
+GEN3 = "gen3"
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_transports: dict[str, httpx.AsyncBaseTransport] = {}
+
+
+def _client_options(name: str) -> dict:
+    if name == HAPI:
+        return {
+            "headers": {"Accept-Encoding": settings.UPSTREAM_ACCEPT_ENCODING},
+            "timeout": httpx.Timeout(settings.PROXY_TIMEOUT, connect=settings.HAPI_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=settings.HAPI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HAPI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.HAPI_KEEPALIVE_EXPIRY,
+            ),
+        }
+    if name == GEN3:
+        return {
+            "timeout": httpx.Timeout(settings.ARBORIST_TIMEOUT, connect=settings.GEN3_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=settings.GEN3_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GEN3_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.GEN3_KEEPALIVE_EXPIRY,
+            ),
+        }
+    raise KeyError(f"Unknown upstream: {name}")
+
+
+@lru_cache(maxsize=None)
+def ssl_context() -> ssl.SSLContext:
+    """One TLS context for every upstream client.
+
+    Loading the CA bundle is most of what creating a client costs, so the
+    clients share it instead of each loading its own at worker boot.
+    """
+    return ssl.create_default_context(cafile=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+                                      capath=os.environ.get("SSL_CERT_DIR"))
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        # Normally created in the lifespan; created lazily when the app is
+        # driven without lifespan events (e.g. ASGITransport in tests).
+        transport = _transports.get(name)
+        if transport is not None:
+            client = httpx.AsyncClient(transport=transport, **_client_options(name))
+        else:
+            client = httpx.AsyncClient(http2=settings.UPSTREAM_HTTP2, verify=ssl_context(), **_client_options(name))
+        _clients[name] = client
+    return client
+
+
+def set_transport(name: str, transport: Optional[httpx.AsyncBaseTransport]) -> None:
+    """Route an upstream through a custom transport, e.g. an in-process stand-in.
+
+    Takes effect for clients created afterwards; pass None to go back to the
+    network.
+    """
+    if transport is None:
+        _transports.pop(name, None)
+    else:
+        _transports[name] = transport
+
+
+def get_hapi_client() -> httpx.AsyncClient:
+    return get_client(HAPI)
+
+
+def get_gen3_client() -> httpx.AsyncClient:
+    return get_client(GEN3)
+
+
+async def open_clients() -> None:
+    for name in (HAPI, GEN3):
+        get_client(name)
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+def _pool_usage(client: httpx.AsyncClient) -> dict:
+    # httpx does not expose pool usage publicly, so it is read from the
+    # private httpcore connection pool. Custom transports have none, and
+    # other httpcore versions may lay it out differently: report no usage
+    # then rather than failing the stats.
+    try:
+        pool = client._transport._pool
+        connections = list(pool.connections)
+        pending = list(pool._requests)
+        queued = sum(1 for req in pending if req.is_queued())
+        idle = sum(1 for conn in connections if conn.is_idle())
+    except Exception:
+        return {}
+    return {
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "in_flight": len(pending) - queued,
+        "queued": queued,
+    }
+
+
+def pool_stats() -> dict:
+    stats = {}
+    for name, client in _clients.items():
+        options = _client_options(name)
+        stats[name] = {
+            **_pool_usage(client),
+            "max_connections": options["limits"].max_connections,
+            "max_keepalive_connections": options["limits"].max_keepalive_connections,
+            "closed": client.is_closed,
+        }
+    return stats
@@ -0,0 +1,175 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+from .config import settings
+from .streaming import UpstreamResult
+
+# Coalescing of identical concurrent upstream requests.
+#
+# The first request for a key becomes the leader: its upstream fetch runs in
+# a task of its own and every request arriving with the same key while that
+# fetch is in flight subscribes to it instead of going upstream. Buffered
+# bodies are shared as they are; streamed bodies are broadcast chunk by
+# chunk, so the leader is not held back by waiting for the whole body.
+#
+# Chunks are retained for late subscribers until the body passes
+# `max_replay_bytes`. From then on the flight takes no new subscribers and
+# chunks every subscriber has consumed are released.
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.head: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.head.add_done_callback(_retrieve)
+        self.task: Optional[asyncio.Task] = None
+        self.chunks: deque = deque()
+        self.base = 0
+        self.size = 0
+        self.joinable = True
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._positions: dict[int, int] = {}
+        self._next_id = 0
+        self._changed = asyncio.Event()
+
+    def join(self) -> int:
+        sid = self._next_id
+        self._next_id += 1
+        self._positions[sid] = 0
+        return sid
+
+    def leave(self, sid: int) -> None:
+        self._positions.pop(sid, None)
+        if not self._positions and not self.done and self.task is not None:
+            # Every subscriber went away; nobody is left to read the body.
+            self.joinable = False
+            self.task.cancel()
+        self._trim()
+
+    def push(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self) -> None:
+        if self.joinable:
+            return
+        low = min(self._positions.values(), default=self.base + len(self.chunks))
+        while self.base < low and self.chunks:
+            self.chunks.popleft()
+            self.base += 1
+
+    async def subscribe(self, sid: int) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                pos = self._positions[sid]
+                if pos < self.base + len(self.chunks):
+                    chunk = self.chunks[pos - self.base]
+                    self._positions[sid] = pos + 1
+                    self._trim()
+                    yield chunk
+                elif self.done:
+                    if self.error is not None:
+                        raise RuntimeError("Shared upstream response failed") from self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.leave(sid)
+
+
+def _retrieve(future: asyncio.Future) -> None:
+    # Mark the exception as retrieved; subscribers re-raise it themselves.
+    if not future.cancelled():
+        future.exception()
+
+
+class RequestCoalescer:
+    def __init__(self, max_replay_bytes: int) -> None:
+        self.max_replay_bytes = max_replay_bytes
+        self._flights: dict[Hashable, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.errors = 0
+        self.cancelled = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: Hashable, fetch: Callable[[], Awaitable[UpstreamResult]]) -> UpstreamResult:
+        flight = self._flights.get(key)
+        if flight is None or not flight.joinable:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(self._produce(key, flight, fetch))
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        sid = flight.join()
+        try:
+            result = await asyncio.shield(flight.head)
+        except BaseException:
+            flight.leave(sid)
+            raise
+        if result.stream is None:
+            flight.leave(sid)
+            return result
+        return UpstreamResult(result.status_code, result.headers, stream=flight.subscribe(sid))
+
+    async def _produce(self, key: Hashable, flight: _Flight, fetch: Callable[[], Awaitable[UpstreamResult]]) -> None:
+        result = None
+        try:
+            result = await fetch()
+            flight.head.set_result(result)
+            if result.stream is not None:
+                async for chunk in result.stream:
+                    flight.push(chunk)
+                    if flight.joinable and flight.size > self.max_replay_bytes:
+                        flight.joinable = False
+                        self._release(key, flight)
+            flight.finish()
+        except asyncio.CancelledError as exc:
+            self.cancelled += 1
+            if not flight.head.done():
+                flight.head.cancel()
+            flight.finish(exc)
+            raise
+        except Exception as exc:
+            self.errors += 1
+            if not flight.head.done():
+                flight.head.set_exception(exc)
+            flight.finish(exc)
+        finally:
+            self._release(key, flight)
+            if result is not None and result.stream is not None:
+                await result.stream.aclose()
+
+    def _release(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def reset(self) -> None:
+        self.leaders = self.followers = self.errors = self.cancelled = 0
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+        }
+
+
+coalescer = RequestCoalescer(max_replay_bytes=settings.COALESCE_MAX_REPLAY_BYTES)
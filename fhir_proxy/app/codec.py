@@ -0,0 +1,43 @@
+import json
+from typing import Any, Callable, Union
+
+from .config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is a declared dependency
+    orjson = None
+
+# Pluggable JSON codec for request/response bodies. orjson is used when it
+# is installed, otherwise the stdlib encoder with the same compact output.
+
+
+class Codec:
+    def __init__(self, name: str, loads: Callable[[Union[bytes, str]], Any], dumps: Callable[[Any], bytes]):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+CODECS: dict[str, Codec] = {"json": Codec("json", json.loads, _json_dumps)}
+if orjson is not None:
+    CODECS["orjson"] = Codec("orjson", orjson.loads, orjson.dumps)
+
+
+def get_codec(name: str) -> Codec:
+    return CODECS.get(name) or CODECS["json"]
+
+
+codec = get_codec(settings.JSON_CODEC)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    return codec.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    return codec.dumps(obj)
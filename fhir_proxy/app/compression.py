@@ -0,0 +1,251 @@
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from .config import settings
+from .metrics import record_wire_bytes
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# Content-Encoding towards the client. Responses are compressed on the fly
+# with the best encoding the client accepts, in COMPRESSION_ENCODINGS order,
+# once they reach COMPRESSION_MIN_SIZE bytes; smaller ones go out as they
+# are. Upstream responses the proxy passes through without looking at the
+# body keep the encoding HAPI FHIR sent them with and are only decoded here
+# when the client does not accept it. Streamed bodies are flushed chunk by
+# chunk, so a client sees each Bundle entry or NDJSON line as it would
+# without compression. A strong ETag is weakened on a body whose encoding
+# the proxy changed.
+
+COMPRESSIBLE_TYPES = ("json", "xml", "text/", "ndjson", "javascript")
+SKIP_STATUSES = {204, 304}
+
+
+def supported_encodings() -> tuple[str, ...]:
+    return ("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate")
+
+
+def accepted_encodings(accept_encoding: str) -> dict[str, float]:
+    """`Accept-Encoding` as {coding: q}."""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def accepts(accepted: dict[str, float], encoding: str) -> bool:
+    if encoding == "identity":
+        return accepted.get("identity", accepted.get("*", 1.0)) > 0
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """The preferred configured encoding the client accepts, if any."""
+    accepted = accepted_encodings(accept_encoding)
+    supported = supported_encodings()
+    best, best_q = None, 0.0
+    for encoding in settings.COMPRESSION_ENCODINGS:
+        encoding = encoding.strip().lower()
+        if encoding not in supported:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressible(headers: Headers, status: int) -> bool:
+    if status in SKIP_STATUSES or "content-range" in headers:
+        return False
+    content_type = headers.get("content-type", "").lower()
+    return any(kind in content_type for kind in COMPRESSIBLE_TYPES)
+
+
+class StreamCompressor:
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=settings.BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            wbits = 31 if encoding == "gzip" else 15
+            self._brotli = None
+            self._zlib = zlib.compressobj(settings.GZIP_LEVEL, zlib.DEFLATED, wbits)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """Compress `data`; with `flush`, everything so far can be decoded by the client."""
+        if self._brotli is not None:
+            out = self._brotli.process(data) if data else b""
+            return out + self._brotli.flush() if flush else out
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+class StreamDecompressor:
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self._brotli = brotli.Decompressor()
+            self._zlib = None
+        else:
+            # gzip, or zlib-wrapped deflate.
+            self._brotli = None
+            self._zlib = zlib.decompressobj(31 if encoding == "gzip" else 15)
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) if data else b""
+        return self._zlib.decompress(data)
+
+    def finish(self) -> bytes:
+        return self._zlib.flush() if self._zlib is not None else b""
+
+
+def decompressor(encoding: str) -> Optional[StreamDecompressor]:
+    return StreamDecompressor(encoding) if encoding in supported_encodings() else None
+
+
+def decode_body(content: bytes, encoding: str) -> bytes:
+    """A whole body in a Content-Encoding, decoded."""
+    if not encoding or encoding == "identity":
+        return content
+    decoder = StreamDecompressor(encoding)
+    return decoder.decompress(content) + decoder.finish()
+
+
+def add_vary(headers: MutableHeaders, name: str) -> None:
+    vary = headers.get("vary", "")
+    if name.lower() not in vary.lower():
+        headers["vary"] = f"{vary}, {name}" if vary else name
+
+
+def weaken_etag(headers: MutableHeaders) -> None:
+    """A strong ETag names exact bytes; a re-encoded body only keeps it as a weak one."""
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["etag"] = f"W/{etag}"
+
+
+class _EncodingResponder:
+    """Re-encodes one response body between the app and the client."""
+
+    def __init__(self, send, accept_encoding: str) -> None:
+        self.send = send
+        self.accepted = accepted_encodings(accept_encoding)
+        self.target = negotiate(accept_encoding)
+        self.start: Optional[dict] = None
+        self.wire_encoding = "identity"
+        self.decoder: Optional[StreamDecompressor] = None
+        self.compressor: Optional[StreamCompressor] = None
+        # Whether the body sent depends on the client's Accept-Encoding.
+        self.vary = False
+        self.pending: list[bytes] = []
+        self.pending_size = 0
+
+    async def __call__(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self._begin(message)
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.decoder is not None:
+            body = self.decoder.decompress(body)
+            if not more_body:
+                body += self.decoder.finish()
+
+        if self.start is not None:
+            if self.target is not None and more_body and self.pending_size + len(body) < settings.COMPRESSION_MIN_SIZE:
+                # Not sure yet whether the body is worth compressing.
+                self.pending.append(body)
+                self.pending_size += len(body)
+                return
+            if self.pending:
+                body = b"".join(self.pending) + body
+                self.pending = []
+            await self._send_start(compress=self.target is not None and len(body) >= settings.COMPRESSION_MIN_SIZE)
+
+        if self.compressor is not None:
+            body = self.compressor.compress(body, flush=more_body and bool(body))
+            if not more_body:
+                body += self.compressor.finish()
+            if not body and more_body:
+                return
+        record_wire_bytes("client", self.wire_encoding, len(body))
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def _begin(self, message: dict) -> None:
+        self.start = message
+        headers = Headers(raw=message["headers"])
+        encoding = headers.get("content-encoding", "identity").strip().lower()
+        if encoding != "identity":
+            if accepts(self.accepted, encoding):
+                # Passed through as HAPI FHIR sent it; decoded for other clients.
+                self.wire_encoding = encoding
+                self.target = None
+                self.vary = decompressor(encoding) is not None
+                return
+            self.decoder = decompressor(encoding)
+            if self.decoder is None:
+                self.wire_encoding = encoding
+                self.target = None
+                return
+            self.vary = True
+        if compressible(headers, message["status"]):
+            # Other clients may get this body compressed.
+            self.vary = True
+        else:
+            self.target = None
+
+    async def _send_start(self, compress: bool) -> None:
+        message, self.start = self.start, None
+        headers = MutableHeaders(raw=list(message["headers"]))
+        if self.decoder is not None:
+            del headers["content-encoding"]
+            del headers["content-length"]
+            weaken_etag(headers)
+        if self.vary:
+            add_vary(headers, "Accept-Encoding")
+        if compress:
+            self.compressor = StreamCompressor(self.target)
+            self.wire_encoding = self.target
+            headers["content-encoding"] = self.target
+            del headers["content-length"]
+            weaken_etag(headers)
+        await self.send({**message, "headers": headers.raw})
+
+
+class CompressionMiddleware:
+    """Negotiate the Content-Encoding of every response with the client."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not settings.COMPRESS_RESPONSES:
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        await self.app(scope, receive, _EncodingResponder(send, accept_encoding))
@@ -1,22 +1,188 @@
+import logging
+import os
+from urllib.parse import urlparse
+
 from starlette.config import Config
+from starlette.datastructures import CommaSeparatedStrings
 
 config = Config(".env")
 
 class Settings:
-    
+
     ARBORIST_URL = config("ARBORIST_URL", default="http://localhost:8081/auth/resources")
     ARBORIST_TIMEOUT = config("ARBORIST_TIMEOUT", cast=int, default=5)
 
-    
+
     HAPI_FHIR_URL = config("HAPI_FHIR_URL", default="http://localhost:8080/fhir")
+    PUBLIC_BASE_URL = config("PUBLIC_BASE_URL", default="")
     SECURITY_TAG_PREFIX = config("SECURITY_TAG_PREFIX", default="gen3|")
+    SECURITY_FRAGMENT_CACHE_SIZE = config("SECURITY_FRAGMENT_CACHE_SIZE", cast=int, default=1024)
+    SECURITY_MATCHER_CACHE_SIZE = config("SECURITY_MATCHER_CACHE_SIZE", cast=int, default=256)
+    MAX_URL_LENGTH = config("MAX_URL_LENGTH", cast=int, default=8000)
+
+
+    RESPONSE_CACHE_ENABLED = config("RESPONSE_CACHE_ENABLED", cast=bool, default=False)
+    RESPONSE_CACHE_TYPES = config("RESPONSE_CACHE_TYPES", cast=CommaSeparatedStrings, default="")
+    RESPONSE_CACHE_TTL = config("RESPONSE_CACHE_TTL", cast=float, default=60.0)
+    RESPONSE_CACHE_MAX_BYTES = config("RESPONSE_CACHE_MAX_BYTES", cast=int, default=256 * 1024 * 1024)
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = config("RESPONSE_CACHE_MAX_ENTRY_BYTES", cast=int, default=8 * 1024 * 1024)
+    RESPONSE_CACHE_DIR = config("RESPONSE_CACHE_DIR", default="")
+    RESPONSE_CACHE_DISK_MAX_BYTES = config("RESPONSE_CACHE_DISK_MAX_BYTES", cast=int, default=1024 * 1024 * 1024)
+
+    CACHE_BACKEND = config("CACHE_BACKEND", default="")
+    SHARED_CACHE_PATH = config("SHARED_CACHE_PATH", default="/dev/shm/fhir-proxy-cache")
+    SHARED_CACHE_BYTES = config("SHARED_CACHE_BYTES", cast=int, default=32 * 1024 * 1024)
+    SHARED_CACHE_SLOTS = config("SHARED_CACHE_SLOTS", cast=int, default=16384)
+
 
-    
     PROXY_TIMEOUT = config("PROXY_TIMEOUT", cast=float, default=30.0)
+    JSON_CODEC = config("JSON_CODEC", default="orjson")
+    STREAM_RESPONSES = config("STREAM_RESPONSES", cast=bool, default=True)
+    BUNDLE_SECURITY_FILTER = config("BUNDLE_SECURITY_FILTER", cast=bool, default=True)
+    BUNDLE_FILTER_MODE = config("BUNDLE_FILTER_MODE", default="drop")
+    BUNDLE_FILTER_MAX_ENTRY_BYTES = config("BUNDLE_FILTER_MAX_ENTRY_BYTES", cast=int, default=64 * 1024 * 1024)
+    REWRITE_BUNDLE_LINKS = config("REWRITE_BUNDLE_LINKS", cast=bool, default=True)
+    PREFETCH_NEXT_PAGE = config("PREFETCH_NEXT_PAGE", cast=bool, default=False)
+    PREFETCH_MAX_PAGES = config("PREFETCH_MAX_PAGES", cast=int, default=256)
+    PREFETCH_TTL = config("PREFETCH_TTL", cast=float, default=30.0)
+    PREFETCH_MAX_PAGE_BYTES = config("PREFETCH_MAX_PAGE_BYTES", cast=int, default=16 * 1024 * 1024)
+    COALESCE_REQUESTS = config("COALESCE_REQUESTS", cast=bool, default=True)
+    COALESCE_MAX_REPLAY_BYTES = config("COALESCE_MAX_REPLAY_BYTES", cast=int, default=8 * 1024 * 1024)
+    METRICS_ENABLED = config("METRICS_ENABLED", cast=bool, default=True)
+    SERVER_TIMING = config("SERVER_TIMING", cast=bool, default=False)
+    BATCH_ENABLED = config("BATCH_ENABLED", cast=bool, default=True)
+    BATCH_MODE = config("BATCH_MODE", default="fanout")
+    BATCH_CONCURRENCY = config("BATCH_CONCURRENCY", cast=int, default=10)
+    BATCH_MAX_ENTRIES = config("BATCH_MAX_ENTRIES", cast=int, default=200)
+    STREAM_UPLOADS = config("STREAM_UPLOADS", cast=bool, default=True)
+    MAX_REQUEST_BODY_BYTES = config("MAX_REQUEST_BODY_BYTES", cast=int, default=1024 * 1024 * 1024)
+    VALIDATE_UPLOAD_SECURITY = config("VALIDATE_UPLOAD_SECURITY", cast=bool, default=False)
+    ADMIN_TOKEN = config("ADMIN_TOKEN", default="")
+    PROFILE_SAMPLE_RATE = config("PROFILE_SAMPLE_RATE", cast=float, default=0.1)
+    PROFILE_TRACEMALLOC_FRAMES = config("PROFILE_TRACEMALLOC_FRAMES", cast=int, default=1)
+    PROFILE_TOP = config("PROFILE_TOP", cast=int, default=50)
+    RESOLVE_ENABLED = config("RESOLVE_ENABLED", cast=bool, default=True)
+    RESOLVE_BATCH_SIZE = config("RESOLVE_BATCH_SIZE", cast=int, default=100)
+    RESOLVE_MAX_RESOURCES = config("RESOLVE_MAX_RESOURCES", cast=int, default=1000)
+
 
-    
     GEN_USER_URL = config("GEN3_USER_URL", default="https://qa.planx-pla.net/user/user")
 
+
+    UPSTREAM_HTTP2 = config("UPSTREAM_HTTP2", cast=bool, default=True)
+    UPSTREAM_ACCEPT_ENCODING = config("UPSTREAM_ACCEPT_ENCODING", default="gzip")
+
+    COMPRESS_RESPONSES = config("COMPRESS_RESPONSES", cast=bool, default=True)
+    COMPRESSION_ENCODINGS = config("COMPRESSION_ENCODINGS", cast=CommaSeparatedStrings, default="br,gzip")
+    COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", cast=int, default=1024)
+    GZIP_LEVEL = config("GZIP_LEVEL", cast=int, default=6)
+    BROTLI_QUALITY = config("BROTLI_QUALITY", cast=int, default=4)
+
+    HAPI_MAX_CONNECTIONS = config("HAPI_MAX_CONNECTIONS", cast=int, default=100)
+    HAPI_MAX_KEEPALIVE_CONNECTIONS = config("HAPI_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=20)
+    HAPI_KEEPALIVE_EXPIRY = config("HAPI_KEEPALIVE_EXPIRY", cast=float, default=30.0)
+    HAPI_CONNECT_TIMEOUT = config("HAPI_CONNECT_TIMEOUT", cast=float, default=5.0)
+
+    GEN3_MAX_CONNECTIONS = config("GEN3_MAX_CONNECTIONS", cast=int, default=50)
+    GEN3_MAX_KEEPALIVE_CONNECTIONS = config("GEN3_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=10)
+    GEN3_KEEPALIVE_EXPIRY = config("GEN3_KEEPALIVE_EXPIRY", cast=float, default=30.0)
+    GEN3_CONNECT_TIMEOUT = config("GEN3_CONNECT_TIMEOUT", cast=float, default=5.0)
+
+    UPSTREAM_LIMIT_ENABLED = config("UPSTREAM_LIMIT_ENABLED", cast=bool, default=True)
+    UPSTREAM_LIMIT_INITIAL = config("UPSTREAM_LIMIT_INITIAL", cast=int, default=20)
+    UPSTREAM_LIMIT_MIN = config("UPSTREAM_LIMIT_MIN", cast=int, default=2)
+    UPSTREAM_QUEUE_SIZE = config("UPSTREAM_QUEUE_SIZE", cast=int, default=500)
+    UPSTREAM_QUEUE_TIMEOUT = config("UPSTREAM_QUEUE_TIMEOUT", cast=float, default=10.0)
+    UPSTREAM_LATENCY_TOLERANCE = config("UPSTREAM_LATENCY_TOLERANCE", cast=float, default=2.0)
+    UPSTREAM_LIMIT_BACKOFF = config("UPSTREAM_LIMIT_BACKOFF", cast=float, default=0.9)
+
+    CIRCUIT_BREAKER_ENABLED = config("CIRCUIT_BREAKER_ENABLED", cast=bool, default=True)
+    CIRCUIT_BREAKER_WINDOW = config("CIRCUIT_BREAKER_WINDOW", cast=int, default=50)
+    CIRCUIT_BREAKER_MIN_CALLS = config("CIRCUIT_BREAKER_MIN_CALLS", cast=int, default=20)
+    CIRCUIT_BREAKER_FAILURE_RATE = config("CIRCUIT_BREAKER_FAILURE_RATE", cast=float, default=0.5)
+    CIRCUIT_BREAKER_SLOW_CALL_RATE = config("CIRCUIT_BREAKER_SLOW_CALL_RATE", cast=float, default=0.8)
+    CIRCUIT_BREAKER_OPEN_SECONDS = config("CIRCUIT_BREAKER_OPEN_SECONDS", cast=float, default=30.0)
+    CIRCUIT_BREAKER_HALF_OPEN_CALLS = config("CIRCUIT_BREAKER_HALF_OPEN_CALLS", cast=int, default=3)
+    HAPI_SLOW_CALL_SECONDS = config("HAPI_SLOW_CALL_SECONDS", cast=float, default=10.0)
+    GEN3_SLOW_CALL_SECONDS = config("GEN3_SLOW_CALL_SECONDS", cast=float, default=2.0)
+
+    HEDGE_REQUESTS = config("HEDGE_REQUESTS", cast=bool, default=False)
+    HEDGE_QUANTILE = config("HEDGE_QUANTILE", cast=float, default=0.95)
+    HEDGE_MIN_DELAY = config("HEDGE_MIN_DELAY", cast=float, default=0.05)
+    HEDGE_WINDOW = config("HEDGE_WINDOW", cast=int, default=1000)
+    HEDGE_MIN_SAMPLES = config("HEDGE_MIN_SAMPLES", cast=int, default=50)
+    HEDGE_MAX_RATIO = config("HEDGE_MAX_RATIO", cast=float, default=0.1)
+
+
+    AUTH_CACHE_ENABLED = config("AUTH_CACHE_ENABLED", cast=bool, default=True)
+    AUTH_CACHE_TTL = config("AUTH_CACHE_TTL", cast=float, default=300.0)
+    AUTH_CACHE_NEGATIVE_TTL = config("AUTH_CACHE_NEGATIVE_TTL", cast=float, default=10.0)
+    AUTH_CACHE_MAX_ENTRIES = config("AUTH_CACHE_MAX_ENTRIES", cast=int, default=10000)
+    AUTH_CACHE_MAX_BYTES = config("AUTH_CACHE_MAX_BYTES", cast=int, default=64 * 1024 * 1024)
+
+
+    JWKS_URL = config("JWKS_URL", default="")
+    JWT_ISSUER = config("JWT_ISSUER", default="")
+    JWT_AUDIENCE = config("JWT_AUDIENCE", default="")
+    JWT_ALGORITHMS = config("JWT_ALGORITHMS", cast=CommaSeparatedStrings, default="RS256")
+    JWKS_REFRESH_INTERVAL = config("JWKS_REFRESH_INTERVAL", cast=float, default=600.0)
+    JWKS_MIN_REFRESH_INTERVAL = config("JWKS_MIN_REFRESH_INTERVAL", cast=float, default=30.0)
+    JWT_VERIFIED_CACHE_SIZE = config("JWT_VERIFIED_CACHE_SIZE", cast=int, default=10000)
+
+URL_SETTINGS = ("HAPI_FHIR_URL", "ARBORIST_URL", "GEN_USER_URL")
+CHOICES = {
+    "BATCH_MODE": ("fanout", "upstream"),
+    "BUNDLE_FILTER_MODE": ("drop", "redact"),
+    "CACHE_BACKEND": ("", "local", "shm"),
+    "JSON_CODEC": ("json", "orjson"),
+}
+POSITIVE = (
+    "PROXY_TIMEOUT", "HAPI_MAX_CONNECTIONS", "GEN3_MAX_CONNECTIONS", "UPSTREAM_LIMIT_MIN", "UPSTREAM_QUEUE_TIMEOUT",
+    "CIRCUIT_BREAKER_WINDOW", "CIRCUIT_BREAKER_OPEN_SECONDS", "CIRCUIT_BREAKER_HALF_OPEN_CALLS", "HEDGE_WINDOW",
+    "BATCH_CONCURRENCY", "BATCH_MAX_ENTRIES", "RESOLVE_BATCH_SIZE", "RESOLVE_MAX_RESOURCES", "MAX_URL_LENGTH",
+    "SHARED_CACHE_BYTES", "SHARED_CACHE_SLOTS", "PROFILE_TRACEMALLOC_FRAMES",
+)
+NON_NEGATIVE = ("MAX_REQUEST_BODY_BYTES", "COMPRESSION_MIN_SIZE", "UPSTREAM_QUEUE_SIZE", "RESPONSE_CACHE_TTL")
+FRACTIONS = (
+    "CIRCUIT_BREAKER_FAILURE_RATE", "CIRCUIT_BREAKER_SLOW_CALL_RATE", "HEDGE_QUANTILE", "HEDGE_MAX_RATIO",
+    "UPSTREAM_LIMIT_BACKOFF", "PROFILE_SAMPLE_RATE",
+)
+# Names older deployments set that no setting reads any more.
+RENAMED = {"AUTH_SERVER_URL": "GEN3_USER_URL"}
+
+
+def validate_settings(settings: Settings) -> None:
+    """Check every setting once at startup instead of failing on the first request that uses it."""
+    errors = []
+    for name in URL_SETTINGS:
+        url = urlparse(getattr(settings, name))
+        if url.scheme not in ("http", "https") or not url.netloc:
+            errors.append(f"{name} must be an http(s) URL, got {getattr(settings, name)!r}")
+    if settings.PUBLIC_BASE_URL and urlparse(settings.PUBLIC_BASE_URL).scheme not in ("http", "https"):
+        errors.append(f"PUBLIC_BASE_URL must be an http(s) URL, got {settings.PUBLIC_BASE_URL!r}")
+    for name, choices in CHOICES.items():
+        if getattr(settings, name) not in choices:
+            errors.append(f"{name} must be one of {', '.join(repr(c) for c in choices)}, got {getattr(settings, name)!r}")
+    errors += [f"{name} must be greater than 0" for name in POSITIVE if getattr(settings, name) <= 0]
+    errors += [f"{name} must not be negative" for name in NON_NEGATIVE if getattr(settings, name) < 0]
+    errors += [f"{name} must be between 0 and 1" for name in FRACTIONS if not 0 <= getattr(settings, name) <= 1]
+    if not settings.UPSTREAM_LIMIT_MIN <= settings.UPSTREAM_LIMIT_INITIAL <= settings.HAPI_MAX_CONNECTIONS:
+        errors.append("UPSTREAM_LIMIT_INITIAL must be between UPSTREAM_LIMIT_MIN and HAPI_MAX_CONNECTIONS")
+    if not 0 <= settings.GZIP_LEVEL <= 9:
+        errors.append("GZIP_LEVEL must be between 0 and 9")
+    if not 0 <= settings.BROTLI_QUALITY <= 11:
+        errors.append("BROTLI_QUALITY must be between 0 and 11")
+    if errors:
+        raise ValueError("Invalid settings:\n  " + "\n  ".join(errors))
+
+    logger = logging.getLogger(__name__)
+    for old, new in RENAMED.items():
+        if old in os.environ:
+            logger.warning("%s is not read any more; set %s instead", old, new)
+    if settings.REWRITE_BUNDLE_LINKS and not settings.PUBLIC_BASE_URL:
+        logger.warning("PUBLIC_BASE_URL is not set; Bundle links will point at the Host header of each request")
+
+
 settings = Settings()
 
 ARBORIST_URL = settings.ARBORIST_URL
@@ -0,0 +1,121 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from .config import settings
+
+# Hedged upstream requests. An idempotent GET that has not answered within
+# the recent `quantile` latency gets a second, identical attempt; whichever
+# returns first is used and the other is cancelled. At most `max_ratio` of
+# requests are hedged, so a slow upstream sees a bounded amount of extra
+# load, and the caller can veto a hedge (e.g. when its concurrency limit
+# or circuit breaker says the upstream is already struggling).
+
+
+class Hedger:
+    def __init__(self, quantile: float, min_delay: float, window: int, min_samples: int, max_ratio: float) -> None:
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.reset()
+
+    def reset(self) -> None:
+        self._latencies: deque[float] = deque(maxlen=self.window)
+        self._delay: Optional[float] = None
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+
+    def record(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._delay = None
+
+    def delay(self) -> Optional[float]:
+        """The hedge delay, or None until enough latencies have been seen."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        if self._delay is None:
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, math.ceil(self.quantile * len(ordered)) - 1)
+            self._delay = max(self.min_delay, ordered[index])
+        return self._delay
+
+    def _within_budget(self) -> bool:
+        return self.hedged < self.max_ratio * self.requests
+
+    async def send(self, attempt: Callable[[], Awaitable[httpx.Response]],
+                   may_hedge: Callable[[], bool] = lambda: True) -> httpx.Response:
+        self.requests += 1
+        delay = self.delay()
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(attempt())
+        hedge = None
+        hedge_started = started
+        pending = {primary}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = None
+                if hedge is None and delay is not None:
+                    timeout = max(0.0, started + delay - time.perf_counter())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if self._within_budget() and may_hedge():
+                        hedge = asyncio.ensure_future(attempt())
+                        hedge_started = time.perf_counter()
+                        pending.add(hedge)
+                        self.hedged += 1
+                    else:
+                        delay = None
+                    continue
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        self.hedge_wins += 1
+                        self.record(time.perf_counter() - hedge_started)
+                    else:
+                        self.primary_wins += 1
+                        self.record(time.perf_counter() - started)
+                    for other in done - {task}:
+                        _discard(other)
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_discard)
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            "delay_ms": delay * 1000 if delay is not None else None,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+        }
+
+
+def _discard(task: asyncio.Future) -> None:
+    """Close the response of an attempt that lost the race."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    asyncio.ensure_future(task.result().aclose())
+
+
+hapi_hedger = Hedger(
+    quantile=settings.HEDGE_QUANTILE,
+    min_delay=settings.HEDGE_MIN_DELAY,
+    window=settings.HEDGE_WINDOW,
+    min_samples=settings.HEDGE_MIN_SAMPLES,
+    max_ratio=settings.HEDGE_MAX_RATIO,
+)
@@ -0,0 +1,363 @@
+"""Bulk-load Synthea or NCPI FHIR resources into a FHIR server.
+
+Run from the fhir_proxy directory:
+
+    python -m app.ingest synthea/output/fhir [--url http://localhost:8080/fhir]
+                         [--bundle-size 500] [--workers 8] [--security-code /programs/synthea]
+
+Files are read one at a time (`*.json` holding a resource or a Bundle, or
+`*.ndjson`) and their resources are spooled to one NDJSON file per type, so
+memory stays flat however large the population is. Types are then uploaded
+in dependency order as transaction (or batch) Bundles: types that do not
+depend on each other are uploaded together by a bounded pool of workers.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Iterator, Optional
+
+import httpx
+
+from .codec import dumps, loads
+from .config import settings
+
+# Resource types and the types they reference, following the ingestion order
+# documented in the README. Types not listed here are uploaded last.
+DEPENDENCIES: dict[str, tuple] = {
+    "Organization": (),
+    "Location": ("Organization",),
+    "Practitioner": (),
+    "PractitionerRole": ("Practitioner", "Organization", "Location"),
+    "Patient": ("Organization", "Practitioner"),
+    "Encounter": ("Patient", "Practitioner", "PractitionerRole", "Location", "Organization"),
+    "Condition": ("Patient", "Encounter"),
+    "Observation": ("Patient", "Encounter"),
+    "Medication": (),
+    "MedicationRequest": ("Patient", "Encounter", "Medication", "Practitioner"),
+    "CareTeam": ("Patient", "Encounter", "Practitioner", "Organization"),
+    "CarePlan": ("Patient", "Encounter", "CareTeam", "Condition"),
+}
+
+# Worth retrying as they are: the server was busy or the request conflicted
+# with a concurrent one.
+RETRY_STATUSES = {408, 409, 412, 429}
+
+URN_UUID = "urn:uuid:"
+
+
+def dependency_levels(types) -> list[list[str]]:
+    """Group resource types into levels that can be uploaded concurrently."""
+    present = set(types)
+    known = [t for t in DEPENDENCIES if t in present]
+    levels: dict[str, int] = {}
+
+    def level(resource_type: str) -> int:
+        if resource_type not in levels:
+            deps = DEPENDENCIES.get(resource_type)
+            if deps is None:
+                deps = known
+            levels[resource_type] = 1 + max((level(d) for d in deps if d in present and d != resource_type),
+                                            default=-1)
+        return levels[resource_type]
+
+    grouped: dict[int, list[str]] = defaultdict(list)
+    for resource_type in sorted(present):
+        grouped[level(resource_type)].append(resource_type)
+    return [grouped[i] for i in sorted(grouped)]
+
+
+def iter_resources(path: str) -> Iterator[dict]:
+    with open(path, "rb") as f:
+        if path.endswith(".ndjson"):
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+            return
+        data = loads(f.read())
+    if data.get("resourceType") == "Bundle" and data.get("type") != "document":
+        for entry in data.get("entry", []):
+            if isinstance(entry.get("resource"), dict):
+                yield entry["resource"]
+    else:
+        yield data
+
+
+def security_tags(codes) -> list[dict]:
+    system = settings.SECURITY_TAG_PREFIX.rstrip("|")
+    return [{"system": system, "code": code} for code in codes]
+
+
+def add_security(resource: dict, tags: list[dict]) -> None:
+    if not tags:
+        return
+    security = resource.setdefault("meta", {}).setdefault("security", [])
+    for tag in tags:
+        if not any(s.get("system") == tag["system"] and s.get("code") == tag["code"] for s in security):
+            security.append(dict(tag))
+
+
+def resolve_references(value: Any, ids: dict[str, str]) -> None:
+    """Turn Synthea's `urn:uuid:` references into `Type/id` references in place."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "reference" and isinstance(item, str) and item.startswith(URN_UUID):
+                value[key] = ids.get(item[len(URN_UUID):], item)
+            elif isinstance(item, (dict, list)):
+                resolve_references(item, ids)
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, (dict, list)):
+                resolve_references(item, ids)
+
+
+def to_entry(resource: dict) -> dict:
+    resource_type = resource["resourceType"]
+    if "id" in resource:
+        url = f"{resource_type}/{resource['id']}"
+        return {"fullUrl": url, "resource": resource, "request": {"method": "PUT", "url": url}}
+    return {"resource": resource, "request": {"method": "POST", "url": resource_type}}
+
+
+class Spool:
+    """Resources spooled to one NDJSON file per resource type."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.counts: dict[str, int] = defaultdict(int)
+        self.ids: dict[str, str] = {}
+        self._files: dict[str, Any] = {}
+
+    def add(self, resource: dict) -> None:
+        resource_type = resource.get("resourceType")
+        if not resource_type:
+            return
+        f = self._files.get(resource_type)
+        if f is None:
+            f = self._files[resource_type] = open(self._path(resource_type), "ab")
+        f.write(dumps(resource) + b"\n")
+        self.counts[resource_type] += 1
+        if "id" in resource:
+            self.ids[str(resource["id"])] = f"{resource_type}/{resource['id']}"
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def read(self, resource_type: str) -> Iterator[dict]:
+        with open(self._path(resource_type), "rb") as f:
+            for line in f:
+                resource = loads(line)
+                resolve_references(resource, self.ids)
+                yield resource
+
+    def _path(self, resource_type: str) -> str:
+        return os.path.join(self.directory, f"{resource_type}.ndjson")
+
+
+class Ingestor:
+    def __init__(self, client: httpx.AsyncClient, url: str, bundle_type: str = "transaction",
+                 bundle_size: int = 500, workers: int = 8, retries: int = 3, backoff: float = 1.0) -> None:
+        self.client = client
+        self.url = url
+        self.bundle_type = bundle_type
+        self.bundle_size = bundle_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.uploaded: dict[str, int] = defaultdict(int)
+        self.failures: dict[str, list] = defaultdict(list)
+        self.retried = 0
+        self.started = time.perf_counter()
+
+    @property
+    def total_uploaded(self) -> int:
+        return sum(self.uploaded.values())
+
+    @property
+    def total_failed(self) -> int:
+        return sum(len(f) for f in self.failures.values())
+
+    def rate(self) -> float:
+        return self.total_uploaded / max(time.perf_counter() - self.started, 1e-9)
+
+    async def run(self, spool: Spool) -> None:
+        for level in dependency_levels(spool.counts):
+            await self.upload_level({t: spool.read(t) for t in level})
+        if self.total_failed:
+            # Entries can fail because something they reference failed or was
+            # not there yet; give every failed entry one more round.
+            failures = {t: f for t, f in self.failures.items() if f}
+            self.failures = defaultdict(list)
+            for level in dependency_levels(failures):
+                await self.upload_level({t: (entry["resource"] for entry, _ in failures[t]) for t in level})
+
+    async def upload_level(self, sources: dict[str, Iterator[dict]]) -> None:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def produce(resource_type: str, resources: Iterator[dict]) -> None:
+            chunk = []
+            for resource in resources:
+                chunk.append(to_entry(resource))
+                if len(chunk) >= self.bundle_size:
+                    await queue.put((resource_type, chunk))
+                    chunk = []
+            if chunk:
+                await queue.put((resource_type, chunk))
+
+        async def work() -> None:
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    await self.upload_chunk(*item)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.ensure_future(work()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*(produce(t, r) for t, r in sources.items()))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def upload_chunk(self, resource_type: str, entries: list) -> None:
+        pending = entries
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += len(pending)
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                failed, retry = await self.post(pending)
+            except Exception as e:
+                # E.g. a batch response that is not a Bundle. The worker must
+                # keep draining the queue, or the producers block on it.
+                self.failures[resource_type].extend((entry, f"{type(e).__name__}: {e}") for entry in pending)
+                return
+            self.uploaded[resource_type] += len(pending) - len(failed) - len(retry)
+            self.failures[resource_type].extend(failed)
+            pending = [entry for entry, _ in retry]
+            if not pending:
+                return
+        self.failures[resource_type].extend(retry)
+
+    async def post(self, entries: list) -> tuple[list, list]:
+        """Upload one Bundle; return the (failed, retryable) entries with a reason."""
+        bundle = {"resourceType": "Bundle", "type": self.bundle_type, "entry": entries}
+        try:
+            resp = await self.client.post(self.url, content=dumps(bundle),
+                                          headers={"Content-Type": "application/fhir+json"})
+        except httpx.TransportError as e:
+            return [], [(entry, str(e)) for entry in entries]
+
+        if resp.status_code in RETRY_STATUSES or resp.status_code >= 500:
+            return [], [(entry, f"HTTP {resp.status_code}") for entry in entries]
+        if resp.is_error:
+            if self.bundle_type == "transaction" and len(entries) > 1:
+                # A transaction fails as a whole; split it to isolate the bad entries.
+                middle = len(entries) // 2
+                first, second = await asyncio.gather(self.post(entries[:middle]), self.post(entries[middle:]))
+                return first[0] + second[0], first[1] + second[1]
+            return [(entry, f"HTTP {resp.status_code}: {resp.text[:500]}") for entry in entries], []
+        if self.bundle_type != "batch":
+            return [], []
+
+        failed, retry = [], []
+        for entry, result in zip(entries, loads(resp.content).get("entry", [])):
+            status = str(result.get("response", {}).get("status", "200"))
+            code = int(status.split()[0]) if status.split()[0].isdigit() else 200
+            if code in RETRY_STATUSES or code >= 500:
+                retry.append((entry, status))
+            elif code >= 400:
+                failed.append((entry, status))
+        return failed, retry
+
+
+def spool_files(paths: list[str], spool: Spool, tags: list[dict]) -> int:
+    count = 0
+    for path in paths:
+        for resource in iter_resources(path):
+            add_security(resource, tags)
+            spool.add(resource)
+            count += 1
+    spool.close()
+    return count
+
+
+async def report_progress(ingestor: Ingestor, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(f"  {ingestor.total_uploaded} uploaded, {ingestor.total_failed} failed, "
+              f"{ingestor.rate():.0f} resources/s", flush=True)
+
+
+async def ingest(args) -> Ingestor:
+    paths = sorted(glob.glob(os.path.join(args.directory, "*.json")) +
+                   glob.glob(os.path.join(args.directory, "*.ndjson")))
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    with tempfile.TemporaryDirectory(prefix="fhir-ingest-") as spool_dir:
+        spool = Spool(spool_dir)
+        started = time.perf_counter()
+        count = await asyncio.to_thread(spool_files, paths, spool, security_tags(args.security_code))
+        print(f"Spooled {count} resources of {len(spool.counts)} types from {len(paths)} files "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        limits = httpx.Limits(max_connections=args.workers, max_keepalive_connections=args.workers)
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=args.timeout) as client:
+            ingestor = Ingestor(client, args.url, args.bundle_type, args.bundle_size,
+                                args.workers, args.retries, args.backoff)
+            progress = asyncio.ensure_future(report_progress(ingestor, args.progress))
+            try:
+                await ingestor.run(spool)
+            finally:
+                progress.cancel()
+    return ingestor
+
+
+def write_failures(ingestor: Ingestor, path: str) -> None:
+    with open(path, "wb") as f:
+        for resource_type, failures in ingestor.failures.items():
+            for entry, reason in failures:
+                f.write(dumps({"reason": reason, "resource": entry["resource"]}) + b"\n")
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="Directory of *.json / *.ndjson files")
+    parser.add_argument("--url", default=settings.HAPI_FHIR_URL, help="FHIR base URL")
+    parser.add_argument("--token", default="", help="Bearer token, e.g. when loading through the proxy")
+    parser.add_argument("--bundle-type", choices=("transaction", "batch"), default="transaction")
+    parser.add_argument("--bundle-size", type=int, default=500, help="Entries per Bundle")
+    parser.add_argument("--workers", type=int, default=8, help="Bundles uploaded concurrently")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=1.0, help="First retry delay in seconds")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--security-code", action="append", default=[],
+                        help="meta.security code to tag every resource with (repeatable)")
+    parser.add_argument("--progress", type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument("--failed-out", help="Write resources that could not be uploaded to this NDJSON file")
+    args = parser.parse_args(argv)
+
+    ingestor = asyncio.run(ingest(args))
+    elapsed = time.perf_counter() - ingestor.started
+    for resource_type in sorted(set(ingestor.uploaded) | set(ingestor.failures)):
+        print(f"{resource_type:>24} {ingestor.uploaded[resource_type]:>10} uploaded"
+              f" {len(ingestor.failures[resource_type]):>8} failed")
+    print(f"{ingestor.total_uploaded} resources in {elapsed:.1f}s ({ingestor.rate():.0f} resources/s), "
+          f"{ingestor.retried} retried, {ingestor.total_failed} failed")
+    if args.failed_out and ingestor.total_failed:
+        write_failures(ingestor, args.failed_out)
+    return 1 if ingestor.total_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from .config import settings
+
+# Adaptive concurrency limiting toward the upstreams.
+#
+# Each upstream gets a limit on concurrent requests that adapts to observed
+# latency (AIMD): while responses stay within `tolerance` times the lowest
+# recent latency and the limit is actually in use, it grows by one per
+# round of `limit` responses; when latency rises past that, or the upstream
+# times out or reports overload, it is cut by `backoff` (at most once per
+# round trip). Requests over the limit wait in a bounded priority queue so
+# cheap direct reads are served before heavy searches; when the queue is
+# full the lowest-priority waiter is shed with 503 and a Retry-After.
+
+PRIORITY_READ = 0
+PRIORITY_WRITE = 1
+PRIORITY_SEARCH = 2
+PRIORITY_PREFETCH = 3
+
+# Upstream answers that mean "too much load", treated like timeouts.
+OVERLOAD_STATUSES = {429, 503, 504}
+
+# Windows of samples after which the latency baseline may drift upward, so
+# a permanently slower upstream does not keep the limit pinned down.
+BASELINE_WINDOW = 100
+BASELINE_DRIFT = 0.05
+
+
+class Overloaded(Exception):
+    def __init__(self, upstream: str, retry_after: int) -> None:
+        super().__init__(f"{upstream} is overloaded")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class ClientFault(Exception):
+    """Raised inside a slot for a fault of the client's request, such as a
+    rejected upload; the call is not taken as a sample of upstream latency."""
+
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Permit:
+    __slots__ = ("limiter", "started", "dropped")
+
+    def __init__(self, limiter: Optional["AdaptiveLimiter"]) -> None:
+        self.limiter = limiter
+        self.started = time.perf_counter()
+        self.dropped = False
+
+    def release(self) -> None:
+        if self.limiter is not None:
+            limiter, self.limiter = self.limiter, None
+            limiter._release(time.perf_counter() - self.started, self.dropped)
+
+    def discard(self) -> None:
+        if self.limiter is not None:
+            limiter, self.limiter = self.limiter, None
+            limiter._release(None, False)
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, initial_limit: int, min_limit: int, max_limit: int, queue_size: int,
+                 queue_timeout: float, tolerance: float = 2.0, backoff: float = 0.9) -> None:
+        self.name = name
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.reset()
+
+    def reset(self) -> None:
+        self.limit = float(max(self.min_limit, min(self.initial_limit, self.max_limit)))
+        self.in_flight = 0
+        self.queued = 0
+        self.baseline: Optional[float] = None
+        self.smoothed: Optional[float] = None
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._window_min = math.inf
+        self._window_count = 0
+        self._last_decrease = 0.0
+        self.admitted = 0
+        self.waited = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.increases = 0
+        self.decreases = 0
+
+    # Admission ------------------------------------------------------------
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_SEARCH) -> AsyncIterator[Permit]:
+        if not settings.UPSTREAM_LIMIT_ENABLED:
+            yield Permit(None)
+            return
+        permit = await self.acquire(priority)
+        try:
+            yield permit
+        except ClientFault:
+            permit.discard()
+            raise
+        except Exception:
+            permit.dropped = True
+            raise
+        finally:
+            permit.release()
+
+    async def acquire(self, priority: int) -> Permit:
+        if self.in_flight < int(self.limit) and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return Permit(self)
+
+        if self.queued >= self.queue_size and not self._shed_below(priority):
+            self.shed += 1
+            raise Overloaded(self.name, self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.queued += 1
+        self.waited += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise Overloaded(self.name, self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just as the caller went away.
+                self._release(None, False)
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                self.queued -= 1
+        self.admitted += 1
+        return Permit(self)
+
+    def _shed_below(self, priority: int) -> bool:
+        """Make room by shedding the newest waiter of a lower priority."""
+        victim = None
+        for entry in self._waiters:
+            if not entry[2].done() and entry[0] > priority and (victim is None or entry[:2] > victim[:2]):
+                victim = entry
+        if victim is None:
+            return False
+        self.queued -= 1
+        self.shed += 1
+        victim[2].set_exception(Overloaded(self.name, self.retry_after()))
+        return True
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.queued -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _release(self, latency: Optional[float], dropped: bool) -> None:
+        if latency is not None:
+            self._adapt(latency, dropped)
+        self.in_flight -= 1
+        self._wake()
+
+    def has_capacity(self) -> bool:
+        return not settings.UPSTREAM_LIMIT_ENABLED or (self.in_flight < int(self.limit) and not self.queued)
+
+    # Adaptation -----------------------------------------------------------
+
+    def _adapt(self, latency: float, dropped: bool) -> None:
+        self.smoothed = latency if self.smoothed is None else 0.9 * self.smoothed + 0.1 * latency
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        self._window_min = min(self._window_min, latency)
+        self._window_count += 1
+        if self._window_count >= BASELINE_WINDOW:
+            self.baseline = min(self._window_min, self.baseline * (1 + BASELINE_DRIFT))
+            self._window_min = math.inf
+            self._window_count = 0
+
+        if dropped or latency > self.baseline * self.tolerance:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.smoothed:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self._last_decrease = now
+                self.decreases += 1
+        elif self.in_flight >= self.limit / 2 and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.increases += 1
+
+    def retry_after(self) -> int:
+        per_request = self.smoothed if self.smoothed is not None else 1.0
+        return max(1, math.ceil(per_request * (self.queued + 1) / max(self.limit, 1.0)))
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "baseline_ms": self.baseline * 1000 if self.baseline is not None else None,
+            "smoothed_ms": self.smoothed * 1000 if self.smoothed is not None else None,
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+hapi_limiter = AdaptiveLimiter(
+    "hapi",
+    initial_limit=settings.UPSTREAM_LIMIT_INITIAL,
+    min_limit=settings.UPSTREAM_LIMIT_MIN,
+    max_limit=settings.HAPI_MAX_CONNECTIONS,
+    queue_size=settings.UPSTREAM_QUEUE_SIZE,
+    queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT,
+    tolerance=settings.UPSTREAM_LATENCY_TOLERANCE,
+    backoff=settings.UPSTREAM_LIMIT_BACKOFF,
+)
+
+gen3_limiter = AdaptiveLimiter(
+    "gen3",
+    initial_limit=settings.UPSTREAM_LIMIT_INITIAL,
+    min_limit=settings.UPSTREAM_LIMIT_MIN,
+    max_limit=settings.GEN3_MAX_CONNECTIONS,
+    queue_size=settings.UPSTREAM_QUEUE_SIZE,
+    queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT,
+    tolerance=settings.UPSTREAM_LATENCY_TOLERANCE,
+    backoff=settings.UPSTREAM_LIMIT_BACKOFF,
+)
+
+
+def limiter_stats() -> dict:
+    return {"hapi": hapi_limiter.stats(), "gen3": gen3_limiter.stats()}
@@ -1,17 +1,230 @@
-from fastapi import FastAPI, Request, Header, HTTPException  
-from fastapi.responses import JSONResponse  
-import httpx  
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse  
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Optional
+from fastapi import Depends, FastAPI, Request, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+import httpx
 from .config import (
-    ARBORIST_URL,
-    ARBORIST_TIMEOUT,
     HAPI_FHIR_URL,
-    SECURITY_TAG_PREFIX,
-    PROXY_TIMEOUT,
-    GEN_USER_URL  
+    GEN_USER_URL,
+    settings,
+    validate_settings,
 )
+from .clients import open_clients, close_clients, get_hapi_client, get_gen3_client, pool_stats
+from .authcache import auth_cache
+from .auth import jwks_validator, require_admin, verify_token
+from .streaming import (
+    UpstreamResult,
+    iter_upstream,
+    is_json_response,
+    record_received,
+    response_headers,
+    upstream_encoding,
+)
+from .compression import CompressionMiddleware, decode_body
+from .breaker import breaker_stats, gen3_breaker, hapi_breaker
+from .batch import (
+    BatchEntry,
+    error_entry,
+    is_batch,
+    parse_entries,
+    response_bundle,
+    response_entry,
+    run_entries,
+    secure_response_entry,
+    upstream_entry,
+)
+from .bundlefilter import BundleSecurityFilter
+from .security import resource_allowed
+from .codec import dumps, loads
+from .scope import AccessScope
+from .responsecache import CachedResponse, cache_key, cacheable_headers, response_cache
+from .coalesce import coalescer
+from .bulkexport import (
+    NDJSONSecurityFilter,
+    is_export_file,
+    is_export_kickoff,
+    is_export_status,
+    is_ndjson,
+    rewrite_manifest,
+    to_proxy_url,
+)
+from .sharedcache import cache_backend
+from .references import (
+    add_included,
+    collect_references,
+    include_query,
+    include_searches,
+    matched_references,
+    revinclude_searches,
+    split_include_params,
+)
+from .uploads import UploadValidator, chain, check_content_length, peek_bundle_type, stream_upload
+from .paging import LinkRewriter, PrefetchedPage, prefetch_cache
+from .hedge import hapi_hedger
+from .limiter import (
+    OVERLOAD_STATUSES,
+    PRIORITY_PREFETCH,
+    PRIORITY_READ,
+    PRIORITY_SEARCH,
+    PRIORITY_WRITE,
+    ClientFault,
+    Overloaded,
+    gen3_limiter,
+    hapi_limiter,
+    limiter_stats,
+)
+from .metrics import MetricsMiddleware, record_upstream, registry, stage
+from .profiling import ProfilingMiddleware, profiler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    validate_settings(settings)
+    await open_clients()
+    await jwks_validator.start()
+    try:
+        yield
+    finally:
+        await jwks_validator.stop()
+        await close_clients()
+
 
-app = FastAPI()  
+# The HAPI client asks for UPSTREAM_ACCEPT_ENCODING itself; what the client
+# accepts is negotiated separately by CompressionMiddleware.
+NOT_FORWARDED = {"host", "content-length", "accept-encoding"}
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(CompressionMiddleware)
+# Added last so it is the outer one and counts the bytes the client gets.
+app.add_middleware(MetricsMiddleware)
+
+registry.register_stats("fhir_proxy_auth_cache", "Authorization cache", auth_cache.stats)
+registry.register_stats("fhir_proxy_response_cache", "Response cache", response_cache.stats)
+if cache_backend is not None:
+    registry.register_stats("fhir_proxy_shared_cache", "Shared cache tier", cache_backend.stats)
+registry.register_stats("fhir_proxy_coalescing", "Request coalescing", coalescer.stats)
+registry.register_stats("fhir_proxy_prefetch", "Next-page prefetching", prefetch_cache.stats)
+registry.register_stats("fhir_proxy_hapi_limiter", "HAPI concurrency limiter", hapi_limiter.stats)
+registry.register_stats("fhir_proxy_gen3_limiter", "Gen3 concurrency limiter", gen3_limiter.stats)
+registry.register_stats("fhir_proxy_hapi_breaker", "HAPI circuit breaker", hapi_breaker.stats)
+registry.register_stats("fhir_proxy_gen3_breaker", "Gen3 circuit breaker", gen3_breaker.stats)
+registry.register_stats("fhir_proxy_hapi_hedging", "HAPI hedged requests", hapi_hedger.stats)
+
+
+@app.exception_handler(ClientFault)
+async def client_fault_handler(request: Request, exc: ClientFault):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Upstream {exc.upstream} is unavailable, retry later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+################################################################################################
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/_proxy/pools", dependencies=[Depends(require_admin)])
+async def upstream_pools():
+    return pool_stats()
+
+
+@app.get("/_proxy/auth-cache", dependencies=[Depends(require_admin)])
+async def authorization_cache_stats():
+    return auth_cache.stats()
+
+
+@app.get("/_proxy/jwks", dependencies=[Depends(require_admin)])
+async def jwks_stats():
+    return jwks_validator.stats()
+
+
+@app.get("/_proxy/response-cache", dependencies=[Depends(require_admin)])
+async def response_cache_stats():
+    return response_cache.stats()
+
+
+@app.get("/_proxy/shared-cache", dependencies=[Depends(require_admin)])
+async def shared_cache_stats():
+    return cache_backend.stats() if cache_backend is not None else {"backend": None}
+
+
+@app.get("/_proxy/coalescing", dependencies=[Depends(require_admin)])
+async def coalescing_stats():
+    return coalescer.stats()
+
+
+@app.get("/_proxy/limits", dependencies=[Depends(require_admin)])
+async def upstream_limits():
+    return limiter_stats()
+
+
+@app.get("/_proxy/breakers", dependencies=[Depends(require_admin)])
+async def circuit_breakers():
+    return {**breaker_stats(), "hedging": hapi_hedger.stats()}
+
+
+@app.get("/_proxy/prefetch", dependencies=[Depends(require_admin)])
+async def prefetch_stats():
+    return prefetch_cache.stats()
+
+
+@app.get("/_proxy/profiling", dependencies=[Depends(require_admin)])
+async def profiling_status():
+    return profiler.stats()
+
+
+@app.post("/_proxy/profiling", dependencies=[Depends(require_admin)])
+async def start_profiling(cpu: bool = True, memory: bool = False, sample_rate: Optional[float] = None,
+                          path: str = "", resource_type: list[str] = Query([]), duration: float = 0):
+    if sample_rate is not None and not 0 <= sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be between 0 and 1")
+    try:
+        profiler.start(cpu, memory, sample_rate, path, resource_type, duration)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid path pattern: {e}")
+    return profiler.stats()
+
+
+@app.delete("/_proxy/profiling", dependencies=[Depends(require_admin)])
+async def stop_profiling(clear: bool = False):
+    if clear:
+        profiler.clear()
+    else:
+        profiler.stop()
+    return profiler.stats()
+
+
+@app.get("/_proxy/profiling/cpu", dependencies=[Depends(require_admin)])
+async def cpu_profile(resource_type: str = "", format: str = "pstats"):
+    if format == "text":
+        return PlainTextResponse(profiler.top_functions(resource_type or None))
+    data = profiler.cpu_profile(resource_type or None)
+    if data is None:
+        raise HTTPException(status_code=404, detail="No CPU profile collected")
+    return Response(content=data, media_type="application/octet-stream",
+                    headers={"Content-Disposition": f'attachment; filename="fhir-proxy-{resource_type or "all"}.prof"'})
+
+
+@app.get("/_proxy/profiling/memory", dependencies=[Depends(require_admin)])
+async def memory_profile(resource_type: str = "", limit: int = 0):
+    return {"peak_bytes": profiler.stats()["peak_bytes"],
+            "top": profiler.top_allocations(resource_type or None, limit)}
 
 
 ################################################################################################
@@ -21,80 +234,572 @@ app = FastAPI()
 async def proxy_fhir(path: str, request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Bearer token required")
-    
+
     token = authorization[len("Bearer "):]
 
+    with stage("auth"):
+        valid = await verify_token(token)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
 
     try:
-        allowed_resources = await get_gen3_allowed_resources(token)
+        with stage("gen3"):
+            scope = await get_access_scope(token)
     except httpx.HTTPStatusError:
         raise HTTPException(status_code=403, detail="Failed to fetch allowed resources from Gen3")
 
-  
-    original_url = f"{HAPI_FHIR_URL}/{path}"
-    if request.query_params:
-        original_url += "?" + str(request.query_params)
 
-    rewritten_url = rewrite_fhir_url(original_url, allowed_resources)
+    try:
+        query, includes, revincludes = split_include_params(request.url.query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    original_url = upstream_url(path, query)
+    resolve = request.method == "GET" and settings.RESOLVE_ENABLED and bool(includes or revincludes)
+
+    path_parts = path.strip("/").split("/")
+    if is_bulk_export(request, path_parts):
+        # HAPI does not take _security on $export; the exported files are
+        # filtered line by line when they are downloaded instead.
+        return await proxy_bulk_export(request, original_url, path_parts, token, scope)
+
+    max_body = settings.MAX_REQUEST_BODY_BYTES
+    body_chunks = request.stream()
+    body_head: list[bytes] = []
+    if request.method in ("POST", "PUT"):
+        check_content_length(request.headers.get("content-length"), max_body)
+    if request.method == "POST" and path_parts == [""] and settings.BATCH_ENABLED:
+        # Only batches are read whole; a transaction is known from its first
+        # chunk and streamed on like any other upload.
+        bundle_type, body_head = await peek_bundle_type(body_chunks, max_body)
+        if bundle_type == "batch":
+            content = b"".join([chunk async for chunk in stream_upload(chain(body_head, body_chunks), max_body)])
+            try:
+                bundle = loads(content)
+            except ValueError:
+                bundle = None
+            if is_batch(bundle):
+                return await proxy_batch(bundle, token, scope, public_base_url(request))
+            body_head, body_chunks = [content], None
+
+    with stage("rewrite"):
+        rewritten_url = rewrite_fhir_url(original_url, scope)
+
+    resource_type = path_parts[0]
+
+    # Bundle links are rewritten to the proxy base, which comes from the Host
+    # header unless PUBLIC_BASE_URL is set; it is part of every key a
+    # rewritten body is stored or shared under.
+    proxy_base = public_base_url(request)
+    response_key = None
+    cached = None
+    if request.method == "GET" and response_cacheable(resource_type) and not resolve:
+        with stage("cache"):
+            response_key = cache_key(rewritten_url, scope.digest, proxy_base)
+            cached = await response_cache.get(response_key)
+        if cached is not None and cached.is_fresh(settings.RESPONSE_CACHE_TTL):
+            response_cache.record_hit(cached)
+            return cached.to_response("HIT")
 
-    forward_headers = {k: v for k, v in request.headers.items() if k.lower() not in ["host", "content-length"]}
+    if request.method == "GET" and settings.PREFETCH_NEXT_PAGE and not resolve:
+        with stage("prefetch"):
+            page = await prefetch_cache.take((rewritten_url, scope.digest, proxy_base))
+        if page is not None:
+            if page.next_url:
+                prefetch_page(page.next_url, token, scope, proxy_base)
+            return page.result.to_response()
+
+    links = None
+    if request.method == "GET" and settings.REWRITE_BUNDLE_LINKS:
+        on_next = None
+        if settings.PREFETCH_NEXT_PAGE and not resolve:
+            on_next = partial(prefetch_page, token=token, scope=scope, proxy_base=proxy_base)
+        links = LinkRewriter(HAPI_FHIR_URL, proxy_base, scope.security_fragment, on_next,
+                             include_query(includes, revincludes) if resolve else "")
+
+    forward_headers = {k: v for k, v in request.headers.items() if k.lower() not in NOT_FORWARDED}
     forward_headers["Authorization"] = f"Bearer {token}"
     forward_headers["Accept"] = "application/fhir+json"
     forward_headers["Content-Type"] = "application/fhir+json"
+    if cached is not None:
+        forward_headers.pop("if-none-match", None)
+        forward_headers.pop("if-modified-since", None)
+        forward_headers.update(cached.conditional_headers())
 
+    method = request.method
     body = None
-    if request.method in ("POST", "PUT"):
-        body = await request.body()
+    if method in ("POST", "PUT"):
+        validator = None
+        if settings.VALIDATE_UPLOAD_SECURITY:
+            validator = UploadValidator(scope, settings.BUNDLE_FILTER_MAX_ENTRY_BYTES)
+        body = stream_upload(chain(body_head, body_chunks), max_body, validator)
+        if not settings.STREAM_UPLOADS:
+            body = b"".join([chunk async for chunk in body])
+        elif "content-length" in request.headers:
+            forward_headers["Content-Length"] = request.headers["content-length"]
+
+    if method == "GET" and len(rewritten_url) > settings.MAX_URL_LENGTH and is_search_path(path_parts):
+        # Large scopes make URLs that upstream servers reject; send the same
+        # search as a form-encoded POST to _search instead.
+        rewritten_url, body = to_post_search(rewritten_url)
+        method = "POST"
+        forward_headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+    fetch = partial(
+        fetch_upstream, request.method, method, rewritten_url, forward_headers, body,
+        scope, path_parts, response_key, cached, links, request_priority(request.method, path_parts),
+    )
+    if request.method == "GET" and settings.COALESCE_REQUESTS and not is_conditional(request):
+        # Identical concurrent searches from the same scope share one
+        # upstream request; the scope digest keeps scopes apart.
+        result = await coalescer.run((request.method, rewritten_url, scope.digest, proxy_base), fetch)
+    else:
+        result = await fetch()
+    if resolve:
+        with stage("resolve"):
+            result = await resolve_references(result, includes, revincludes, token, scope, proxy_base)
+    return result.to_response()
+
+
+async def fetch_upstream(
+    client_method: str,
+    method: str,
+    url: str,
+    headers: dict,
+    body,
+    scope: AccessScope,
+    path_parts: list[str],
+    response_key,
+    cached,
+    links: Optional[LinkRewriter] = None,
+    priority: int = PRIORITY_SEARCH,
+) -> UpstreamResult:
+    resource_type = path_parts[0]
+    # Reads and vreads return one resource, checked whole.
+    is_direct_read = len(path_parts) == 2 or (len(path_parts) == 4 and path_parts[2] == "_history")
+
+    client = get_hapi_client()
 
-    async with httpx.AsyncClient(timeout=PROXY_TIMEOUT) as client:
+    def attempt():
+        upstream_request = client.build_request(method=method, url=url, headers=headers, content=body)
+        return client.send(upstream_request, stream=True)
+
+    try:
+        async with hapi_breaker.guard() as call, hapi_limiter.slot(priority) as permit:
+            with stage("upstream"):
+                if method == "GET" and settings.HEDGE_REQUESTS:
+                    # Hedges go out only while the upstream has spare capacity.
+                    resp = await hapi_hedger.send(attempt, lambda: hapi_breaker.closed and hapi_limiter.has_capacity())
+                else:
+                    resp = await attempt()
+            permit.dropped = resp.status_code in OVERLOAD_STATUSES
+            call.failed = resp.status_code >= 500
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Error communicating with FHIR server: {str(e)}")
+    record_upstream("hapi", resp.status_code)
+
+    if resp.is_error:
         try:
-            resp = await client.request(
-                method=request.method,
-                url=rewritten_url,
-                headers=forward_headers,
-                content=body
+            await resp.aread()
+        finally:
+            await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=f"FHIR server error: {resp.text}")
+
+    if response_key is not None:
+        if resp.status_code == 304 and cached is not None:
+            await resp.aclose()
+            response_cache.record_revalidated(cached)
+            return cached.to_result("REVALIDATED")
+        response_cache.record_miss()
+        if resp.status_code != 200 or "no-store" in resp.headers.get("cache-control", ""):
+            response_key = None
+    elif settings.RESPONSE_CACHE_ENABLED and client_method in ("POST", "PUT", "DELETE") and path_parts[-1] != "_search":
+        if resource_type:
+            await response_cache.invalidate(resource_type)
+        else:
+            # A transaction or batch at the base URL may touch any type.
+            await response_cache.invalidate_all()
+
+    # Only direct reads need the whole body for the meta.security check;
+    # anything else is streamed through, with search Bundles re-checked entry
+    # by entry as they arrive.
+    if settings.STREAM_RESPONSES and not is_direct_read:
+        inspect = (settings.BUNDLE_SECURITY_FILTER or links is not None) and client_method == "GET" \
+            and is_json_response(resp)
+        if not inspect and response_key is None and settings.COMPRESS_RESPONSES \
+                and upstream_encoding(resp) != "identity":
+            # Nothing reads this body, so it goes out in the encoding HAPI FHIR
+            # sent it with; CompressionMiddleware decodes it for clients that
+            # do not accept that encoding.
+            return UpstreamResult(resp.status_code, response_headers(resp, raw=True),
+                                  stream=iter_upstream(resp, raw=True))
+        body_iter = iter_upstream(resp)
+        if inspect:
+            bundle_filter = BundleSecurityFilter(
+                scope if settings.BUNDLE_SECURITY_FILTER else None,
+                mode=settings.BUNDLE_FILTER_MODE,
+                max_entry_bytes=settings.BUNDLE_FILTER_MAX_ENTRY_BYTES,
+                rewrite_links=links,
             )
-            resp.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=f"FHIR server error: {e.response.text}")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=f"Error communicating with FHIR server: {str(e)}")
+            body_iter = bundle_filter.filter(body_iter)
+        if response_key is not None:
+            body_iter = response_cache.tee(
+                body_iter, response_key, resource_type, resp.status_code, cacheable_headers(resp.headers)
+            )
+        return UpstreamResult(resp.status_code, response_headers(resp), stream=body_iter)
+
+    try:
+        with stage("read"):
+            await resp.aread()
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Error communicating with FHIR server: {str(e)}")
+    finally:
+        await resp.aclose()
+    record_received(resp)
+
+    if resp.status_code == 304 or not resp.content:
+        # Not modified, or a write answered without a body: nothing to check.
+        return UpstreamResult(resp.status_code, response_headers(resp), body=b"")
 
-    data = resp.json()
+    with stage("decode"):
+        data = loads(resp.content)
 
 ###################################################################################################################################
 
-    path_parts = path.strip("/").split("/")
-    is_direct_read = len(path_parts) == 2  
+    if is_direct_read and is_export_file(data):
+        # The line filter only applies to NDJSON downloads, so export files
+        # are never served as a Binary resource.
+        raise HTTPException(status_code=406, detail="Export files can only be downloaded as NDJSON")
+
+    with stage("security"):
+        allowed = not is_direct_read or resource_allowed(data, scope)
+    if not allowed:
+        raise HTTPException(status_code=403, detail="Access denied for this resource")
 
-    if is_direct_read and "meta" in data and "security" in data["meta"]:
-        resource_codes = [sec.get("code") for sec in data["meta"]["security"]]
-        if not any(code in allowed_resources for code in resource_codes):
-            raise HTTPException(status_code=403, detail="Access denied for this resource")
+    if links is not None and isinstance(data, dict) and data.get("resourceType") == "Bundle" and "link" in data:
+        data["link"] = links(data["link"])
 
 
 ####################################################################################################################################
 
 
-    return JSONResponse(content=data, status_code=resp.status_code)
+    with stage("encode"):
+        result = UpstreamResult(resp.status_code, {"content-type": "application/json"}, body=dumps(data))
+    if response_key is not None:
+        headers = cacheable_headers(resp.headers)
+        headers.update(result.headers)
+        await response_cache.put(
+            response_key, CachedResponse(resource_type, resp.status_code, headers, result.body, time.time())
+        )
+    return result
 ####################################################################################################################################
+async def proxy_bulk_export(request: Request, url: str, path_parts: list[str], token: str,
+                            scope: AccessScope) -> Response:
+    forward_headers = {k: v for k, v in request.headers.items() if k.lower() not in NOT_FORWARDED}
+    forward_headers["Authorization"] = f"Bearer {token}"
+    body = await request.body() if request.method == "POST" else None
+
+    client = get_hapi_client()
+    upstream_request = client.build_request(request.method, url, headers=forward_headers, content=body)
+    try:
+        async with hapi_breaker.guard() as call, hapi_limiter.slot(PRIORITY_SEARCH) as permit:
+            with stage("upstream"):
+                resp = await client.send(upstream_request, stream=True)
+            permit.dropped = resp.status_code in OVERLOAD_STATUSES
+            call.failed = resp.status_code >= 500
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Error communicating with FHIR server: {str(e)}")
+    record_upstream("hapi", resp.status_code)
+
+    if resp.is_error:
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=f"FHIR server error: {resp.text}")
+
+    proxy_base = public_base_url(request)
+    headers = response_headers(resp)
+    if "content-location" in headers:
+        headers["content-location"] = to_proxy_url(headers["content-location"], HAPI_FHIR_URL, proxy_base)
+    content_type = resp.headers.get("content-type", "")
+
+    if is_ndjson(content_type):
+        ndjson_filter = NDJSONSecurityFilter(scope, max_line_bytes=settings.BUNDLE_FILTER_MAX_ENTRY_BYTES)
+        return StreamingResponse(ndjson_filter.filter(iter_upstream(resp)), status_code=resp.status_code,
+                                 headers=headers)
+
+    if is_export_status(path_parts) or is_export_kickoff(path_parts):
+        if resp.status_code != 200 or "json" not in content_type:
+            return StreamingResponse(iter_upstream(resp), status_code=resp.status_code, headers=headers)
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+        manifest = rewrite_manifest(loads(resp.content), HAPI_FHIR_URL, proxy_base)
+        return Response(content=dumps(manifest), status_code=resp.status_code, headers=headers)
+
+    # A download that did not come back as NDJSON cannot be filtered.
+    await resp.aclose()
+    raise HTTPException(status_code=406, detail="Only NDJSON export files can be downloaded in bulk")
+
+
+async def proxy_batch(bundle: dict, token: str, scope: AccessScope, proxy_base: str) -> Response:
+    entries = bundle.get("entry") or []
+    if len(entries) > settings.BATCH_MAX_ENTRIES:
+        raise HTTPException(status_code=413, detail=f"Batch has more than {settings.BATCH_MAX_ENTRIES} entries")
+    parsed = parse_entries(entries, (HAPI_FHIR_URL, proxy_base), scope)
+    if settings.BATCH_MODE == "upstream":
+        responses = await run_upstream_batch(parsed, token, scope, proxy_base)
+    else:
+        execute = partial(execute_batch_entry, token=token, scope=scope, proxy_base=proxy_base)
+        responses = await run_entries(parsed, execute, settings.BATCH_CONCURRENCY)
+    return Response(content=dumps(response_bundle(responses)), media_type="application/fhir+json")
+
+
+async def execute_batch_entry(entry: BatchEntry, token: str, scope: AccessScope, proxy_base: str) -> dict:
+    url = rewrite_fhir_url(f"{HAPI_FHIR_URL}/{entry.url}", scope)
+    path_parts = entry.path_parts
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/fhir+json",
+        "Content-Type": "application/fhir+json",
+        **entry.headers,
+    }
+    body = dumps(entry.resource) if entry.resource is not None else None
+    method = entry.method
+    links = None
+    if method == "GET":
+        links = LinkRewriter(HAPI_FHIR_URL, proxy_base, scope.security_fragment)
+        if len(url) > settings.MAX_URL_LENGTH and is_search_path(path_parts):
+            url, body = to_post_search(url)
+            method = "POST"
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+    fetch = partial(
+        fetch_upstream, entry.method, method, url, headers, body,
+        scope, path_parts, None, None, links, request_priority(entry.method, path_parts),
+    )
+    try:
+        if method == "GET" and settings.COALESCE_REQUESTS and not entry.headers:
+            result = await coalescer.run((method, url, scope.digest, proxy_base), fetch)
+        else:
+            result = await fetch()
+        content = await read_result(result)
+    except HTTPException as e:
+        return error_entry(e.status_code, str(e.detail))
+    except Overloaded as e:
+        return error_entry(503, str(e))
+    try:
+        resource = loads(content) if content else None
+    except ValueError:
+        return error_entry(502, "FHIR server returned invalid JSON")
+    return response_entry(result.status_code, result.headers, resource)
+
+
+async def run_upstream_batch(parsed: list, token: str, scope: AccessScope, proxy_base: str) -> list[dict]:
+    """Send the accepted entries to HAPI as one batch and check what it returns."""
+    forwarded = [entry for entry in parsed if isinstance(entry, BatchEntry)]
+    if not forwarded:
+        return parsed
+    upstream_bundle = {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [upstream_entry(entry, rewrite_fhir_url(entry.url, scope)) for entry in forwarded],
+    }
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/fhir+json",
+        "Content-Type": "application/fhir+json",
+    }
+    try:
+        result = await fetch_upstream("POST", "POST", HAPI_FHIR_URL, headers, dumps(upstream_bundle), scope, [""],
+                                      None, None, None, PRIORITY_SEARCH)
+        returned = loads(await read_result(result)).get("entry") or []
+    except HTTPException as e:
+        returned = [error_entry(e.status_code, str(e.detail))] * len(forwarded)
+    except Overloaded as e:
+        returned = [error_entry(503, str(e))] * len(forwarded)
+    except (ValueError, AttributeError):
+        returned = [error_entry(502, "FHIR server returned an invalid batch response")] * len(forwarded)
+
+    links = LinkRewriter(HAPI_FHIR_URL, proxy_base, scope.security_fragment)
+    responses = []
+    returned_entries = iter(returned)
+    for entry in parsed:
+        if not isinstance(entry, BatchEntry):
+            responses.append(entry)
+            continue
+        response = next(returned_entries, None)
+        if response is None:
+            responses.append(error_entry(502, "FHIR server returned no response for this entry"))
+        elif entry.method == "GET":
+            responses.append(secure_response_entry(response, scope, links))
+        else:
+            responses.append(response)
+    return responses
+
+
+async def resolve_references(result: UpstreamResult, includes: list[str], revincludes: list[tuple[str, str]],
+                             token: str, scope: AccessScope, proxy_base: str) -> UpstreamResult:
+    """Inline what a search page refers to, or is referred to by, as `include` entries."""
+    content = await read_result(result)
+    headers = dict(result.headers)
+    headers.pop("content-encoding", None)
+    try:
+        bundle = loads(content) if result.status_code == 200 else None
+    except ValueError:
+        bundle = None
+    if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+        return UpstreamResult(result.status_code, headers, body=content)
+
+    searches = []
+    if includes:
+        wanted = collect_references(bundle, includes, (HAPI_FHIR_URL, proxy_base), settings.RESOLVE_MAX_RESOURCES)
+        searches += include_searches(wanted, settings.RESOLVE_BATCH_SIZE)
+    if revincludes:
+        searches += revinclude_searches(matched_references(bundle), revincludes, settings.RESOLVE_BATCH_SIZE,
+                                        settings.RESOLVE_MAX_RESOURCES)
+    pages = await asyncio.gather(*(
+        fetch_search(resource_type, search_query, token, scope) for resource_type, search_query in searches
+    ))
+    included = [resource for page in pages for resource in page if resource_allowed(resource, scope)]
+    add_included(bundle, included[:settings.RESOLVE_MAX_RESOURCES], proxy_base)
+    headers["content-type"] = "application/fhir+json"
+    return UpstreamResult(result.status_code, headers, body=dumps(bundle))
+
+
+async def fetch_search(resource_type: str, query: str, token: str, scope: AccessScope) -> list[dict]:
+    """The resources of the first page of a search, with the scope applied."""
+    url = rewrite_fhir_url(upstream_url(resource_type, query), scope)
+    headers = {"Authorization": f"Bearer {token}", "Accept": "application/fhir+json"}
+    method, body = "GET", None
+    if len(url) > settings.MAX_URL_LENGTH:
+        url, body = to_post_search(url)
+        method = "POST"
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    result = await fetch_upstream("GET", method, url, headers, body, scope, [resource_type], None, None, None,
+                                  PRIORITY_SEARCH)
+    content = await read_result(result)
+    if result.status_code != 200:
+        status = result.status_code if 400 <= result.status_code < 500 else 502
+        raise HTTPException(status_code=status, detail=f"Resolving references with {resource_type} failed")
+    page = loads(content)
+    return [
+        entry["resource"] for entry in page.get("entry") or []
+        if isinstance(entry, dict) and isinstance(entry.get("resource"), dict)
+    ]
+
+
+async def read_result(result: UpstreamResult) -> bytes:
+    """The whole body of a result, without its Content-Encoding."""
+    if result.stream is None:
+        content = result.body
+    else:
+        content = b"".join([chunk async for chunk in result.stream])
+    return decode_body(content, result.headers.get("content-encoding", ""))
+
+
+def prefetch_page(next_url: str, token: str, scope: AccessScope, proxy_base: str) -> None:
+    """Fetch the next page of a search in the background for the client's next request."""
+    if not next_url.startswith(HAPI_FHIR_URL):
+        return
+    path, _, query = next_url[len(HAPI_FHIR_URL):].partition("?")
+    path = path.strip("/")
+    # The same URL and key proxy_fhir computes when the client follows the link.
+    url = rewrite_fhir_url(upstream_url(path, query), scope)
+    headers = {"Authorization": f"Bearer {token}", "Accept": "application/fhir+json"}
+    links = LinkRewriter(HAPI_FHIR_URL, proxy_base, scope.security_fragment)
+
+    async def fetch() -> PrefetchedPage:
+        result = await fetch_upstream("GET", "GET", url, headers, None, scope, path.split("/"), None, None, links,
+                                      PRIORITY_PREFETCH)
+        return PrefetchedPage(result, links)
+
+    prefetch_cache.start((url, scope.digest, proxy_base), fetch)
+
+
+async def get_access_scope(token: str) -> AccessScope:
+    if not settings.AUTH_CACHE_ENABLED:
+        return await load_access_scope(token)
+    return await auth_cache.get_or_load(token, load_access_scope)
+
+
+async def load_access_scope(token: str) -> AccessScope:
+    return AccessScope(await get_gen3_allowed_resources(token))
+
+
 async def get_gen3_allowed_resources(token: str) -> list[str]:
     headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient(timeout=ARBORIST_TIMEOUT) as client:
+    client = get_gen3_client()
+    async with gen3_breaker.guard() as call, gen3_limiter.slot(PRIORITY_READ) as permit:
         resp = await client.get(GEN_USER_URL, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("resources", [])  
+        permit.dropped = resp.status_code in OVERLOAD_STATUSES
+        call.failed = resp.status_code >= 500
+    record_upstream("gen3", resp.status_code)
+    resp.raise_for_status()
+    data = loads(resp.content)
+    return data.get("resources", [])
 
 ################################################################################################
 
-def rewrite_fhir_url(original_url: str, resources: list[str]) -> str:
-    parsed = urlparse(original_url)
-    query_params = parse_qs(parsed.query)
-    security_tags = [SECURITY_TAG_PREFIX + res for res in resources]
-    query_params["_security"] = security_tags
-    new_query = urlencode(query_params, doseq=True)
-    return urlunparse(parsed._replace(query=new_query))
+def upstream_url(path: str, query: str) -> str:
+    url = f"{HAPI_FHIR_URL}/{path}"
+    return f"{url}?{query}" if query else url
+
+
+def rewrite_fhir_url(original_url: str, scope: AccessScope) -> str:
+    # The scope's encoded _security fragment is appended to the client's
+    # query as-is. A client-supplied _security parameter is ANDed with it by
+    # the FHIR server, so it can only narrow the result.
+    fragment = scope.security_fragment
+    if not fragment:
+        return original_url
+    if "?" not in original_url:
+        return f"{original_url}?{fragment}"
+    if original_url.endswith(("?", "&")):
+        return original_url + fragment
+    return f"{original_url}&{fragment}"
+
+
+def request_priority(method: str, path_parts: list[str]) -> int:
+    if path_parts[-1] == "_search":
+        return PRIORITY_SEARCH
+    if method == "GET":
+        return PRIORITY_READ if len(path_parts) == 2 else PRIORITY_SEARCH
+    return PRIORITY_WRITE
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def is_bulk_export(request: Request, path_parts: list[str]) -> bool:
+    if is_export_kickoff(path_parts) or is_export_status(path_parts):
+        return True
+    # Export files are Binary resources downloaded as NDJSON.
+    return (request.method == "GET" and len(path_parts) == 2 and path_parts[0] == "Binary"
+            and is_ndjson(request.headers.get("accept", "")))
+
+
+def public_base_url(request: Request) -> str:
+    return settings.PUBLIC_BASE_URL.rstrip("/") or str(request.base_url).rstrip("/")
+
+
+def response_cacheable(resource_type: str) -> bool:
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return False
+    return not settings.RESPONSE_CACHE_TYPES or resource_type in settings.RESPONSE_CACHE_TYPES
+
+
+def is_search_path(path_parts: list[str]) -> bool:
+    return len(path_parts) == 1 or path_parts[-1] == "_search"
+
+
+def to_post_search(url: str) -> tuple[str, bytes]:
+    base, _, query = url.partition("?")
+    if not base.endswith("/_search"):
+        base = base.rstrip("/") + "/_search"
+    return base, query.encode()
 
 ################################################################################################
 
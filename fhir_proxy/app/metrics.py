@@ -0,0 +1,261 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+from .config import settings
+
+# Hot-path instrumentation: a minimal Prometheus registry (counters, gauges,
+# histograms rendered in the text exposition format) and per-request stage
+# timings. Stages are recorded through a context variable so code deep in
+# the request path can time itself without threading a timer around.
+#
+# Metrics are kept per process; with several gunicorn workers each worker
+# serves its own /metrics.
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def reset(self) -> None:
+        self._values.clear()
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def reset(self) -> None:
+        self._series.clear()
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+        self._collectors: list[tuple[str, str, Callable[[], dict]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, help: str, stats: Callable[[], dict]) -> None:
+        """Export the numeric values of a `stats()` dict as gauges on every scrape."""
+        self._collectors.append((prefix, help, stats))
+
+    def reset(self) -> None:
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, help, stats in self._collectors:
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.extend((f"# HELP {name} {help} ({key})", f"# TYPE {name} gauge", f"{name} {_number(value)}"))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.register(Histogram(
+    "fhir_proxy_request_duration_seconds", "Time to serve a proxied request", ("method", "status")))
+STAGE_DURATION = registry.register(Histogram(
+    "fhir_proxy_stage_duration_seconds", "Time spent per stage of a proxied request", ("stage",)))
+PAYLOAD_BYTES = registry.register(Histogram(
+    "fhir_proxy_payload_bytes", "Request and response body sizes", ("direction",), SIZE_BUCKETS))
+UPSTREAM_RESPONSES = registry.register(Counter(
+    "fhir_proxy_upstream_responses_total", "Upstream responses by status code", ("upstream", "status")))
+IN_FLIGHT = registry.register(Gauge(
+    "fhir_proxy_in_flight_requests", "Proxied requests currently being served"))
+WIRE_BYTES = registry.register(Counter(
+    "fhir_proxy_wire_bytes_total", "Response body bytes on the wire by hop and Content-Encoding", ("hop", "encoding")))
+
+
+# Per-request stage timings -------------------------------------------------
+
+class RequestTimings:
+    __slots__ = ("stages",)
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items())
+
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("fhir_proxy_timings", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def record_upstream(upstream: str, status_code: int) -> None:
+    if settings.METRICS_ENABLED:
+        UPSTREAM_RESPONSES.inc(upstream, str(status_code))
+
+
+def record_wire_bytes(hop: str, encoding: str, size: int) -> None:
+    """Body bytes as received from HAPI FHIR (`upstream`) or sent to the client (`client`)."""
+    if settings.METRICS_ENABLED and size:
+        WIRE_BYTES.inc(hop, encoding, amount=size)
+
+
+class MetricsMiddleware:
+    """Time proxied requests and count their payloads.
+
+    Admin endpoints (`/metrics`, `/_proxy/...`) are not measured.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not (settings.METRICS_ENABLED or settings.SERVER_TIMING) \
+                or scope["path"] == "/metrics" or scope["path"].startswith("/_proxy/"):
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        status = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def receive_counted():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_measured(message) -> None:
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if settings.SERVER_TIMING and timings.stages:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timings.server_timing().encode()))
+                    message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        metrics_enabled = settings.METRICS_ENABLED
+        if metrics_enabled:
+            IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_counted, send_measured)
+        finally:
+            _timings.reset(token)
+            if metrics_enabled:
+                IN_FLIGHT.dec()
+                REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"], str(status))
+                for name, seconds in timings.stages.items():
+                    STAGE_DURATION.observe(seconds, name)
+                PAYLOAD_BYTES.observe(request_bytes, "request")
+                PAYLOAD_BYTES.observe(response_bytes, "response")
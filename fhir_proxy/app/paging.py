@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .bulkexport import to_proxy_url
+from .config import settings
+from .streaming import UpstreamResult
+
+# Search paging through the proxy. The `link` URLs of upstream Bundles are
+# rewritten to point at the proxy, with the scope's `_security` fragment
+# taken out again (the proxy adds it back on the way upstream, so clients
+# never see or tamper with it). Optionally the next page is prefetched while
+# the current one streams, and handed out when the client asks for it.
+
+
+def strip_fragment(url: str, fragment: str) -> str:
+    """Remove the proxy's own `_security` parameter from an upstream URL."""
+    if not fragment or "?" not in url:
+        return url
+    base, _, query = url.partition("?")
+    params = [param for param in query.split("&") if param != fragment]
+    return f"{base}?{'&'.join(params)}" if params else base
+
+
+class LinkRewriter:
+    """Rewrite a Bundle's `link` array and remember the upstream `next` URL."""
+
+    def __init__(self, upstream_base: str, proxy_base: str, fragment: str,
+                 on_next: Optional[Callable[[str], None]] = None, proxy_query: str = "") -> None:
+        self.upstream_base = upstream_base
+        self.proxy_base = proxy_base
+        self.fragment = fragment
+        self.on_next = on_next
+        # Proxy-only parameters the client's links should keep.
+        self.proxy_query = proxy_query
+        self.next_url: Optional[str] = None
+
+    def __call__(self, links: Any) -> Any:
+        if not isinstance(links, list):
+            return links
+        for link in links:
+            if not isinstance(link, dict) or not isinstance(link.get("url"), str):
+                continue
+            upstream = strip_fragment(link["url"], self.fragment)
+            if link.get("relation") == "next":
+                self.next_url = upstream
+                if self.on_next is not None:
+                    self.on_next(upstream)
+            link["url"] = to_proxy_url(upstream, self.upstream_base, self.proxy_base)
+            if self.proxy_query:
+                link["url"] += ("&" if "?" in link["url"] else "?") + self.proxy_query
+        return links
+
+
+class PrefetchedPage:
+    __slots__ = ("result", "links")
+
+    def __init__(self, result: UpstreamResult, links: LinkRewriter) -> None:
+        self.result = result
+        self.links = links
+
+    @property
+    def next_url(self) -> Optional[str]:
+        # Known once the page's `link` array has streamed past.
+        return self.links.next_url
+
+
+class PrefetchCache:
+    """Next pages fetched ahead of the client, each handed out once."""
+
+    def __init__(self, max_entries: int, ttl: float, max_page_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_page_bytes = max_page_bytes
+        self._pages: "OrderedDict[Hashable, tuple[asyncio.Task, float]]" = OrderedDict()
+        self.started = 0
+        self.hits = 0
+        self.expired = 0
+        self.errors = 0
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._pages
+
+    def start(self, key: Hashable, fetch: Callable[[], Awaitable[PrefetchedPage]]) -> None:
+        if key in self._pages:
+            return
+        while len(self._pages) >= self.max_entries:
+            _, (task, _) = self._pages.popitem(last=False)
+            task.cancel()
+            self.expired += 1
+        task = asyncio.ensure_future(self._load(fetch))
+        task.add_done_callback(_retrieve)
+        self._pages[key] = (task, time.monotonic())
+        self.started += 1
+
+    async def take(self, key: Hashable) -> Optional[PrefetchedPage]:
+        item = self._pages.pop(key, None)
+        if item is None:
+            return None
+        task, started = item
+        if time.monotonic() - started > self.ttl:
+            task.cancel()
+            self.expired += 1
+            return None
+        try:
+            page = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception:
+            self.errors += 1
+            return None
+        self.hits += 1
+        return page
+
+    async def _load(self, fetch: Callable[[], Awaitable[PrefetchedPage]]) -> PrefetchedPage:
+        page = await fetch()
+        result = page.result
+        if result.stream is not None:
+            body = bytearray()
+            async for chunk in result.stream:
+                body += chunk
+                if len(body) > self.max_page_bytes:
+                    await result.stream.aclose()
+                    raise ValueError("Prefetched page exceeds the configured size limit")
+            page.result = UpstreamResult(result.status_code, result.headers, body=bytes(body))
+        return page
+
+    def clear(self) -> None:
+        for task, _ in self._pages.values():
+            task.cancel()
+        self._pages.clear()
+
+    def reset(self) -> None:
+        self.clear()
+        self.started = self.hits = self.expired = self.errors = 0
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pages),
+            "started": self.started,
+            "hits": self.hits,
+            "expired": self.expired,
+            "errors": self.errors,
+        }
+
+
+def _retrieve(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+prefetch_cache = PrefetchCache(
+    max_entries=settings.PREFETCH_MAX_PAGES,
+    ttl=settings.PREFETCH_TTL,
+    max_page_bytes=settings.PREFETCH_MAX_PAGE_BYTES,
+)
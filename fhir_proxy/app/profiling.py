@@ -0,0 +1,248 @@
+import io
+import marshal
+import random
+import re
+import time
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from .config import settings
+
+if TYPE_CHECKING:
+    import cProfile
+    import pstats
+    import tracemalloc
+
+# On-demand profiling of live requests, switched on through the admin API.
+#
+# While a profiling session is active, a sample of the requests matching
+# its path pattern and resource types is run under cProfile and/or
+# tracemalloc. CPU profiles are merged per resource type into pstats data
+# that can be downloaded and opened with pstats or snakeviz; allocations are
+# aggregated per resource type and source line. Only one request is
+# profiled at a time: both tools see the whole process, so concurrent
+# requests would be mixed into the same profile anyway. With no session
+# active the middleware costs one attribute check per request, and the
+# profilers themselves are only imported when a session starts.
+
+# Profiles are kept per resource type; past this many, under "other".
+MAX_KEYS = 100
+
+
+def request_key(path: str) -> str:
+    """Profiles are grouped by resource type; `/` is the base URL."""
+    return path.strip("/").split("/", 1)[0] or "/"
+
+
+class _Allocations:
+    __slots__ = ("size", "count")
+
+    def __init__(self) -> None:
+        self.size = 0
+        self.count = 0
+
+
+class RequestProfiler:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.active = False
+        self.cpu = False
+        self.memory = False
+        self.sample_rate = 0.0
+        self.path: Optional[re.Pattern] = None
+        self.resource_types: frozenset = frozenset()
+        self.until: Optional[float] = None
+        self.started_tracemalloc = False
+        self._busy = False
+        self._cpu: dict[str, "pstats.Stats"] = {}
+        self._allocations: dict[str, dict[str, _Allocations]] = {}
+        self._peaks: dict[str, int] = {}
+        self.profiled: dict[str, int] = {}
+        self.skipped = 0
+
+    def start(self, cpu: bool = True, memory: bool = False, sample_rate: Optional[float] = None,
+              path: str = "", resource_types: Iterable[str] = (), duration: float = 0) -> None:
+        self.stop()
+        self.cpu = cpu
+        self.memory = memory
+        self.sample_rate = settings.PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.path = re.compile(path) if path else None
+        self.resource_types = frozenset(resource_types)
+        self.until = time.monotonic() + duration if duration > 0 else None
+        import tracemalloc
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(settings.PROFILE_TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        self.active = cpu or memory
+
+    def stop(self) -> None:
+        """End the session; what was collected stays available until `clear`."""
+        self.active = False
+        if self.started_tracemalloc:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def clear(self) -> None:
+        self.stop()
+        self.reset()
+
+    def wants(self, path: str) -> bool:
+        if self.until is not None and time.monotonic() > self.until:
+            self.stop()
+            return False
+        if self.resource_types and request_key(path) not in self.resource_types:
+            return False
+        if self.path is not None and not self.path.search(path):
+            return False
+        if self._busy:
+            self.skipped += 1
+            return False
+        return random.random() < self.sample_rate
+
+    def begin(self, path: str) -> "_Capture":
+        self._busy = True
+        key = request_key(path)
+        if key not in self.profiled and len(self.profiled) >= MAX_KEYS:
+            key = "other"
+        return _Capture(self, key)
+
+    def _record(self, key: str, profile: Optional["cProfile.Profile"], before: Optional["tracemalloc.Snapshot"],
+                peak: int) -> None:
+        import pstats
+        import tracemalloc
+
+        self._busy = False
+        self.profiled[key] = self.profiled.get(key, 0) + 1
+        if profile is not None:
+            stats = self._cpu.get(key)
+            if stats is None:
+                self._cpu[key] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if before is not None and tracemalloc.is_tracing():
+            after = _snapshot()
+            lines = self._allocations.setdefault(key, {})
+            for diff in after.compare_to(before, "lineno"):
+                if diff.size_diff <= 0:
+                    continue
+                line = lines.get(str(diff.traceback))
+                if line is None:
+                    line = lines[str(diff.traceback)] = _Allocations()
+                line.size += diff.size_diff
+                line.count += diff.count_diff
+            self._peaks[key] = max(self._peaks.get(key, 0), peak)
+
+    # Reports --------------------------------------------------------------
+
+    def cpu_profile(self, key: Optional[str] = None) -> Optional[bytes]:
+        """pstats data (as written by `Stats.dump_stats`) for one key or all merged."""
+        selected = [stats for name, stats in self._cpu.items() if not key or name == key]
+        if not selected:
+            return None
+        import pstats
+
+        merged = pstats.Stats()
+        merged.add(*selected)
+        return marshal.dumps(merged.stats)
+
+    def top_functions(self, key: Optional[str] = None, limit: int = 0) -> str:
+        """The most expensive functions by cumulative time, as printed by pstats."""
+        selected = [stats for name, stats in self._cpu.items() if not key or name == key]
+        if not selected:
+            return ""
+        import pstats
+
+        out = io.StringIO()
+        merged = pstats.Stats(stream=out)
+        merged.add(*selected)
+        merged.sort_stats("cumulative").print_stats(limit or settings.PROFILE_TOP)
+        return out.getvalue()
+
+    def top_allocations(self, key: Optional[str] = None, limit: int = 0) -> list[dict]:
+        limit = limit or settings.PROFILE_TOP
+        merged: dict[str, _Allocations] = {}
+        for name, lines in self._allocations.items():
+            if key and name != key:
+                continue
+            for where, line in lines.items():
+                total = merged.setdefault(where, _Allocations())
+                total.size += line.size
+                total.count += line.count
+        top = sorted(merged.items(), key=lambda item: item[1].size, reverse=True)[:limit]
+        return [{"line": where, "bytes": line.size, "blocks": line.count} for where, line in top]
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "cpu": self.cpu,
+            "memory": self.memory,
+            "sample_rate": self.sample_rate,
+            "path": self.path.pattern if self.path is not None else "",
+            "resource_types": sorted(self.resource_types),
+            "remaining_seconds": max(0.0, self.until - time.monotonic()) if self.until is not None else None,
+            "profiled": dict(self.profiled),
+            "skipped_busy": self.skipped,
+            "peak_bytes": dict(self._peaks),
+        }
+
+
+def _snapshot() -> "tracemalloc.Snapshot":
+    import tracemalloc
+
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+
+class _Capture:
+    def __init__(self, profiler: RequestProfiler, key: str) -> None:
+        self.profiler = profiler
+        self.key = key
+        self.profile: Optional["cProfile.Profile"] = None
+        self.before: Optional["tracemalloc.Snapshot"] = None
+        self.baseline = 0
+
+    def __enter__(self) -> "_Capture":
+        import cProfile
+        import tracemalloc
+
+        if self.profiler.memory and tracemalloc.is_tracing():
+            self.before = _snapshot()
+            tracemalloc.reset_peak()
+            self.baseline = tracemalloc.get_traced_memory()[0]
+        if self.profiler.cpu:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Another profiler is running in this process.
+                self.profile = None
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        import tracemalloc
+
+        if self.profile is not None:
+            self.profile.disable()
+        peak = max(0, tracemalloc.get_traced_memory()[1] - self.baseline) if self.before is not None else 0
+        self.profiler._record(self.key, self.profile, self.before, peak)
+
+
+class ProfilingMiddleware:
+    """Run sampled requests under the active profiling session."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if not profiler.active or scope["type"] != "http" or scope["path"] == "/metrics" \
+                or scope["path"].startswith("/_proxy/") or not profiler.wants(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        with profiler.begin(scope["path"]):
+            await self.app(scope, receive, send)
+
+
+profiler = RequestProfiler()
@@ -0,0 +1,165 @@
+from typing import Any, Iterable, Iterator
+from urllib.parse import parse_qsl, quote
+
+from .security import is_resource_type
+
+# Proxy-side reference resolution for search results. A search carrying
+# `_proxy_include=subject,performer` (or `*` for every reference) gets the
+# resources its matches refer to appended as `include` entries, and
+# `_proxy_revinclude=Observation:subject` appends the Observations that
+# refer to the matches. The references are collected from the whole page,
+# deduplicated and fetched with one `_id=a,b,c` search per resource type,
+# instead of one read per reference by the client.
+
+INCLUDE_PARAM = "_proxy_include"
+REVINCLUDE_PARAM = "_proxy_revinclude"
+
+
+def split_include_params(query: str) -> tuple[str, list[str], list[tuple[str, str]]]:
+    """Take the proxy's include parameters out of a query string.
+
+    ValueError for a revinclude source that is not a resource type, as it
+    becomes the path of an upstream search.
+    """
+    if INCLUDE_PARAM not in query and REVINCLUDE_PARAM not in query:
+        return query, [], []
+    kept, includes, revincludes = [], [], []
+    for param in query.split("&"):
+        name = param.partition("=")[0]
+        if name not in (INCLUDE_PARAM, REVINCLUDE_PARAM):
+            kept.append(param)
+            continue
+        for _, decoded in parse_qsl(param, keep_blank_values=True):
+            for item in filter(None, (part.strip() for part in decoded.split(","))):
+                if name == INCLUDE_PARAM:
+                    includes.append(item)
+                elif ":" in item:
+                    source, _, search_param = item.partition(":")
+                    if not is_resource_type(source):
+                        raise ValueError(f"{REVINCLUDE_PARAM} source {source!r} is not a resource type")
+                    revincludes.append((source, search_param))
+    return "&".join(kept), includes, revincludes
+
+
+def include_query(includes: list[str], revincludes: list[tuple[str, str]]) -> str:
+    """The include parameters as they are carried on proxy paging links."""
+    params = []
+    if includes:
+        params.append(f"{INCLUDE_PARAM}={quote(','.join(includes), safe=',*')}")
+    if revincludes:
+        params.append(f"{REVINCLUDE_PARAM}={quote(','.join(f'{s}:{p}' for s, p in revincludes), safe=',:')}")
+    return "&".join(params)
+
+
+def _resources(bundle: dict, modes: Iterable[str] = ("match", None)) -> Iterator[dict]:
+    for entry in bundle.get("entry") or []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("resource"), dict):
+            continue
+        search = entry.get("search")
+        mode = search.get("mode") if isinstance(search, dict) else None
+        if mode in modes:
+            yield entry["resource"]
+
+
+def _resource_key(resource: dict) -> tuple:
+    return resource.get("resourceType"), resource.get("id")
+
+
+def _walk_references(value: Any) -> Iterator[str]:
+    if isinstance(value, dict):
+        reference = value.get("reference")
+        if isinstance(reference, str):
+            yield reference
+        for item in value.values():
+            if isinstance(item, (dict, list)):
+                yield from _walk_references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _walk_references(item)
+
+
+def parse_reference(reference: str, bases: Iterable[str]) -> tuple:
+    """`(type, id)` of a reference to a resource on this server, else None."""
+    for base in bases:
+        base = base.rstrip("/") + "/"
+        if reference.startswith(base):
+            reference = reference[len(base):]
+            break
+    if "://" in reference or reference.startswith(("#", "urn:")) or "?" in reference:
+        return None
+    parts = reference.strip("/").split("/")
+    # Type/id or Type/id/_history/version
+    if len(parts) not in (2, 4) or not is_resource_type(parts[0]) or not parts[1]:
+        return None
+    return parts[0], parts[1]
+
+
+def collect_references(bundle: dict, elements: list[str], bases: Iterable[str], limit: int) -> dict[str, list[str]]:
+    """Ids to include per resource type, minus what the Bundle already holds."""
+    present = {_resource_key(resource) for resource in _resources(bundle, ("match", "include", None))}
+    wanted: dict[str, list[str]] = {}
+    seen = set()
+    for resource in _resources(bundle):
+        values = [resource] if "*" in elements else [resource.get(name) for name in elements]
+        for reference in (ref for value in values for ref in _walk_references(value)):
+            key = parse_reference(reference, bases)
+            if key is None or key in present or key in seen:
+                continue
+            if len(seen) >= limit:
+                return wanted
+            seen.add(key)
+            wanted.setdefault(key[0], []).append(key[1])
+    return wanted
+
+
+def matched_references(bundle: dict) -> dict[str, list[str]]:
+    """`Type/id` of every match, per resource type."""
+    matches: dict[str, list[str]] = {}
+    for resource in _resources(bundle):
+        resource_type, resource_id = _resource_key(resource)
+        if isinstance(resource_type, str) and isinstance(resource_id, str):
+            matches.setdefault(resource_type, []).append(f"{resource_type}/{resource_id}")
+    return matches
+
+
+def _chunks(items: list[str], size: int) -> Iterator[list[str]]:
+    for start in range(0, len(items), max(1, size)):
+        yield items[start:start + max(1, size)]
+
+
+def include_searches(wanted: dict[str, list[str]], batch_size: int) -> list[tuple[str, str]]:
+    """`(type, query)` searches fetching the wanted ids in batches."""
+    return [
+        (resource_type, f"_id={quote(','.join(ids), safe=',')}&_count={len(ids)}")
+        for resource_type, all_ids in wanted.items()
+        for ids in _chunks(all_ids, batch_size)
+    ]
+
+
+def revinclude_searches(matches: dict[str, list[str]], revincludes: list[tuple[str, str]], batch_size: int,
+                        count: int) -> list[tuple[str, str]]:
+    references = [reference for refs in matches.values() for reference in refs]
+    return [
+        (source, f"{quote(search_param)}={quote(','.join(chunk), safe=',/')}&_count={count}")
+        for source, search_param in revincludes
+        for chunk in _chunks(references, batch_size)
+    ]
+
+
+def add_included(bundle: dict, resources: Iterable[dict], base_url: str) -> int:
+    """Append resources as `include` entries, skipping ones already present."""
+    present = {_resource_key(resource) for resource in _resources(bundle, ("match", "include", None))}
+    entries = bundle.setdefault("entry", [])
+    added = 0
+    for resource in resources:
+        key = _resource_key(resource)
+        if key in present:
+            continue
+        present.add(key)
+        entries.append({
+            "fullUrl": f"{base_url.rstrip('/')}/{key[0]}/{key[1]}",
+            "resource": resource,
+            "search": {"mode": "include"},
+        })
+        added += 1
+    return added
@@ -0,0 +1,322 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+from starlette.responses import Response
+
+from .codec import dumps, loads
+from .config import settings
+from .security import is_resource_type
+from .sharedcache import CacheBackend, cache_backend
+from .streaming import UpstreamResult
+
+# Optional cache of upstream GET responses, keyed by the rewritten URL and
+# the caller's scope digest so cached bodies are never shared across
+# authorization scopes. Entries live in a byte-bounded in-memory LRU with an
+# optional on-disk tier and an optional tier shared by the workers of a host
+# (see sharedcache.py); stale entries carrying an ETag or Last-Modified are
+# revalidated with a conditional request instead of being refetched.
+
+CACHED_HEADERS = ("content-type", "etag", "last-modified", "content-location")
+NAMESPACE = "response"
+
+
+class CachedResponse:
+    __slots__ = ("resource_type", "status_code", "headers", "body", "stored_at", "generation")
+
+    def __init__(self, resource_type: str, status_code: int, headers: dict, body: bytes, stored_at: float):
+        self.resource_type = resource_type
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        # Shared tier generation of the resource type when this copy was kept.
+        self.generation = 0
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.headers.get("etag")
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.headers.get("last-modified")
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.stored_at < ttl
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_result(self, status: str) -> UpstreamResult:
+        headers = dict(self.headers)
+        headers["X-Proxy-Cache"] = status
+        return UpstreamResult(self.status_code, headers, body=self.body)
+
+    def to_response(self, status: str) -> Response:
+        return self.to_result(status).to_response()
+
+
+def cache_key(url: str, scope_digest: str, proxy_base: str = "") -> str:
+    # Cached Bundles carry links rewritten to `proxy_base`.
+    return hashlib.sha256(f"{scope_digest}\n{proxy_base}\n{url}".encode()).hexdigest()
+
+
+def cacheable_headers(headers) -> dict:
+    return {name: headers[name] for name in CACHED_HEADERS if name in headers}
+
+
+def encode_entry(entry: CachedResponse) -> bytes:
+    meta = {
+        "resource_type": entry.resource_type,
+        "status_code": entry.status_code,
+        "headers": entry.headers,
+        "stored_at": entry.stored_at,
+    }
+    return dumps(meta) + b"\n" + entry.body
+
+
+def decode_entry(data: bytes) -> CachedResponse:
+    end = data.index(b"\n")
+    meta = loads(data[:end])
+    return CachedResponse(meta["resource_type"], meta["status_code"], meta["headers"], data[end + 1:],
+                          meta["stored_at"])
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, max_entry_bytes: int, disk_dir: str = "", disk_max_bytes: int = 0,
+                 backend: Optional[CacheBackend] = None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.backend = backend
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._by_type: dict[str, set] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes_saved = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Lookup ---------------------------------------------------------------
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self.backend is None or entry.generation == self._generation(entry.resource_type):
+                self._entries.move_to_end(key)
+                return entry
+            # Another worker invalidated the resource type.
+            self._forget(key)
+        if self.backend is not None:
+            data = self.backend.get(NAMESPACE, key.encode())
+            if data is not None:
+                entry = decode_entry(data)
+                self.shared_hits += 1
+                self._remember(key, entry)
+                return entry
+        if self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._remember(key, entry)
+                return entry
+        return None
+
+    def record_hit(self, entry: CachedResponse) -> None:
+        self.hits += 1
+        self.bytes_saved += len(entry.body)
+
+    def record_revalidated(self, entry: CachedResponse) -> None:
+        self.revalidated += 1
+        self.bytes_saved += len(entry.body)
+        entry.stored_at = time.time()
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    # Storage --------------------------------------------------------------
+
+    async def put(self, key: str, entry: CachedResponse) -> None:
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        self.stores += 1
+        self._remember(key, entry)
+        if self.backend is not None:
+            self.backend.set(NAMESPACE, key.encode(), encode_entry(entry), tag=entry.resource_type)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, entry)
+
+    async def tee(self, chunks: AsyncIterator[bytes], key: str, resource_type: str,
+                  status_code: int, headers: dict) -> AsyncIterator[bytes]:
+        """Pass a streamed body through and cache it once it completed in full."""
+        parts: Optional[list] = []
+        size = 0
+        async for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            await self.put(key, CachedResponse(resource_type, status_code, headers, b"".join(parts), time.time()))
+
+    def _generation(self, resource_type: str) -> int:
+        return self.backend.generation(NAMESPACE, resource_type)
+
+    def _remember(self, key: str, entry: CachedResponse) -> None:
+        if key in self._entries:
+            self._forget(key)
+        if self.backend is not None:
+            entry.generation = self._generation(entry.resource_type)
+        self._entries[key] = entry
+        self._by_type.setdefault(entry.resource_type, set()).add(key)
+        self._bytes += len(entry.body)
+        while self._bytes > self.max_bytes and self._entries:
+            self._forget(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+        keys = self._by_type.get(entry.resource_type)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_type[entry.resource_type]
+
+    async def invalidate(self, resource_type: str) -> None:
+        for key in list(self._by_type.get(resource_type, ())):
+            self._forget(key)
+        self.invalidations += 1
+        if self.backend is not None:
+            self.backend.invalidate(NAMESPACE, resource_type)
+        type_dir = self._type_dir(resource_type) if self.disk_dir else None
+        if type_dir is not None:
+            await asyncio.to_thread(shutil.rmtree, type_dir, True)
+
+    async def invalidate_all(self) -> None:
+        self.clear()
+        self.invalidations += 1
+        if self.backend is not None:
+            self.backend.clear(NAMESPACE)
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for type_dir in os.scandir(self.disk_dir):
+                await asyncio.to_thread(shutil.rmtree, type_dir.path, True)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_type.clear()
+        self._bytes = 0
+
+    def reset(self) -> None:
+        self.clear()
+        self.hits = self.disk_hits = self.shared_hits = self.revalidated = self.misses = 0
+        self.stores = self.evictions = self.invalidations = self.bytes_saved = 0
+
+    # Disk tier ------------------------------------------------------------
+
+    def _type_dir(self, resource_type: str) -> Optional[str]:
+        """The directory of a resource type, or None for names that are not one."""
+        if not is_resource_type(resource_type):
+            return None
+        root = os.path.realpath(self.disk_dir)
+        type_dir = os.path.realpath(os.path.join(root, resource_type))
+        if os.path.dirname(type_dir) != root:
+            return None
+        return type_dir
+
+    def _find_disk(self, key: str) -> Optional[str]:
+        if not os.path.isdir(self.disk_dir):
+            return None
+        for type_dir in os.scandir(self.disk_dir):
+            path = os.path.join(type_dir.path, key)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _read_disk(self, key: str) -> Optional[CachedResponse]:
+        path = self._find_disk(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return decode_entry(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, entry: CachedResponse) -> None:
+        type_dir = self._type_dir(entry.resource_type)
+        if type_dir is None:
+            return
+        os.makedirs(type_dir, exist_ok=True)
+        tmp_path = os.path.join(type_dir, f".{key}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(encode_entry(entry))
+        os.replace(tmp_path, os.path.join(type_dir, key))
+        if self.disk_max_bytes:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        files = []
+        for type_dir in os.scandir(self.disk_dir):
+            if type_dir.is_dir():
+                files.extend(entry for entry in os.scandir(type_dir.path) if entry.is_file())
+        stats = [(f.stat().st_mtime, f.stat().st_size, f.path) for f in files]
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "disk": bool(self.disk_dir),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "shared": self.backend is not None,
+            "shared_hits": self.shared_hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "bytes_saved": self.bytes_saved,
+            "hit_ratio": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache(
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.RESPONSE_CACHE_MAX_ENTRY_BYTES,
+    disk_dir=settings.RESPONSE_CACHE_DIR,
+    disk_max_bytes=settings.RESPONSE_CACHE_DISK_MAX_BYTES,
+    backend=cache_backend,
+)
@@ -0,0 +1,87 @@
+import hashlib
+from collections import OrderedDict
+from typing import Iterable, Optional
+from urllib.parse import quote_plus
+
+from .config import settings
+from .security import SecurityMatcher
+
+# The set of Gen3 resources a token may access. A scope is built once per
+# authorization lookup and cached with it, so everything derived from the
+# resource set (its digest, the encoded `_security` query fragment, the
+# compiled security matcher) is computed once instead of on every request.
+
+_fragments: "OrderedDict[str, str]" = OrderedDict()
+_matchers: "OrderedDict[str, SecurityMatcher]" = OrderedDict()
+
+
+def _escape_token(value: str) -> str:
+    # FHIR search escaping for characters with a meaning inside token values.
+    for char in ("\\", ",", "$", "|"):
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def security_fragment(digest: str, resources: tuple) -> str:
+    """Encoded `_security` query parameter for a resource set, memoized by digest.
+
+    The tags are sent as one comma-separated parameter, which FHIR search
+    treats as "any of", instead of one parameter per tag.
+    """
+    fragment = _fragments.get(digest)
+    if fragment is not None:
+        _fragments.move_to_end(digest)
+        return fragment
+    if resources:
+        tags = ",".join(settings.SECURITY_TAG_PREFIX + _escape_token(res) for res in resources)
+        fragment = "_security=" + quote_plus(tags)
+    else:
+        fragment = ""
+    _fragments[digest] = fragment
+    while len(_fragments) > settings.SECURITY_FRAGMENT_CACHE_SIZE:
+        _fragments.popitem(last=False)
+    return fragment
+
+
+def security_matcher(digest: str, resources: tuple) -> SecurityMatcher:
+    """Compiled matcher for a resource set, shared by every scope with that set."""
+    matcher = _matchers.get(digest)
+    if matcher is not None:
+        _matchers.move_to_end(digest)
+        return matcher
+    matcher = SecurityMatcher(resources)
+    _matchers[digest] = matcher
+    while len(_matchers) > settings.SECURITY_MATCHER_CACHE_SIZE:
+        _matchers.popitem(last=False)
+    return matcher
+
+
+class AccessScope:
+    __slots__ = ("resources", "digest", "_fragment", "_matcher")
+
+    def __init__(self, resources: Iterable[str]):
+        self.resources = tuple(sorted(set(resources)))
+        self.digest = hashlib.sha256("\n".join(self.resources).encode()).hexdigest()
+        self._fragment: Optional[str] = None
+        self._matcher: Optional[SecurityMatcher] = None
+
+    def __len__(self) -> int:
+        return len(self.resources)
+
+    def __iter__(self):
+        return iter(self.resources)
+
+    def __contains__(self, resource: object) -> bool:
+        return self.matcher.allows(resource)
+
+    @property
+    def security_fragment(self) -> str:
+        if self._fragment is None:
+            self._fragment = security_fragment(self.digest, self.resources)
+        return self._fragment
+
+    @property
+    def matcher(self) -> SecurityMatcher:
+        if self._matcher is None:
+            self._matcher = security_matcher(self.digest, self.resources)
+        return self._matcher
@@ -0,0 +1,113 @@
+import re
+from typing import Any, Iterable, Optional
+
+from .config import settings
+
+# The allowed security codes of a scope are compiled once into a matcher:
+# a frozenset for exact codes and a trie over the path segments of
+# hierarchical Arborist resources, where holding `/programs/x` also allows
+# `/programs/x/projects/y`. Codes are compared without the
+# SECURITY_TAG_PREFIX and without a trailing slash. The inheritance only
+# applies to checks made here (reads, the Bundle, NDJSON and batch filters);
+# searches are filtered upstream by the exact `_security` codes.
+
+_END = None
+
+# FHIR resource type names; client-supplied types are checked against this
+# before they are used in upstream paths or cache directories.
+RESOURCE_TYPE = re.compile(r"[A-Z][A-Za-z]+")
+
+
+def is_resource_type(name: object) -> bool:
+    return isinstance(name, str) and RESOURCE_TYPE.fullmatch(name) is not None
+
+
+def normalize_code(code: str) -> str:
+    prefix = settings.SECURITY_TAG_PREFIX
+    if prefix and code.startswith(prefix):
+        code = code[len(prefix):]
+    if len(code) > 1 and code.endswith("/"):
+        code = code.rstrip("/") or "/"
+    return code
+
+
+class SecurityMatcher:
+    __slots__ = ("exact", "_trie")
+
+    def __init__(self, codes: Iterable[str]) -> None:
+        exact = set()
+        trie: dict = {}
+        for code in codes:
+            if not isinstance(code, str):
+                continue
+            code = normalize_code(code)
+            exact.add(code)
+            if code.startswith("/"):
+                node = trie
+                for segment in _segments(code):
+                    node = node.setdefault(segment, {})
+                node[_END] = True
+        self.exact = frozenset(exact)
+        self._trie = trie
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def __contains__(self, code: object) -> bool:
+        return self.allows(code)
+
+    def allows(self, code: object) -> bool:
+        if not isinstance(code, str):
+            return False
+        if code in self.exact:
+            return True
+        code = normalize_code(code)
+        if code in self.exact:
+            return True
+        if not self._trie or not code.startswith("/"):
+            return False
+        node = self._trie
+        for segment in _segments(code):
+            node = node.get(segment)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+
+def _segments(path: str) -> list[str]:
+    return [segment for segment in path.split("/") if segment]
+
+
+def compile_matcher(allowed_resources: Iterable[str]) -> SecurityMatcher:
+    if isinstance(allowed_resources, SecurityMatcher):
+        return allowed_resources
+    matcher: Optional[SecurityMatcher] = getattr(allowed_resources, "matcher", None)
+    if matcher is not None:
+        return matcher
+    return SecurityMatcher(allowed_resources)
+
+
+def security_codes(resource: Any) -> list:
+    if not isinstance(resource, dict):
+        return []
+    meta = resource.get("meta")
+    if not isinstance(meta, dict) or not isinstance(meta.get("security"), list):
+        return []
+    return [sec.get("code") for sec in meta["security"] if isinstance(sec, dict)]
+
+
+def resource_allowed(resource: Any, allowed_resources: Iterable[str]) -> bool:
+    """A resource is visible if it is untagged or carries one allowed security code.
+
+    Pass a scope or a compiled matcher on hot paths; a plain list of codes
+    is compiled on every call.
+    """
+    if not isinstance(resource, dict):
+        return True
+    meta = resource.get("meta")
+    if not isinstance(meta, dict) or "security" not in meta:
+        return True
+    matcher = compile_matcher(allowed_resources)
+    return any(matcher.allows(code) for code in security_codes(resource))
@@ -0,0 +1,391 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from .config import settings
+
+# Second cache tier shared by the workers of a host.
+#
+# The authorization and response caches keep their own in-process LRU and
+# consult a backend on a miss, writing through on every store. A backend is
+# a byte store with expiry and per-tag generations: bumping the generation
+# of a tag (a resource type) or of a whole namespace makes every entry
+# stored under the old one miss, in every worker at once.
+#
+# `SharedMemoryBackend` keeps the store in a memory-mapped file, by default
+# under /dev/shm, so all Gunicorn workers on a host see each other's entries
+# and the cache survives a worker restart. The file holds a 4-way set
+# associative slot table and a ring log of values. Lookups read the slot and
+# the value in place, without taking a lock, and use a per-slot sequence
+# number and the ring's write position to detect a concurrent overwrite;
+# writers serialize on an flock of the file.
+
+NAMESPACE_TAG = "\x00*"
+
+
+class CacheBackend(ABC):
+    """Interface of a shared cache tier."""
+
+    @abstractmethod
+    def get(self, namespace: str, key: bytes) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: bytes, value: bytes, ttl: Optional[float] = None, tag: str = "") -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def generation(self, namespace: str, tag: str = "") -> int:
+        """A number that changes whenever `tag` or the whole namespace is invalidated."""
+
+    @abstractmethod
+    def invalidate(self, namespace: str, tag: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self, namespace: str) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class _Counters:
+    def reset_counters(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.stores = 0
+        self.rejected = 0
+
+    def counter_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "stores": self.stores,
+            "rejected": self.rejected,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class LocalBackend(_Counters, CacheBackend):
+    """In-process backend with the same semantics, bounded by total bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._generations: dict[tuple, int] = {}
+        self._bytes = 0
+        self.reset_counters()
+
+    def _generations_of(self, namespace: str, tag: str) -> tuple:
+        return self._generations.get((namespace, tag), 0), self._generations.get((namespace, NAMESPACE_TAG), 0)
+
+    def get(self, namespace: str, key: bytes) -> Optional[bytes]:
+        item = self._entries.get((namespace, key))
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires_at, tag, generations = item
+        if expires_at <= time.time() or generations != self._generations_of(namespace, tag):
+            self._remove((namespace, key))
+            self.stale += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end((namespace, key))
+        self.hits += 1
+        return value
+
+    def set(self, namespace: str, key: bytes, value: bytes, ttl: Optional[float] = None, tag: str = "") -> bool:
+        if len(value) > self.max_bytes:
+            self.rejected += 1
+            return False
+        if (namespace, key) in self._entries:
+            self._remove((namespace, key))
+        expires_at = time.time() + ttl if ttl is not None else float("inf")
+        self._entries[(namespace, key)] = (value, expires_at, tag, self._generations_of(namespace, tag))
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self.stores += 1
+        return True
+
+    def _remove(self, entry_key: tuple) -> None:
+        value = self._entries.pop(entry_key)[0]
+        self._bytes -= len(value)
+
+    def delete(self, namespace: str, key: bytes) -> None:
+        if (namespace, key) in self._entries:
+            self._remove((namespace, key))
+
+    def generation(self, namespace: str, tag: str = "") -> int:
+        tag_generation, namespace_generation = self._generations_of(namespace, tag)
+        return (namespace_generation << 32) + tag_generation
+
+    def invalidate(self, namespace: str, tag: str) -> None:
+        self._generations[(namespace, tag)] = self._generations.get((namespace, tag), 0) + 1
+
+    def clear(self, namespace: str) -> None:
+        self.invalidate(namespace, NAMESPACE_TAG)
+
+    def reset(self) -> None:
+        self._entries.clear()
+        self._generations.clear()
+        self._bytes = 0
+        self.reset_counters()
+
+    def stats(self) -> dict:
+        return {"backend": "local", "entries": len(self._entries), "bytes": self._bytes, **self.counter_stats()}
+
+
+# Shared memory layout ------------------------------------------------------
+
+MAGIC = b"FPXCACHE"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")  # magic, version, slots, data size, write position
+HEADER_SIZE = 64
+WRITE_POS = struct.Struct("<Q")
+WRITE_POS_OFFSET = 24
+GENERATION_COUNT = 4096
+GENERATION = struct.Struct("<Q")
+# seq, length, key digest, value position, expiry, tag index, namespace
+# index, tag generation, namespace generation
+SLOT = struct.Struct("<II16sQdIIQQ")
+SEQ = struct.Struct("<I")
+WAYS = 4
+DIGEST_SIZE = 16
+
+
+def _digest(namespace: str, key: bytes) -> bytes:
+    return hashlib.blake2b(key, digest_size=DIGEST_SIZE, person=namespace.encode()[:16]).digest()
+
+
+def _generation_index(namespace: str, tag: str) -> int:
+    digest = hashlib.blake2b(f"{namespace}\x00{tag}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % GENERATION_COUNT
+
+
+class SharedMemoryBackend(_Counters, CacheBackend):
+    def __init__(self, path: str, size: int, slots: int) -> None:
+        self.path = path
+        self.slots = max(WAYS, slots - slots % WAYS)
+        self._generations_offset = HEADER_SIZE
+        self._slots_offset = self._generations_offset + GENERATION_COUNT * GENERATION.size
+        self._data_offset = self._slots_offset + self.slots * SLOT.size
+        self.data_size = size - self._data_offset
+        if self.data_size < 4096:
+            raise ValueError("Shared cache size is too small for its slot table")
+        self.size = size
+        self._pid: Optional[int] = None
+        self._fd = -1
+        self._map: Optional[mmap.mmap] = None
+        self.reset_counters()
+
+    # Mapping --------------------------------------------------------------
+
+    def _mapped(self) -> mmap.mmap:
+        # Workers forked after the file was opened need their own descriptor:
+        # an flock held through a shared one would not exclude the others.
+        if self._map is None or self._pid != os.getpid():
+            self._open()
+        return self._map
+
+    def _open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if not self._layout_matches(fd):
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, VERSION, self.slots, self.data_size, 0), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            mapped = mmap.mmap(fd, self.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd, self._map, self._pid = fd, mapped, os.getpid()
+
+    def _layout_matches(self, fd: int) -> bool:
+        if os.fstat(fd).st_size != self.size:
+            return False
+        magic, version, slots, data_size, _ = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+        return (magic, version, slots, data_size) == (MAGIC, VERSION, self.slots, self.data_size)
+
+    def close(self) -> None:
+        if self._map is not None and self._pid == os.getpid():
+            self._map.close()
+            os.close(self._fd)
+        self._map = None
+        self._fd = -1
+
+    def _locked(self) -> "_FileLock":
+        self._mapped()
+        return _FileLock(self._fd)
+
+    # Helpers --------------------------------------------------------------
+
+    def _slot_offsets(self, digest: bytes) -> range:
+        bucket = int.from_bytes(digest[:8], "little") % (self.slots // WAYS)
+        start = self._slots_offset + bucket * WAYS * SLOT.size
+        return range(start, start + WAYS * SLOT.size, SLOT.size)
+
+    def _generation_at(self, mapped: mmap.mmap, index: int) -> int:
+        return GENERATION.unpack_from(mapped, self._generations_offset + index * GENERATION.size)[0]
+
+    def _overwritten(self, mapped: mmap.mmap, position: int) -> bool:
+        write_pos = WRITE_POS.unpack_from(mapped, WRITE_POS_OFFSET)[0]
+        return write_pos + DIGEST_SIZE - position > self.data_size
+
+    # Operations -----------------------------------------------------------
+
+    def get(self, namespace: str, key: bytes) -> Optional[bytes]:
+        mapped = self._mapped()
+        digest = _digest(namespace, key)
+        for offset in self._slot_offsets(digest):
+            seq, length, slot_digest, position, expires_at, tag_index, ns_index, tag_gen, ns_gen = \
+                SLOT.unpack_from(mapped, offset)
+            if slot_digest != digest or seq & 1 or not length:
+                continue
+            if expires_at <= time.time() or self._generation_at(mapped, tag_index) != tag_gen \
+                    or self._generation_at(mapped, ns_index) != ns_gen or self._overwritten(mapped, position):
+                self.stale += 1
+                break
+            start = self._data_offset + position % self.data_size
+            value = mapped[start:start + length]
+            # Valid only if neither the slot nor the value area was rewritten
+            # while it was being copied.
+            if SEQ.unpack_from(mapped, offset)[0] != seq or self._overwritten(mapped, position) \
+                    or mapped[start - DIGEST_SIZE:start] != digest:
+                self.stale += 1
+                break
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, namespace: str, key: bytes, value: bytes, ttl: Optional[float] = None, tag: str = "") -> bool:
+        record = DIGEST_SIZE + len(value)
+        if not value or record > self.data_size // 4:
+            self.rejected += 1
+            return False
+        digest = _digest(namespace, key)
+        tag_index = _generation_index(namespace, tag)
+        ns_index = _generation_index(namespace, NAMESPACE_TAG)
+        expires_at = time.time() + ttl if ttl is not None else float("inf")
+        with self._locked():
+            mapped = self._map
+            write_pos = WRITE_POS.unpack_from(mapped, WRITE_POS_OFFSET)[0]
+            if write_pos % self.data_size + record > self.data_size:
+                # Records never wrap around the end of the ring.
+                write_pos += self.data_size - write_pos % self.data_size
+            # Claim the area before writing it so readers see the overwrite.
+            WRITE_POS.pack_into(mapped, WRITE_POS_OFFSET, write_pos + record)
+            start = self._data_offset + write_pos % self.data_size
+            mapped[start:start + DIGEST_SIZE] = digest
+            mapped[start + DIGEST_SIZE:start + record] = value
+
+            offset = self._victim(mapped, digest)
+            seq = SEQ.unpack_from(mapped, offset)[0]
+            SEQ.pack_into(mapped, offset, seq + 1)
+            SLOT.pack_into(mapped, offset, seq + 1, len(value), digest, write_pos + DIGEST_SIZE, expires_at,
+                           tag_index, ns_index, self._generation_at(mapped, tag_index),
+                           self._generation_at(mapped, ns_index))
+            SEQ.pack_into(mapped, offset, seq + 2)
+        self.stores += 1
+        return True
+
+    def _victim(self, mapped: mmap.mmap, digest: bytes) -> int:
+        """The slot to write: the key's own, a free one, or the oldest of the bucket."""
+        oldest, oldest_position = None, None
+        for offset in self._slot_offsets(digest):
+            _, length, slot_digest, position, expires_at, *_ = SLOT.unpack_from(mapped, offset)
+            if slot_digest == digest or not length or expires_at <= time.time() or self._overwritten(mapped, position):
+                return offset
+            if oldest is None or position < oldest_position:
+                oldest, oldest_position = offset, position
+        return oldest
+
+    def delete(self, namespace: str, key: bytes) -> None:
+        digest = _digest(namespace, key)
+        with self._locked():
+            mapped = self._map
+            for offset in self._slot_offsets(digest):
+                seq, _, slot_digest, *_ = SLOT.unpack_from(mapped, offset)
+                if slot_digest == digest:
+                    SEQ.pack_into(mapped, offset, seq + 1)
+                    SLOT.pack_into(mapped, offset, seq + 2, 0, bytes(DIGEST_SIZE), 0, 0.0, 0, 0, 0, 0)
+
+    def generation(self, namespace: str, tag: str = "") -> int:
+        mapped = self._mapped()
+        tag_generation = self._generation_at(mapped, _generation_index(namespace, tag))
+        namespace_generation = self._generation_at(mapped, _generation_index(namespace, NAMESPACE_TAG))
+        return (namespace_generation << 32) + tag_generation
+
+    def invalidate(self, namespace: str, tag: str) -> None:
+        index = _generation_index(namespace, tag)
+        with self._locked():
+            offset = self._generations_offset + index * GENERATION.size
+            GENERATION.pack_into(self._map, offset, self._generation_at(self._map, index) + 1)
+
+    def clear(self, namespace: str) -> None:
+        self.invalidate(namespace, NAMESPACE_TAG)
+
+    def reset(self) -> None:
+        with self._locked():
+            self._map[HEADER_SIZE:self._data_offset] = bytes(self._data_offset - HEADER_SIZE)
+            WRITE_POS.pack_into(self._map, WRITE_POS_OFFSET, 0)
+        self.reset_counters()
+
+    def stats(self) -> dict:
+        write_pos = WRITE_POS.unpack_from(self._mapped(), WRITE_POS_OFFSET)[0]
+        return {
+            "backend": "shm",
+            "size": self.size,
+            "slots": self.slots,
+            "bytes_written": write_pos,
+            **self.counter_stats(),
+        }
+
+
+class _FileLock:
+    __slots__ = ("fd",)
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+
+    def __enter__(self) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def create_backend(name: str) -> Optional[CacheBackend]:
+    if not name:
+        return None
+    if name == "local":
+        return LocalBackend(settings.SHARED_CACHE_BYTES)
+    if name == "shm":
+        return SharedMemoryBackend(settings.SHARED_CACHE_PATH, settings.SHARED_CACHE_BYTES,
+                                   settings.SHARED_CACHE_SLOTS)
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}")
+
+
+cache_backend = create_backend(settings.CACHE_BACKEND)
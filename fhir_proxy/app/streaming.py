@@ -0,0 +1,72 @@
+from typing import AsyncIterator, Optional
+
+import httpx
+from starlette.responses import Response, StreamingResponse
+
+from .metrics import record_wire_bytes
+
+# Headers that describe the upstream connection or the upstream encoding of
+# the body rather than the resource itself; they are not forwarded.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "content-length",
+    "content-encoding",
+}
+
+
+def response_headers(resp: httpx.Response, raw: bool = False) -> dict[str, str]:
+    """Forwarded headers; `raw` keeps Content-Encoding for a body passed through still encoded."""
+    headers = {k: v for k, v in resp.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    if raw and "content-encoding" in resp.headers:
+        headers["content-encoding"] = resp.headers["content-encoding"]
+    return headers
+
+
+def upstream_encoding(resp: httpx.Response) -> str:
+    return resp.headers.get("content-encoding", "identity").strip().lower()
+
+
+def record_received(resp: httpx.Response) -> None:
+    record_wire_bytes("upstream", upstream_encoding(resp), resp.num_bytes_downloaded)
+
+
+async def iter_upstream(resp: httpx.Response, raw: bool = False) -> AsyncIterator[bytes]:
+    """Yield the upstream body chunk by chunk and always release the connection.
+
+    With `raw` the chunks are yielded in their upstream Content-Encoding.
+    """
+    try:
+        async for chunk in (resp.aiter_raw() if raw else resp.aiter_bytes()):
+            yield chunk
+    finally:
+        record_received(resp)
+        await resp.aclose()
+
+
+def is_json_response(resp: httpx.Response) -> bool:
+    return "json" in resp.headers.get("content-type", "")
+
+
+class UpstreamResult:
+    """What the proxy answers with: a buffered body or a stream of chunks."""
+
+    __slots__ = ("status_code", "headers", "body", "stream")
+
+    def __init__(self, status_code: int, headers: dict, body: bytes = b"",
+                 stream: Optional[AsyncIterator[bytes]] = None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.stream = stream
+
+    def to_response(self) -> Response:
+        if self.stream is not None:
+            return StreamingResponse(self.stream, status_code=self.status_code, headers=self.headers)
+        return Response(content=self.body, status_code=self.status_code, headers=self.headers)
@@ -0,0 +1,148 @@
+from typing import AsyncIterator, Iterable, Optional
+
+from .bundlefilter import BundleScanner
+from .limiter import ClientFault
+from .security import compile_matcher, security_codes
+
+# Request bodies of POST/PUT are streamed to HAPI FHIR as they arrive
+# instead of being read into memory first. The stream is cut with 413 once
+# it passes MAX_REQUEST_BODY_BYTES. With VALIDATE_UPLOAD_SECURITY every
+# resource in it (or every entry resource of a Bundle) must carry an allowed
+# `meta.security` tag; the resources are checked one at a time with the
+# incremental Bundle scanner, and the last chunk is only passed on once the
+# whole body has been checked, so HAPI never receives a complete document
+# holding a resource the caller may not write.
+
+
+class UploadRejected(ClientFault):
+    pass
+
+
+class UploadValidator:
+    def __init__(self, allowed_resources: Iterable[str], max_resource_bytes: int = 0) -> None:
+        self.matcher = compile_matcher(allowed_resources)
+        self.scanner = BundleScanner(max_resource_bytes)
+        self.resource_type: Optional[str] = None
+        self.meta = None
+        self.checked = 0
+        # Verdicts on entries that came before `resourceType`, applied once
+        # the body is known to be a Bundle.
+        self._pending_checked = 0
+        self._pending_rejected = False
+
+    def feed(self, chunk: bytes) -> None:
+        try:
+            events = self.scanner.feed(chunk)
+        except ValueError as e:
+            raise UploadRejected(400, f"Invalid JSON request body: {e}")
+        self._check(events)
+
+    def close(self) -> None:
+        try:
+            events = self.scanner.close()
+        except ValueError as e:
+            raise UploadRejected(400, f"Invalid JSON request body: {e}")
+        self._check(events)
+
+    def _check(self, events: list) -> None:
+        for event in events:
+            kind = event[0]
+            if kind == "member":
+                if event[1] == "resourceType":
+                    self.resource_type = event[3]
+                    if self.resource_type == "Bundle":
+                        self._apply_pending()
+                elif event[1] == "meta":
+                    self.meta = event[3]
+            elif kind == "entry" and self.resource_type in (None, "Bundle"):
+                entry = event[2]
+                if isinstance(entry, dict) and entry.get("resource") is not None:
+                    if self.resource_type is None:
+                        self._pending_checked += 1
+                        self._pending_rejected |= not self._allowed(entry["resource"])
+                    else:
+                        self._require_tag(entry["resource"])
+            elif kind == "end" and self.resource_type != "Bundle":
+                self._require_tag({"meta": self.meta})
+            elif kind == "raw":
+                raise UploadRejected(400, "Request body must be a JSON resource")
+
+    def _allowed(self, resource) -> bool:
+        return any(self.matcher.allows(code) for code in security_codes(resource))
+
+    def _apply_pending(self) -> None:
+        if self._pending_rejected:
+            raise UploadRejected(403, "Every uploaded resource must carry an allowed security tag")
+        self.checked += self._pending_checked
+
+    def _require_tag(self, resource) -> None:
+        if not self._allowed(resource):
+            raise UploadRejected(403, "Every uploaded resource must carry an allowed security tag")
+        self.checked += 1
+
+
+async def stream_upload(chunks: AsyncIterator[bytes], max_bytes: int = 0,
+                        validator: Optional[UploadValidator] = None) -> AsyncIterator[bytes]:
+    """Pass a request body on chunk by chunk, within `max_bytes` and checked by `validator`."""
+    size = 0
+    held = None
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise UploadRejected(413, f"Request body exceeds {max_bytes} bytes")
+        if validator is not None:
+            validator.feed(chunk)
+        if held is not None:
+            yield held
+        held = chunk
+    if validator is not None:
+        validator.close()
+    if held is not None:
+        yield held
+
+
+async def peek_bundle_type(chunks: AsyncIterator[bytes], max_bytes: int = 0) -> tuple[Optional[str], list[bytes]]:
+    """Read a body until the `type` of a Bundle is known; return it with the chunks read.
+
+    Bundles name their type before their entries, so normally only the
+    first chunk is read. Anything but a Bundle stops at `resourceType`.
+    """
+    scanner = BundleScanner()
+    read: list[bytes] = []
+    size = 0
+    is_bundle = None
+    async for chunk in chunks:
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise UploadRejected(413, f"Request body exceeds {max_bytes} bytes")
+        read.append(chunk)
+        try:
+            events = scanner.feed(chunk)
+        except ValueError:
+            return None, read
+        for event in events:
+            if event[0] == "raw" or event[0] == "end":
+                return None, read
+            if event[0] == "member" and event[1] == "resourceType":
+                is_bundle = event[3] == "Bundle"
+                if not is_bundle:
+                    return None, read
+            elif event[0] == "member" and event[1] == "type" and is_bundle is not False:
+                return (event[3] if isinstance(event[3], str) else None), read
+    return None, read
+
+
+async def chain(head: list[bytes], rest: Optional[AsyncIterator[bytes]] = None) -> AsyncIterator[bytes]:
+    for chunk in head:
+        yield chunk
+    if rest is not None:
+        async for chunk in rest:
+            yield chunk
+
+
+def check_content_length(content_length: Optional[str], max_bytes: int) -> None:
+    """Refuse a body announced larger than `max_bytes` before reading any of it."""
+    if max_bytes and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise UploadRejected(413, f"Request body exceeds {max_bytes} bytes")
@@ -0,0 +1,95 @@
+"""Hit rates of the authorization and response caches across worker processes.
+
+Run from the fhir_proxy directory:
+
+    python -m benchmarks.cache_bench [--workers 1,2,4,8] [--requests 20000]
+                                     [--tokens 2000] [--urls 5000] [--backends none,shm]
+
+Each worker process gets its own in-process caches, like a Gunicorn worker,
+and serves its share of one skewed stream of (token, URL) requests. With
+`none` every worker warms its own caches; with `shm` the workers also share
+a shared-memory tier. Misses are what would go to Gen3 and HAPI FHIR.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from app.authcache import AuthorizationCache
+from app.responsecache import CachedResponse, ResponseCache
+from app.scope import AccessScope
+from app.sharedcache import SharedMemoryBackend
+
+BODY = b'{"resourceType":"Bundle","type":"searchset","entry":[]}' * 20
+
+
+def request_stream(count: int, tokens: int, urls: int, seed: int) -> list[tuple[int, int]]:
+    rng = random.Random(seed)
+    # Skewed like real traffic: a few users and queries dominate.
+    return [(int(rng.paretovariate(1.2)) % tokens, int(rng.paretovariate(1.1)) % urls) for _ in range(count)]
+
+
+async def serve(requests: list, args, shm_path: str) -> dict:
+    backend = SharedMemoryBackend(shm_path, args.shared_bytes, args.shared_slots) if shm_path else None
+    auth = AuthorizationCache(ttl=300, negative_ttl=10, max_entries=args.l1_entries, max_bytes=64 * 1024 * 1024,
+                              backend=backend)
+    responses = ResponseCache(max_bytes=args.l1_entries * len(BODY), max_entry_bytes=len(BODY) * 2,
+                              backend=backend)
+
+    async def load(token: str) -> AccessScope:
+        return AccessScope([f"/programs/p{token[-1]}"])
+
+    response_misses = 0
+    for token_id, url_id in requests:
+        scope = await auth.get_or_load(f"token-{token_id}", load)
+        key = f"{scope.digest}:{url_id}"
+        if await responses.get(key) is None:
+            response_misses += 1
+            await responses.put(key, CachedResponse("Patient", 200, {}, BODY, time.time()))
+    return {"requests": len(requests), "auth_misses": auth.misses, "response_misses": response_misses}
+
+
+def worker(requests: list, args, shm_path: str) -> dict:
+    return asyncio.run(serve(requests, args, shm_path))
+
+
+def run(workers: int, backend: str, args) -> dict:
+    stream = request_stream(args.requests, args.tokens, args.urls, seed=1)
+    shares = [stream[i::workers] for i in range(workers)]
+    with tempfile.TemporaryDirectory(dir=args.shm_dir) as directory:
+        shm_path = os.path.join(directory, "cache") if backend == "shm" else ""
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = pool.starmap(worker, [(share, args, shm_path) for share in shares])
+    total = sum(r["requests"] for r in results)
+    return {
+        "auth_hit_ratio": 1 - sum(r["auth_misses"] for r in results) / total,
+        "response_hit_ratio": 1 - sum(r["response_misses"] for r in results) / total,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4,8", help="Worker process counts")
+    parser.add_argument("--backends", default="none,shm", help="Shared tiers to compare")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--tokens", type=int, default=2000, help="Distinct bearer tokens")
+    parser.add_argument("--urls", type=int, default=5000, help="Distinct URLs per scope")
+    parser.add_argument("--l1-entries", type=int, default=500, help="In-process entries per worker and cache")
+    parser.add_argument("--shared-bytes", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--shared-slots", type=int, default=65536)
+    parser.add_argument("--shm-dir", default="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'backend':>7} {'auth hit %':>10} {'response hit %':>14}")
+    for workers in (int(w) for w in args.workers.split(",")):
+        for backend in args.backends.split(","):
+            result = run(workers, backend, args)
+            print(f"{workers:>7} {backend:>7} {result['auth_hit_ratio'] * 100:>10.1f}"
+                  f" {result['response_hit_ratio'] * 100:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
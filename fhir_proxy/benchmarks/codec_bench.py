@@ -0,0 +1,42 @@
+"""Encode/decode throughput of the available JSON codecs on Synthea-like Bundles.
+
+Run from the fhir_proxy directory:
+
+    python -m benchmarks.codec_bench [--sizes 10,100,1000,10000] [--repeat 5]
+"""
+import argparse
+import time
+
+from app.codec import CODECS
+
+from .synthea import searchset_bundle
+
+
+def best_time(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="Bundle sizes in entries")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'entries':>8} {'bytes':>11} {'codec':>7} {'decode MB/s':>12} {'encode MB/s':>12}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        bundle = searchset_bundle(size)
+        payload = CODECS["json"].dumps(bundle)
+        megabytes = len(payload) / 1e6
+        for name, codec in CODECS.items():
+            decode = best_time(lambda: codec.loads(payload), args.repeat)
+            encode = best_time(lambda: codec.dumps(bundle), args.repeat)
+            print(f"{size:>8} {len(payload):>11} {name:>7} {megabytes / decode:>12.1f} {megabytes / encode:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
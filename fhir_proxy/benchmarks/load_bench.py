@@ -0,0 +1,207 @@
+"""Load test of the proxy against in-process HAPI FHIR and Gen3 stand-ins.
+
+Run from the fhir_proxy directory:
+
+    python -m benchmarks.load_bench [--concurrency 1,10,50] [--requests 1000] [--entries 50]
+                                    [--hapi-latency-ms 5] [--gen3-latency-ms 20]
+                                    [--json results.json] [--compare baseline.json]
+
+The proxy app and both upstreams run in this process, so the numbers measure
+the proxy hot path rather than the network. Upstream time is measured at the
+stand-ins; "proxy" is the remainder of each request's latency, including
+time spent waiting for the event loop.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import resource
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+from app.authcache import auth_cache
+from app.clients import GEN3, HAPI, close_clients, set_transport
+from app.coalesce import coalescer
+from app.main import app
+from app.responsecache import response_cache
+
+from .standins import StageTimer, TimedTransport, gen3_app, hapi_app
+
+STAGES = ("gen3", "hapi")
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+
+def request_path(scenario: str, i: int, queries: int) -> str:
+    n = i % queries if queries else i
+    if scenario == "read":
+        return f"/Patient/{n}"
+    return f"/Patient?name=bench-{n}"
+
+
+def reset_caches() -> None:
+    auth_cache.reset()
+    response_cache.reset()
+    coalescer.reset()
+
+
+async def drive(proxy: httpx.AsyncClient, args, concurrency: int, total: int) -> tuple[list, int]:
+    latencies: list[float] = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker() -> None:
+        nonlocal errors
+        while (i := next(counter)) < total:
+            token = f"bench-token-{i % args.tokens}"
+            start = time.perf_counter()
+            resp = await proxy.get(request_path(args.scenario, i, args.queries),
+                                   headers={"Authorization": f"Bearer {token}"})
+            latencies.append(time.perf_counter() - start)
+            if resp.status_code != 200:
+                errors += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def run_level(proxy: httpx.AsyncClient, timer: StageTimer, args, concurrency: int) -> dict:
+    reset_caches()
+    await drive(proxy, args, concurrency, args.warmup)
+    timer.reset()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    latencies, errors = await drive(proxy, args, concurrency, args.requests)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if args.tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    count = len(latencies)
+    mean = sum(latencies) / count
+    stages = {stage: timer.seconds[stage] / count * 1000 for stage in STAGES}
+    stages["proxy"] = max(mean * 1000 - sum(stages.values()), 0.0)
+    return {
+        "concurrency": concurrency,
+        "requests": count,
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": count / elapsed,
+        "mean_ms": mean * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "stages_ms": stages,
+        "upstream_calls": {stage: timer.calls[stage] for stage in STAGES},
+        "peak_bytes": peak,
+    }
+
+
+def print_level(result: dict) -> None:
+    stages = result["stages_ms"]
+    peak = result["peak_bytes"]
+    print(
+        f"{result['concurrency']:>5} {result['requests']:>7} {result['errors']:>6} {result['rps']:>9.1f}"
+        f" {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f}"
+        f" {stages['gen3']:>7.2f} {stages['hapi']:>7.2f} {stages['proxy']:>7.2f}"
+        f" {(peak // 1024 if peak is not None else '-'):>9}"
+    )
+
+
+def compare(results: list, baseline_path: str, tolerance: float, args=None) -> list[str]:
+    with open(baseline_path) as f:
+        data = json.load(f)
+    baseline = {level["concurrency"]: level for level in data["levels"]}
+    if args is not None:
+        for name, value in data.get("args", {}).items():
+            if name != "concurrency" and getattr(args, name, value) != value:
+                print(f"note: baseline was run with --{name.replace('_', '-')}={value}")
+    regressions = []
+    for result in results:
+        base = baseline.get(result["concurrency"])
+        if base is None:
+            continue
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"c={result['concurrency']}: rps {result['rps']:.1f} < baseline {base['rps']:.1f}")
+        for key in ("p95_ms", "p99_ms"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"c={result['concurrency']}: {key} {result[key]:.2f} > baseline {base[key]:.2f}")
+    return regressions
+
+
+async def run(args) -> list:
+    timer = StageTimer()
+    codes = [f"/programs/bench/projects/p{i}" for i in range(args.codes)]
+    hapi = hapi_app(args.entries, codes, args.hapi_latency_ms / 1000)
+    gen3 = gen3_app(codes, args.gen3_latency_ms / 1000)
+    await close_clients()
+    set_transport(HAPI, TimedTransport(httpx.ASGITransport(app=hapi), timer, "hapi"))
+    set_transport(GEN3, TimedTransport(httpx.ASGITransport(app=gen3), timer, "gen3"))
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=None) as proxy:
+            for concurrency in args.concurrency:
+                result = await run_level(proxy, timer, args, concurrency)
+                print_level(result)
+                results.append(result)
+    finally:
+        await close_clients()
+        set_transport(HAPI, None)
+        set_transport(GEN3, None)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,10,50", help="Concurrency levels to run")
+    parser.add_argument("--requests", type=int, default=1000, help="Measured requests per level")
+    parser.add_argument("--warmup", type=int, default=50, help="Unmeasured requests per level")
+    parser.add_argument("--scenario", choices=("search", "read"), default="search")
+    parser.add_argument("--entries", type=int, default=50, help="Entries per search Bundle")
+    parser.add_argument("--codes", type=int, default=4, help="Distinct security codes")
+    parser.add_argument("--tokens", type=int, default=100, help="Distinct bearer tokens")
+    parser.add_argument("--queries", type=int, default=0, help="Distinct queries (0: every request differs)")
+    parser.add_argument("--hapi-latency-ms", type=float, default=5.0)
+    parser.add_argument("--gen3-latency-ms", type=float, default=20.0)
+    parser.add_argument("--tracemalloc", action="store_true", help="Report the traced memory peak (slower)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+
+    print(f"{'conc':>5} {'reqs':>7} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          f" {'gen3 ms':>7} {'hapi ms':>7} {'proxy ms':>7} {'peak KiB':>9}")
+    results = asyncio.run(run(args))
+    print(f"max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} KiB")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+                       "levels": results}, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance, args)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Security tag checks against large allowed-resource sets.
+
+Run from the fhir_proxy directory:
+
+    python -m benchmarks.matcher_bench [--paths 100,1000,10000,50000] [--checks 20000]
+
+Compares the compiled matcher (frozenset plus path trie) with a scan of the
+allowed list, for a mix of exact hits, descendant paths and misses.
+"""
+import argparse
+import random
+import time
+
+from app.security import SecurityMatcher
+
+
+def allowed_paths(count: int) -> list[str]:
+    return [f"/programs/p{i % 100}/projects/r{i}" for i in range(count)]
+
+
+def sample_codes(paths: list[str], checks: int) -> list[str]:
+    rng = random.Random(0)
+    codes = []
+    for i in range(checks):
+        path = rng.choice(paths)
+        kind = i % 3
+        if kind == 0:
+            codes.append(path)
+        elif kind == 1:
+            codes.append(f"{path}/subjects/s{i}")
+        else:
+            codes.append(f"/programs/other/projects/r{i}")
+    return codes
+
+
+def list_allows(allowed: list[str], code: str) -> bool:
+    # Exact matches only; the old check had no notion of hierarchy.
+    return code in allowed
+
+
+def best_time(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paths", default="100,1000,10000,50000", help="Allowed resource paths")
+    parser.add_argument("--checks", type=int, default=20000, help="Codes checked per run")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'paths':>7} {'compile ms':>11} {'matcher ns/check':>17} {'list ns/check':>14}")
+    for count in (int(p) for p in args.paths.split(",")):
+        paths = allowed_paths(count)
+        codes = sample_codes(paths, args.checks)
+        compile_time = best_time(lambda: SecurityMatcher(paths), args.repeat)
+        matcher = SecurityMatcher(paths)
+        matched = best_time(lambda: [matcher.allows(code) for code in codes], args.repeat)
+        # The list scan is O(n) per check; time a slice so large sets finish.
+        scanned_codes = codes[:max(1, min(len(codes), 2_000_000 // count))]
+        scanned = best_time(lambda: [list_allows(paths, code) for code in scanned_codes], args.repeat)
+        print(f"{count:>7} {compile_time * 1e3:>11.2f} {matched / len(codes) * 1e9:>17.0f}"
+              f" {scanned / len(scanned_codes) * 1e9:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
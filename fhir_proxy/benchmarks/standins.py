@@ -0,0 +1,82 @@
+"""In-process stand-ins for the HAPI FHIR server and the Gen3 user endpoint."""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Sequence
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from .synthea import patient, searchset_bundle
+
+FHIR_JSON = "application/fhir+json"
+
+
+def hapi_app(entries: int, codes: Sequence[str], latency: float = 0.0) -> Starlette:
+    """A FHIR server answering every search with the same Synthea-like Bundle.
+
+    Bodies are serialized once up front so the stand-in costs as little as
+    possible next to the proxy being measured.
+    """
+    bundle = json.dumps(searchset_bundle(entries, codes)).encode()
+    resource = json.dumps(patient(random.Random(0), codes)).encode()
+
+    async def fhir(request: Request) -> Response:
+        if latency:
+            await asyncio.sleep(latency)
+        parts = request.path_params["path"].strip("/").split("/")
+        body = resource if len(parts) == 2 and parts[1] != "_search" else bundle
+        return Response(body, media_type=FHIR_JSON)
+
+    return Starlette(routes=[Route("/{path:path}", fhir, methods=["GET", "POST", "PUT", "DELETE"])])
+
+
+def gen3_app(resources: Sequence[str], latency: float = 0.0) -> Starlette:
+    body = json.dumps({"resources": list(resources)}).encode()
+
+    async def user(request: Request) -> Response:
+        if latency:
+            await asyncio.sleep(latency)
+        return Response(body, media_type="application/json")
+
+    return Starlette(routes=[Route("/{path:path}", user)])
+
+
+class StageTimer:
+    """Accumulated wall time per stage, e.g. per upstream."""
+
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = defaultdict(float)
+        self.calls: dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def reset(self) -> None:
+        self.seconds.clear()
+        self.calls.clear()
+
+
+class TimedTransport(httpx.AsyncBaseTransport):
+    """Wrap a transport and record how long each upstream exchange took."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, timer: StageTimer, stage: str) -> None:
+        self.inner = inner
+        self.timer = timer
+        self.stage = stage
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            return await self.inner.handle_async_request(request)
+        finally:
+            self.timer.record(self.stage, time.perf_counter() - start)
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
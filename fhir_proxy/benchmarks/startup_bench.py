@@ -0,0 +1,77 @@
+"""Worker boot time: importing the app and running its startup.
+
+Run from the fhir_proxy directory:
+
+    python -m benchmarks.startup_bench [--runs 10] [--top 15]
+
+Every run is a fresh interpreter, like a new Gunicorn worker or a pod
+scaled out by the autoscaler. `import` is the time to import `app.main`,
+`startup` the lifespan startup after it (settings validation, upstream
+clients). `--top` lists the slowest modules imported by `app.main` (two levels
+deep) by cumulative time, as reported by `python -X importtime`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import asyncio, json, time
+start = time.perf_counter()
+from app.main import app, lifespan
+imported = time.perf_counter()
+
+async def boot():
+    async with lifespan(app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(json.dumps({"import": imported - start, "startup": ready - imported}))
+"""
+
+
+def probe(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-W", "ignore", "-c", PROBE], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(env: dict, top: int) -> list[tuple[int, str]]:
+    stderr = subprocess.run([sys.executable, "-W", "ignore", "-X", "importtime", "-c", "import app.main"], env=env,
+                            check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Names are indented two spaces per level below `app.main`.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if 1 <= depth <= 2:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports to list, 0 for none")
+    args = parser.parse_args()
+
+    # Nothing to fetch at startup: no JWKS, no network.
+    env = {**os.environ, "JWKS_URL": "", "PYTHONPATH": os.getcwd()}
+    runs = [probe(env) for _ in range(args.runs)]
+    print(f"{'':>8} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for phase in ("import", "startup"):
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:>8} {statistics.median(values):>10.1f} {min(values):>8.1f} {max(values):>8.1f}")
+
+    if args.top:
+        print("\nslowest imports (cumulative ms)")
+        for micros, name in slowest_imports(env, args.top):
+            print(f"{micros / 1000:>8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
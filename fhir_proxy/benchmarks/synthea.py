@@ -0,0 +1,151 @@
+import random
+import uuid
+from typing import Sequence
+
+# Synthea-like FHIR resources for benchmarks: one Patient followed by
+# Encounters, Observations, Conditions and MedicationRequests that reference
+# it, with the same shape and nesting as Synthea's R4 output.
+
+LOINC = [
+    ("8302-2", "Body Height", 150.0, 190.0, "cm"),
+    ("29463-7", "Body Weight", 50.0, 110.0, "kg"),
+    ("8867-4", "Heart rate", 55.0, 110.0, "/min"),
+    ("2339-0", "Glucose", 70.0, 140.0, "mg/dL"),
+    ("39156-5", "Body mass index", 18.0, 35.0, "kg/m2"),
+]
+SNOMED_CONDITIONS = [
+    ("44054006", "Diabetes"),
+    ("38341003", "Hypertension"),
+    ("195662009", "Acute viral pharyngitis"),
+    ("10509002", "Acute bronchitis"),
+]
+RXNORM = [("860975", "metformin 500 MG Oral Tablet"), ("314076", "lisinopril 10 MG Oral Tablet")]
+
+
+def _security(codes: Sequence[str], rng: random.Random) -> dict:
+    return {"security": [{"system": "gen3", "code": rng.choice(codes)}]}
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def patient(rng: random.Random, codes: Sequence[str]) -> dict:
+    pid = _uuid(rng)
+    return {
+        "resourceType": "Patient",
+        "id": pid,
+        "meta": _security(codes, rng),
+        "text": {"status": "generated", "div": "<div xmlns=\"http://www.w3.org/1999/xhtml\">Generated by Synthea</div>"},
+        "extension": [
+            {
+                "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+                "extension": [{"url": "ombCategory", "valueCoding": {
+                    "system": "urn:oid:2.16.840.1.113883.6.238", "code": "2106-3", "display": "White"}}],
+            }
+        ],
+        "identifier": [{"system": "https://github.com/synthetichealth/synthea", "value": pid}],
+        "name": [{"use": "official", "family": f"Family{rng.randint(1, 999)}", "given": [f"Given{rng.randint(1, 999)}"]}],
+        "gender": rng.choice(["male", "female"]),
+        "birthDate": f"{rng.randint(1930, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "address": [{"line": [f"{rng.randint(1, 999)} Main St"], "city": "Chicago", "state": "IL", "country": "US"}],
+    }
+
+
+def encounter(rng: random.Random, codes: Sequence[str], patient_id: str) -> dict:
+    return {
+        "resourceType": "Encounter",
+        "id": _uuid(rng),
+        "meta": _security(codes, rng),
+        "status": "finished",
+        "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "AMB"},
+        "type": [{"coding": [{"system": "http://snomed.info/sct", "code": "185349003",
+                              "display": "Encounter for check up"}]}],
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "period": {"start": "2020-01-01T10:00:00-05:00", "end": "2020-01-01T10:15:00-05:00"},
+    }
+
+
+def observation(rng: random.Random, codes: Sequence[str], patient_id: str, encounter_id: str) -> dict:
+    code, display, low, high, unit = rng.choice(LOINC)
+    return {
+        "resourceType": "Observation",
+        "id": _uuid(rng),
+        "meta": _security(codes, rng),
+        "status": "final",
+        "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                                  "code": "vital-signs", "display": "vital-signs"}]}],
+        "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}], "text": display},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "encounter": {"reference": f"Encounter/{encounter_id}"},
+        "effectiveDateTime": "2020-01-01T10:00:00-05:00",
+        "valueQuantity": {"value": round(rng.uniform(low, high), 2), "unit": unit,
+                          "system": "http://unitsofmeasure.org", "code": unit},
+    }
+
+
+def condition(rng: random.Random, codes: Sequence[str], patient_id: str, encounter_id: str) -> dict:
+    code, display = rng.choice(SNOMED_CONDITIONS)
+    return {
+        "resourceType": "Condition",
+        "id": _uuid(rng),
+        "meta": _security(codes, rng),
+        "clinicalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-clinical",
+                                       "code": "active"}]},
+        "code": {"coding": [{"system": "http://snomed.info/sct", "code": code, "display": display}], "text": display},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "encounter": {"reference": f"Encounter/{encounter_id}"},
+        "onsetDateTime": "2020-01-01T10:00:00-05:00",
+    }
+
+
+def medication_request(rng: random.Random, codes: Sequence[str], patient_id: str, encounter_id: str) -> dict:
+    code, display = rng.choice(RXNORM)
+    return {
+        "resourceType": "MedicationRequest",
+        "id": _uuid(rng),
+        "meta": _security(codes, rng),
+        "status": "active",
+        "intent": "order",
+        "medicationCodeableConcept": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm",
+                                                  "code": code, "display": display}], "text": display},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "encounter": {"reference": f"Encounter/{encounter_id}"},
+        "authoredOn": "2020-01-01T10:00:00-05:00",
+        "dosageInstruction": [{"sequence": 1, "timing": {"repeat": {"frequency": 1, "period": 1, "periodUnit": "d"}}}],
+    }
+
+
+def resources(count: int, codes: Sequence[str] = ("/programs/synthea",), seed: int = 0):
+    rng = random.Random(seed)
+    produced = 0
+    while produced < count:
+        pat = patient(rng, codes)
+        yield pat
+        produced += 1
+        while produced < count and rng.random() > 0.02:
+            enc = encounter(rng, codes, pat["id"])
+            yield enc
+            produced += 1
+            for make in (observation, observation, observation, condition, medication_request):
+                if produced >= count:
+                    break
+                yield make(rng, codes, pat["id"], enc["id"])
+                produced += 1
+
+
+def searchset_bundle(count: int, codes: Sequence[str] = ("/programs/synthea",), seed: int = 0,
+                     base_url: str = "http://localhost:8080/fhir") -> dict:
+    entries = [
+        {"fullUrl": f"{base_url}/{res['resourceType']}/{res['id']}", "resource": res, "search": {"mode": "match"}}
+        for res in resources(count, codes, seed)
+    ]
+    return {
+        "resourceType": "Bundle",
+        "id": str(uuid.UUID(int=seed)),
+        "meta": {"lastUpdated": "2020-01-01T10:00:00.000-05:00"},
+        "type": "searchset",
+        "total": count,
+        "link": [{"relation": "self", "url": f"{base_url}/Observation?_count={count}"}],
+        "entry": entries,
+    }